@@ -8,8 +8,8 @@ VERSION_MINOR = 1
 # Parse arguments first, so --version works even if the deps misbehave.
 parser = argparse.ArgumentParser(description="Build Fomu bitstream")
 parser.add_argument(
-    "--revision", choices=["evt", "dvt", "pvt", "hacker"], required=True,
-    help="Hardware revision to target"
+    "--revision", choices=["evt", "dvt", "pvt", "hacker"], nargs="+", required=True,
+    help="Hardware revision to target; give several to build them all"
     )
 parser.add_argument(
     "--version",
@@ -20,7 +20,75 @@ parser.add_argument(
     "--test",
     action="store_true",
     help="Run as testbench")
+parser.add_argument(
+    "--sim", choices=["migen", "verilator"], default="migen",
+    help="Simulator to use with --test")
+parser.add_argument(
+    "--cycles", type=int, default=None,
+    help="CPU cycle budget for --test (default 1000 for migen, 1000000 for verilator)")
+parser.add_argument(
+    "--stop-pc", type=lambda x: int(x, 0),
+    help="Stop the simulation when the CPU fetches an instruction here")
+parser.add_argument(
+    "--stop-write", type=lambda x: int(x, 0),
+    help="Stop the simulation when the CPU writes to this address")
+parser.add_argument(
+    "--sys-clk", type=float, default=12,
+    help="CPU clock frequency in MHz; the PLL gets as close as it can (default 12)")
+parser.add_argument(
+    "--registered-bus", action="store_true",
+    help="Register the bus read mux, for Fmax, at the cost of a wait state on reads the SPRAM can't answer at once")
+parser.add_argument(
+    "--cpu-variant", choices=["standard", "65c02"], default="standard",
+    help="CPU core: the NMOS 6502, or a 65C02 with the CMOS instructions (default standard)")
+parser.add_argument(
+    "--rom-image", metavar="FILE",
+    help="Firmware for the block RAM ROM: a raw binary, or Intel HEX (.hex) with 6502 addresses")
+parser.add_argument(
+    "--rom-region", default="high_os_rom",
+    help="Memory map entry the ROM replaces (default high_os_rom)")
+parser.add_argument(
+    "--rom-size", type=lambda x: int(x, 0),
+    help="ROM size in bytes (default: the size of the image)")
+parser.add_argument(
+    "--rom-placeholder", action="store_true",
+    help="Fill the ROM with a placeholder pattern that --swap-rom can replace later")
+parser.add_argument(
+    "--swap-rom", metavar="FILE",
+    help="Patch new firmware into the last --rom-placeholder bitstream, without rebuilding it")
+parser.add_argument(
+    "--cache-dir", default=None,
+    help="Where to keep cached build artifacts (default build_cache/ next to build.py)")
+parser.add_argument(
+    "--no-cache", action="store_true",
+    help="Run the whole toolchain, without the build cache")
+parser.add_argument(
+    "--seeds", type=int, default=None,
+    help="Place and route with this many nextpnr seeds, keeping the bitstream with the most slack")
+parser.add_argument(
+    "--jobs", type=int, default=None,
+    help="Processes to build revisions and seeds with (default: one per core)")
+parser.add_argument(
+    "--bench", action="store_true",
+    help="Build, report resource use and Fmax, and fail if either regressed since the last --bench")
+parser.add_argument(
+    "--bench-history", default=None,
+    help="JSON lines file --bench appends its results to (default bench_history.jsonl next to build.py)")
+parser.add_argument(
+    "--max-lut-growth", type=float, default=2.0,
+    help="Percentage growth in logic cells --bench tolerates (default 2)")
+parser.add_argument(
+    "--max-fmax-drop", type=float, default=5.0,
+    help="Percentage drop in any clock's Fmax --bench tolerates (default 5)")
+parser.add_argument(
+    "--profile-elaboration", action="store_true",
+    help="Report how long building the SoC and its Verilog takes, per submodule, then stop")
 args = parser.parse_args()
+sweeping = len(args.revision) > 1 or args.seeds is not None
+if (sweeping or args.bench) and (args.test or args.swap_rom or args.no_cache):
+    parser.error("several revisions, --seeds and --bench only work for cached hardware builds")
+if sweeping and args.bench:
+    parser.error("--bench builds one revision with one seed")
 
 # Add all the dependencies' base paths into the Python path.
 base_dir = os.path.dirname(__file__)
@@ -31,18 +99,106 @@ for dep in os.listdir(deps_dir):
 from fomu_platform import FomuPlatform
 from fomu_soc import Fomu
 
-platform = FomuPlatform(revision = args.revision)
-soc = Fomu(platform)
+output_dir = os.path.join(base_dir, "build")
+if args.rom_region not in Fomu.memory_map:
+    parser.error("unknown --rom-region "+args.rom_region)
+
+if args.swap_rom:
+    import time
+    from fomu_6502_rom import load_rom_image, load_placeholder, swap_rom
+    start = time.time()
+    region, size = load_placeholder(output_dir)
+    swap_rom(output_dir, load_rom_image(args.swap_rom, Fomu.memory_map[region].start))
+    print("Swapped", args.swap_rom, "into", region, "in %.2fs" % (time.time() - start))
+    sys.exit(0)
+
+rom_image = None
+if args.rom_placeholder:
+    from fomu_6502_rom import save_placeholder
+    os.makedirs(output_dir, exist_ok=True)
+    rom_size = args.rom_size or Fomu.memory_map[args.rom_region].size
+    rom_image = save_placeholder(output_dir, args.rom_region, rom_size)
+elif args.rom_image:
+    from fomu_6502_rom import load_rom_image
+    rom_image = load_rom_image(args.rom_image, Fomu.memory_map[args.rom_region].start)
+
+def elaborate_on(platform):
+    return Fomu(platform, simulation=args.test and args.sim == "migen", sys_clk_freq=args.sys_clk*1e6,
+                rom_image=rom_image, rom_region=args.rom_region, rom_size=args.rom_size,
+                cpu_variant=args.cpu_variant, registered_bus=args.registered_bus)
+
+def elaborate(revision):
+    platform = FomuPlatform(revision = revision)
+    return platform, elaborate_on(platform)
+
+cache_dir = args.cache_dir or os.path.join(base_dir, "build_cache")
+# The CPU core hardly ever changes, so it is synthesised out of context and
+# its netlist linked into the rest of the design.
+from fomu_6502_cpu import CPU_SOURCES
+prebuilt = {"cpu": CPU_SOURCES[args.cpu_variant]}
+
+if sweeping:
+    # Each revision is built in build/<revision>, and each seed in a
+    # seed<N> directory below that.
+    from fomu_flow import sweep
+    build_dirs = []
+    for revision in args.revision:
+        platform, soc = elaborate(revision)
+        build_dirs.append(os.path.join(output_dir, revision))
+        platform.build(soc, build_dir=build_dirs[-1], run=False)
+    sweep(build_dirs, cache_dir, range(1, (args.seeds or 1) + 1), args.jobs, prebuilt=prebuilt)
+    sys.exit(0)
+
+if args.profile_elaboration:
+    from fomu_profile import ElaborationProfiler
+    platform = FomuPlatform(revision = args.revision[0])
+    ElaborationProfiler(platform, lambda: elaborate_on(platform)).print_report()
+    sys.exit(0)
+
+platform, soc = elaborate(args.revision[0])
+
+if args.bench:
+    from fomu_flow import FomuFlow
+    import fomu_bench
+    flow = FomuFlow(output_dir, cache_dir, prebuilt=prebuilt)
+    platform.build(soc, build_dir=output_dir, run=False)
+    flow.run()
+    # Breaking the SoC up into submodules uses up its elaboration, so do
+    # that with a fresh one.
+    bench_platform, bench_soc = elaborate(args.revision[0])
+    record = fomu_bench.benchmark_record(flow, args.revision[0], soc.sys_clk_freq,
+                                         fomu_bench.synthesise_submodules(flow, bench_platform, bench_soc),
+                                         args.cpu_variant, fomu_bench.synthesise_cores(flow, CPU_SOURCES))
+    fomu_bench.print_record(record)
+    history_file = args.bench_history or os.path.join(base_dir, "bench_history.jsonl")
+    record["regressions"] = fomu_bench.regressions(record, fomu_bench.load_history(history_file),
+                                                   args.max_lut_growth, args.max_fmax_drop)
+    fomu_bench.append_history(history_file, record)
+    for complaint in record["regressions"]:
+        print("Regression: "+complaint)
+    sys.exit(1 if record["regressions"] else 0)
 
 if not args.test:
-    output_dir = os.path.join(base_dir, "build")
-    platform.build(soc)
+    if args.no_cache:
+        platform.build(soc, build_dir=output_dir)
+    else:
+        from fomu_flow import FomuFlow
+        platform.build(soc, build_dir=output_dir, run=False)
+        FomuFlow(output_dir, cache_dir, prebuilt=prebuilt).run()
+elif args.sim == "verilator":
+    import time
+    from fomu_verilator import VerilatorSim
+    platform.build(soc, build_dir=output_dir, run=False)
+    sim = VerilatorSim(output_dir, sources=CPU_SOURCES[args.cpu_variant])
+    start = time.time()
+    result = sim.run(args.cycles or 1000000, stop_pc=args.stop_pc, stop_write=args.stop_write)
+    elapsed = time.time() - start
+    print("Stopped on", result.reason, "after", result.cycles, "cycles, PC = $%04X" % result.pc)
+    if args.stop_write is not None:
+        print("Last write to $%04X: $%02X" % (args.stop_write, sim.peek(args.stop_write)))
+    if elapsed > 0:
+        print("%.2f MHz simulated" % (result.cycles / elapsed / 1e6))
 else:
     from migen.sim import run_simulation
-    def testbench():
-        yield soc.cd_sys.clk
-        yield soc.cd_sys.rst
-        yield soc.address_bus
-        yield
-    
-    run_simulation(soc, testbench())
+    from testbench import testbench
+    run_simulation(soc, testbench(soc, args.cycles or 1000, args.stop_pc, args.stop_write))
@@ -16,3 +16,65 @@ class Bus6502(object):
         self.irq = Signal(reset=0)
         self.nmi = Signal(reset=0)
         self.rdy = Signal(reset=1)
+        # RDY as the master sees it, from the fabric: the master moves on
+        # after each cycle it is set.
+        self.bus_rdy = Signal(reset=1)
+        # Set while RDY is low and the master is presenting its next access,
+        # a write to this device, so a device holding RDY after a read can
+        # tell an indexed store's read from the program's.
+        self.write_waiting = Signal()
+
+    def access(self):
+        """For a device that is also a Module. Returns (access, offset):
+        access is set on each cycle of an access that the master moves on
+        from (cs with bus_rdy), so once however many cycles the fabric
+        presents it for (wait states or a stalled master), and offset holds
+        address[:4] from the last access, for read data, as the master moves
+        its address on while the device answers. The read an indexed store
+        or read-modify-write instruction makes of its target before writing
+        it is an access of its own."""
+        access = Signal()
+        offset = Signal(4)
+        self.comb += access.eq(self.cs & self.bus_rdy)
+        self.sync += If(access, offset.eq(self.address[:4]))
+        return access, offset
+
+    def completed_reads(self, access):
+        """For a device whose reads have side effects (taking a byte from a
+        queue), given access from access(). An indexed store reads its
+        target the cycle before writing it, and a read-modify-write
+        instruction reads it again before writing it, so reads are only
+        acted on once the master has moved on. Returns (start, done,
+        cancelled, offset) for runs of consecutive accesses to one offset:
+        start is set on a run's first access, done on the cycle after a run
+        with a read the program made in it, and cancelled instead after a
+        run of one read then a write, an indexed store's. offset is the
+        run's address[:4]."""
+        offset = Signal(4)
+        in_run = Signal()
+        reads = Signal(2)
+        wrote = Signal()
+        continuing = Signal()
+        ending = Signal()
+        start = Signal()
+        done = Signal()
+        cancelled = Signal()
+        self.comb += [
+            continuing.eq(access & in_run & (self.address[:4] == offset)),
+            ending.eq(self.bus_rdy & in_run & ~continuing),
+            start.eq(access & ~continuing),
+            done.eq(ending & (reads != 0) & ((reads == 2) | ~wrote)),
+            cancelled.eq(ending & (reads == 1) & wrote)
+            ]
+        self.sync += If(self.bus_rdy,
+            in_run.eq(access),
+            If(continuing,
+                If(~self.we & (reads != 2), reads.eq(reads + 1)),
+                If(self.we, wrote.eq(1))
+            ).Elif(access,
+                offset.eq(self.address[:4]),
+                reads.eq(Mux(self.we, 0, 1)),
+                wrote.eq(self.we)
+            )
+        )
+        return start, done, cancelled, offset
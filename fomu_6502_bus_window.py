@@ -0,0 +1,154 @@
+from migen import *
+
+# Word address of the control register; bit 0 holds the CPU in reset.
+CONTROL = 0x4000
+CPU_RESET = 0x01
+# Word address of the reset vector override: while VECTOR_ENABLE is set,
+# the CPU reads the low 16 bits as its reset vector.
+VECTOR = 0x4001
+VECTOR_ENABLE = 0x10000
+
+class Bus6502Window(Module):
+    """Gives a Wishbone master (the USB host, see fomu_usb_wishbone.py) the
+    6502's address space.
+
+    It sits between the CPU and the bus fabric, and looks like the CPU to
+    the fabric. Wishbone addresses are of 32-bit words: word n below
+    CONTROL is the bytes at 4n to 4n+3, least significant first, and sel
+    picks which of them are accessed, in address order. Each byte is an
+    ordinary bus cycle, so wait states and the flash cache stall it just
+    like the CPU.
+
+    The host only gets the bus while the CPU is held in reset, by setting
+    CPU_RESET in the control register at word CONTROL; other accesses are
+    answered with err while the CPU runs. Letting go of the reset restarts
+    the CPU from its reset vector, which can be overridden through VECTOR to
+    start a program the host has loaded.
+    """
+
+    def __init__(self, cpu):
+        # The bus, as the fabric sees it.
+        self.address = Signal(16)
+        self.data_out = Signal(8)
+        self.data_in = Signal(8)
+        self.we = Signal()
+        self.irq = Signal()
+        self.nmi = Signal()
+        self.rdy = Signal(reset=1)
+
+        # Wishbone signals.
+        self.wishbone_adr_i = Signal(30)
+        self.wishbone_dat_i = Signal(32)
+        self.wishbone_dat_o = Signal(32)
+        self.wishbone_sel_i = Signal(4)
+        self.wishbone_cyc_i = Signal()
+        self.wishbone_stb_i = Signal()
+        self.wishbone_we_i = Signal()
+        self.wishbone_ack_o = Signal()
+        self.wishbone_err_o = Signal()
+
+        self.cpu_reset = Signal()
+        self.vector = Signal(17)
+
+        # Step 0 is idle. Steps 1 to 4 present bytes 0 to 3, and each step
+        # after the first collects the byte presented before it. Step 6
+        # acknowledges.
+        step = Signal(3)
+        lane = Signal(2)
+        selected = Signal()
+        address = Signal(16)
+        data_out = Signal(8)
+        we = Signal()
+        data = Array(Signal(8) for i in range(4))
+        control_ack = Signal()
+        err = Signal()
+
+        request = Signal()
+        in_window = Signal()
+        control = Signal()
+        self.comb += [
+            request.eq(self.wishbone_cyc_i & self.wishbone_stb_i & ~self.wishbone_ack_o & ~err),
+            in_window.eq(self.wishbone_adr_i < CONTROL),
+            control.eq((self.wishbone_adr_i == CONTROL) | (self.wishbone_adr_i == VECTOR)),
+            lane.eq(step - 1),
+            selected.eq((step >= 1) & (step <= 4) & Array(self.wishbone_sel_i[i] for i in range(4))[lane]),
+            # Between accesses, and for bytes not selected, read RAM at 0,
+            # which has no side effects.
+            If(selected,
+                address.eq(Cat(lane, self.wishbone_adr_i[:14])),
+                data_out.eq(Array(self.wishbone_dat_i[i*8:i*8+8] for i in range(4))[lane]),
+                we.eq(self.wishbone_we_i)
+            ),
+            self.wishbone_dat_o.eq(Cat(data[0], data[1], data[2], data[3])),
+            self.wishbone_ack_o.eq((step == 6) | control_ack),
+            self.wishbone_err_o.eq(err),
+            ]
+
+        self.sync += [
+            control_ack.eq(0),
+            err.eq(0),
+            If(step == 0,
+                If(request,
+                    If(control,
+                        If(self.wishbone_adr_i == CONTROL,
+                            If(self.wishbone_we_i & self.wishbone_sel_i[0],
+                                self.cpu_reset.eq(self.wishbone_dat_i[0])
+                            ),
+                            data[0].eq(self.cpu_reset),
+                            data[1].eq(0),
+                            data[2].eq(0)
+                        ).Else(
+                            If(self.wishbone_we_i & (self.wishbone_sel_i == 0xF),
+                                self.vector.eq(self.wishbone_dat_i)
+                            ),
+                            data[0].eq(self.vector[0:8]),
+                            data[1].eq(self.vector[8:16]),
+                            data[2].eq(self.vector[16])
+                        ),
+                        data[3].eq(0),
+                        control_ack.eq(1)
+                    ).Elif(in_window & self.cpu_reset,
+                        step.eq(1)
+                    ).Else(
+                        err.eq(1)
+                    )
+                )
+            ).Elif(step == 6,
+                step.eq(0)
+            ).Elif(self.rdy,
+                If(step >= 2,
+                    data[step - 2].eq(self.data_in)
+                ),
+                step.eq(step + 1)
+            )
+            ]
+
+        # The reset vector is read back a cycle after the CPU addresses it.
+        vector_byte = Signal(2)
+        self.sync += If(self.rdy,
+                vector_byte.eq(Mux(self.address == 0xFFFC, 1, Mux(self.address == 0xFFFD, 2, 0)))
+            )
+
+        # The CPU has the bus unless it is held.
+        self.comb += [
+            cpu.reset.eq(self.cpu_reset),
+            If(self.cpu_reset,
+                self.address.eq(address),
+                self.data_out.eq(data_out),
+                self.we.eq(we)
+            ).Else(
+                self.address.eq(cpu.address),
+                self.data_out.eq(cpu.data_out),
+                self.we.eq(cpu.we)
+            ),
+            If(self.vector[16] & (vector_byte == 1),
+                cpu.data_in.eq(self.vector[0:8])
+            ).Elif(self.vector[16] & (vector_byte == 2),
+                cpu.data_in.eq(self.vector[8:16])
+            ).Else(
+                cpu.data_in.eq(self.data_in)
+            ),
+            cpu.rdy.eq(self.rdy),
+            cpu.irq.eq(self.irq),
+            cpu.nmi.eq(self.nmi),
+            ]
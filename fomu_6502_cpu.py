@@ -2,7 +2,14 @@ import os
 from migen import *
 from fomu_6502_bus import Bus6502
 
-CPU_VARIANTS=['standard']
+# The Verilog each variant of the core is built from. build.py synthesises
+# these on their own, once, rather than in every build. Both define a
+# module called cpu, so the rest of the flow doesn't mind which it gets.
+CPU_SOURCES = {
+    "standard": ("cpu.v", "ALU.v"),
+    "65c02": ("cpu_65c02.v", "ALU.v"),
+    }
+CPU_VARIANTS = list(CPU_SOURCES)
 
 class A6502(Bus6502, Module):
     @property
@@ -32,15 +39,22 @@ class A6502(Bus6502, Module):
     def __init__(self, platform, variant="standard"):
         super().__init__(platform)
         
+        if variant not in CPU_SOURCES:
+            raise ValueError("Unknown CPU variant \'"+variant+"\'")
         self.platform = platform
         self.variant = variant
+        self.sources = CPU_SOURCES[variant]
+        # Holds the core in reset, on top of the system reset.
+        self.reset = Signal()
         
         # Note that we are byte-wide and so always present the
-        # whole address, no byte-select lanes involved.
+        # whole address, no byte-select lanes involved. The instance
+        # name is fixed so simulation wrappers can reach inside it.
         self.specials += [
             Instance("cpu",
+                     name="cpu",
                      i_clk=ClockSignal(),
-                     i_reset=ResetSignal(),
+                     i_reset=ResetSignal() | self.reset,
                      o_AB=self.address, 
                      o_DO=self.data_out,
                      i_DI=self.data_in,
@@ -50,5 +64,5 @@ class A6502(Bus6502, Module):
                      i_RDY=self.rdy)
         ]
 
-        platform.add_source("cpu.v")
-        platform.add_source("ALU.v")
+        for source in self.sources:
+            platform.add_source(source)
@@ -0,0 +1,773 @@
+from migen import *
+from fomu_6502_cpu import A6502, CPU_VARIANTS
+
+# A migen transliteration of Arlet Ottens' cpu.v and ALU.v, for use with
+# migen's run_simulation(), and of cpu_65c02.v, which adds the 65C02's
+# instructions to cpu.v. It follows the Verilog statement for statement,
+# so that AB, DO and WE come out on exactly the same cycles and DI is read
+# one cycle late, as the Fomu bus muxes expect. Registers that the Verilog
+# never resets are reset_less here too, and 'x' (don't care) values become
+# the default for that mux.
+
+SEL_A, SEL_S, SEL_X, SEL_Y = range(4)
+
+OP_OR = 0b1100
+OP_AND = 0b1101
+OP_EOR = 0b1110
+OP_ADD = 0b0011
+OP_SUB = 0b0111
+OP_ROL = 0b1011
+OP_A = 0b1111
+
+(ABS0, ABS1, ABSX0, ABSX1, ABSX2, BRA0, BRA1, BRA2, BRK0, BRK1, BRK2, BRK3,
+ DECODE, FETCH, INDX0, INDX1, INDX2, INDX3, INDY0, INDY1, INDY2, INDY3,
+ JMP0, JMP1, JMPI0, JMPI1, JSR0, JSR1, JSR2, JSR3, PULL0, PULL1, PULL2,
+ PUSH0, PUSH1, READ, REG, RTI0, RTI1, RTI2, RTI3, RTI4, RTS0, RTS1, RTS2,
+ RTS3, WRITE, ZP0, ZPX0, ZPX1) = range(50)
+# Only the 65C02 uses these.
+BBR0, WAIT, STOP = range(50, 53)
+
+# DECODE state transitions, in casex priority order.
+_DECODE_STATES = [
+    ("0000_0000", BRK0),
+    ("0010_0000", JSR0),
+    ("0010_1100", ABS0),    # BIT abs
+    ("0100_0000", RTI0),
+    ("0100_1100", JMP0),
+    ("0110_0000", RTS0),
+    ("0110_1100", JMPI0),
+    ("0x00_1000", PUSH0),
+    ("0x10_1000", PULL0),
+    ("0xx1_1000", REG),     # CLC, SEC, CLI, SEI
+    ("1xx0_00x0", FETCH),   # IMM
+    ("1xx0_1100", ABS0),    # X/Y abs
+    ("1xxx_1000", REG),     # DEY, TYA, ...
+    ("xxx0_0001", INDX0),
+    ("xxx0_01xx", ZP0),
+    ("xxx0_1001", FETCH),   # IMM
+    ("xxx0_1101", ABS0),    # even E column
+    ("xxx0_1110", ABS0),    # even E column
+    ("xxx1_0000", BRA0),    # odd 0 column
+    ("xxx1_0001", INDY0),   # odd 1 column
+    ("xxx1_01xx", ZPX0),    # odd 4,5,6,7 columns
+    ("xxx1_1001", ABSX0),   # odd 9 column
+    ("xxx1_11xx", ABSX0),   # odd C, D, E, F columns
+    ("xxxx_1010", REG),     # <shift> A, TXA, ...  NOP
+    ]
+
+# The 65C02's additions. cpu_65c02.v puts these ahead of the NMOS entries,
+# here and in each decoder below, so they win where the two overlap.
+_CMOS_DECODE_STATES = [
+    ("1000_0000", BRA0),    # BRA
+    ("000x_1100", ABS0),    # TSB/TRB abs
+    ("0001_0100", ZP0),     # TRB zp
+    ("1001_1100", ABS0),    # STZ abs
+    ("x101_1010", PUSH0),   # PHX, PHY
+    ("x111_1010", PULL0),   # PLX, PLY
+    ("xxx1_0010", INDY0),   # (zp)
+    ("xxxx_0111", ZP0),     # RMB, SMB
+    ("xxxx_1111", ZP0),     # BBR, BBS
+    ("1100_1011", WAIT),    # WAI
+    ("1101_1011", STOP),    # STP
+    ]
+
+_CMOS_DECODE = {
+    "load_reg": [
+        (("xxx1_1010",      # INC A, DEC A, PHX, PHY, PLX, PLY
+          "0xx1_0010",      # ORA, AND, EOR, ADC (zp)
+          "1x11_0010"),     # LDA, SBC (zp)
+         1)],
+    "dst_reg": [
+        (("1011_0010",), SEL_A),    # LDA (zp)
+        (("1111_1010",), SEL_X),    # PLX
+        (("0111_1010",), SEL_Y),    # PLY
+        (("x101_1010",), SEL_S),    # PHX, PHY
+        ],
+    "src_reg": [
+        (("1101_1010",), SEL_X),    # PHX
+        (("0101_1010",), SEL_Y),    # PHY
+        ],
+    "index_y": [(("1001_1110",), 0)],           # STZ abs, X
+    "store": [
+        (("1000_1001",), 0),                    # BIT imm
+        (("011x_0100", "1001_0010"), 1),        # STZ zp/zpx, STA (zp)
+        ],
+    "write_back": [(("000x_x100", "xxxx_0111"), 1)],    # TSB, TRB, RMB, SMB
+    "inc": [(("0001_1010",), 1)],               # INC A
+    "shift": [(("0xx1_1010",), 0)],             # INC A, DEC A, PHY, PLY
+    "compare": [(("1101_0010",), 1)],           # CMP (zp)
+    "shift_right": [(("01x1_x010",), 0)],       # EOR, ADC (zp), PHY, PLY
+    "rotate": [(("0x11_1010",), 0)],            # DEC A, PLY
+    "op": [
+        (("0001_1010", "0111_0010"), OP_ADD),   # INC A, ADC (zp)
+        (("0011_1010", "11x1_0010"), OP_SUB),   # DEC A, CMP/SBC (zp)
+        (("0001_0010", "0000_x100", "1xxx_0111"), OP_OR),       # ORA (zp), TSB, SMB
+        (("0011_0010", "0001_x100", "0xxx_0111",
+          "0011_x100", "1000_1001"), OP_AND),   # AND (zp), TRB, RMB, BIT
+        (("0101_0010",), OP_EOR),               # EOR (zp)
+        ],
+    "bit_ins": [(("0011_x100", "1000_1001"), 1)],       # BIT zpx/absx/imm
+    }
+
+def _cmos_decode(ir):
+    """Values for the flags that only cpu_65c02.v has."""
+    return {
+        "stz": _casex(ir, "011x_0100", "1001_11x0"),
+        "bra": ir == 0x80,
+        "tsb": _casex(ir, "0000_x100"),
+        "trb": _casex(ir, "0001_x100"),
+        "smb": _casex(ir, "1xxx_0111"),
+        "rmb": _casex(ir, "0xxx_0111"),
+        "bbs": _casex(ir, "1xxx_1111"),
+        "bbr": _casex(ir, "0xxx_1111"),
+        "ind_zp": _casex(ir, "xxx1_0010"),
+        "bit_imm": ir == 0x89,
+        "jmp_indx": ir == 0x7c,
+        "bit_mask": 1 << ((ir >> 4) & 7),
+        }
+
+def _casex(value, *patterns):
+    """True if value matches any of the casex-style bit patterns, which are
+    written MSB first with 'x' for don't care and '_' as a separator."""
+    matches = []
+    for pattern in patterns:
+        bits = pattern.replace("_", "")
+        mask = int("".join("0" if b == "x" else "1" for b in bits), 2)
+        match = int(bits.replace("x", "0"), 2)
+        matches.append((value & mask) == match)
+    result = matches[0]
+    for m in matches[1:]:
+        result = result | m
+    return result
+
+# The casex decoder tables are evaluated here for all 256 opcodes and
+# looked up by IR, rather than matched bit by bit. The result is the same,
+# but migen's simulator re-evaluates every comparison on every pass, and
+# this is the difference between a usable simulation and an unusable one.
+
+def _next_state(ir, cmos):
+    """State that DECODE moves to for opcode ir. Opcodes that match nothing
+    leave the state alone, as in the Verilog."""
+    for pattern, target in (_CMOS_DECODE_STATES if cmos else []) + _DECODE_STATES:
+        if _casex(ir, pattern):
+            return target
+    return DECODE
+
+def _first(ir, choices, default):
+    for patterns, value in choices:
+        if _casex(ir, *patterns):
+            return value
+    return default
+
+def _decode(ir, cmos):
+    """Values the instruction decoder registers latch in DECODE."""
+    values = {
+        "load_reg": _casex(ir,
+            "0xx01010",     # ASLA, ROLA, LSRA, RORA
+            "0xxxxx01",     # ORA, AND, EOR, ADC
+            "100x10x0",     # DEY, TYA, TXA, TXS
+            "1010xxx0",     # LDA/LDX/LDY
+            "10111010",     # TSX
+            "1011x1x0",     # LDX/LDY
+            "11001010",     # DEX
+            "1x1xxx01",     # LDA, SBC
+            "xxx01000"),    # DEY, TAY, INY, INX
+        "dst_reg": _first(ir, [
+            (("1110_1000", "1100_1010", "101x_xx10"), SEL_X),
+            (("0x00_1000", "1001_1010"), SEL_S),
+            (("1x00_1000", "101x_x100", "1010_x000"), SEL_Y),
+            ], SEL_A),
+        "src_reg": _first(ir, [
+            (("1011_1010",), SEL_S),
+            (("100x_x110", "100x_1x10", "1110_xx00", "1100_1010"), SEL_X),
+            (("100x_x100", "1001_1000", "1100_xx00", "1x00_1000"), SEL_Y),
+            ], SEL_A),
+        "index_y": _casex(ir, "xxx1_0001", "10x1_x110", "xxxx_1001"),
+        "store": _casex(ir, "100x_x1x0", "100x_xx01"),
+        "write_back": _casex(ir, "0xxx_x110", "11xx_x110"),
+        "load_only": _casex(ir, "101x_xxxx"),
+        "inc": _casex(ir, "111x_x110", "11x0_1000"),
+        "shift": _casex(ir, "0xxx_x110", "0xxx_1010"),
+        "compare": _casex(ir, "11x0_0x00", "11x0_1100", "110x_xx01"),
+        "shift_right": _casex(ir, "01xx_xx10"),
+        "rotate": _casex(ir, "0x1x_1010", "0x1x_x110"),
+        "op": _first(ir, [
+            (("00xx_xx10",), OP_ROL),
+            (("0010_x100",), OP_AND),
+            (("01xx_xx10",), OP_A),
+            (("1000_1000", "1100_1010", "110x_x110", "11xx_xx01",
+              "11x0_0x00", "11x0_1100"), OP_SUB),
+            (("010x_xx01", "00xx_xx01"), 0b1100 | ((ir >> 5) & 0b11)),
+            ], OP_ADD),
+        "bit_ins": _casex(ir, "0010_x100"),
+        "php": ir == 0x08,
+        "clc": ir == 0x18,
+        "plp": ir == 0x28,
+        "sec": ir == 0x38,
+        "cli": ir == 0x58,
+        "sei": ir == 0x78,
+        "clv": ir == 0xb8,
+        "cld": ir == 0xd8,
+        "sed": ir == 0xf8,
+        "brk": ir == 0x00,
+        }
+    flags = _cmos_decode(ir)
+    if cmos:
+        for name, choices in _CMOS_DECODE.items():
+            values[name] = _first(ir, choices, values[name])
+    for name in flags:
+        values[name] = flags[name] if cmos else 0
+    return values
+
+_DECODE_FIELDS = [
+    ("load_reg", 1), ("dst_reg", 2), ("src_reg", 2), ("index_y", 1),
+    ("store", 1), ("write_back", 1), ("load_only", 1), ("inc", 1),
+    ("shift", 1), ("compare", 1), ("shift_right", 1), ("rotate", 1),
+    ("op", 4), ("bit_ins", 1), ("php", 1), ("clc", 1), ("plp", 1),
+    ("sec", 1), ("cli", 1), ("sei", 1), ("clv", 1), ("cld", 1),
+    ("sed", 1), ("brk", 1), ("stz", 1), ("bra", 1), ("tsb", 1), ("trb", 1),
+    ("smb", 1), ("rmb", 1), ("bbs", 1), ("bbr", 1), ("ind_zp", 1), ("bit_imm", 1),
+    ("jmp_indx", 1), ("bit_mask", 8),
+    ]
+_DECODE_WIDTH = sum(width for name, width in _DECODE_FIELDS)
+
+def _pack(values):
+    word = 0
+    offset = 0
+    for name, width in _DECODE_FIELDS:
+        word |= int(values[name]) << offset
+        offset += width
+    return word
+
+def _state_case(state, target, choices, default):
+    """Drive target from a case on state. choices is a list of
+    (states, value) pairs, like the case items in the Verilog."""
+    cases = {"default": target.eq(default)}
+    for states, value in choices:
+        for s in states:
+            cases[s] = target.eq(value)
+    return Case(state, cases)
+
+class _ALU(Module):
+    """ALU.v"""
+    def __init__(self):
+        self.op = Signal(4)
+        self.right = Signal()
+        self.AI = Signal(8)
+        self.BI = Signal(8)
+        self.CI = Signal()
+        self.BCD = Signal()
+        self.RDY = Signal()
+        self.OUT = Signal(8, reset_less=True)
+        self.CO = Signal(reset_less=True)
+        self.V = Signal()
+        self.Z = Signal()
+        self.N = Signal(reset_less=True)
+        self.HC = Signal(reset_less=True)
+
+        AI7 = Signal(reset_less=True)
+        BI7 = Signal(reset_less=True)
+        temp_logic = Signal(9)
+        temp_BI = Signal(8)
+        temp_l = Signal(5)
+        temp_h = Signal(5)
+        adder_CI = Signal()
+        HC9 = Signal()
+        CO9 = Signal()
+        temp_HC = Signal()
+
+        self.comb += [
+            adder_CI.eq(Mux(self.right | (self.op[2:4] == 0b11), 0, self.CI)),
+            If(self.right,
+                temp_logic.eq(Cat(self.AI[1:8], self.CI, self.AI[0]))
+            ).Else(
+                Case(self.op[0:2], {
+                    0b00: temp_logic.eq(self.AI | self.BI),
+                    0b01: temp_logic.eq(self.AI & self.BI),
+                    0b10: temp_logic.eq(self.AI ^ self.BI),
+                    0b11: temp_logic.eq(self.AI),
+                    })
+            ),
+            Case(self.op[2:4], {
+                0b00: temp_BI.eq(self.BI),
+                0b01: temp_BI.eq(~self.BI),
+                0b10: temp_BI.eq(temp_logic),
+                0b11: temp_BI.eq(0),
+                }),
+            HC9.eq(self.BCD & (temp_l[1:4] >= 5)),
+            CO9.eq(self.BCD & (temp_h[1:4] >= 5)),
+            temp_HC.eq(temp_l[4] | HC9),
+            temp_l.eq(temp_logic[0:4] + temp_BI[0:4] + adder_CI),
+            temp_h.eq(temp_logic[4:9] + temp_BI[4:8] + temp_HC),
+            self.V.eq(AI7 ^ BI7 ^ self.CO ^ self.N),
+            self.Z.eq(self.OUT == 0),
+            ]
+
+        self.sync += If(self.RDY,
+            AI7.eq(self.AI[7]),
+            BI7.eq(temp_BI[7]),
+            self.OUT.eq(Cat(temp_l[0:4], temp_h[0:4])),
+            self.CO.eq(temp_h[4] | CO9),
+            self.N.eq(temp_h[3]),
+            self.HC.eq(temp_HC),
+            )
+
+class A6502Sim(A6502):
+    """Drop-in replacement for A6502 that migen's simulator can execute.
+
+    The CPU state is exposed for testbenches: pc, state, a, x, y, s and
+    p, plus insn_pc, the address of the opcode being decoded whenever
+    state is DECODE.
+    """
+
+    def __init__(self, platform, variant="standard"):
+        # Skip A6502.__init__, which instantiates cpu.v.
+        super(A6502, self).__init__(platform)
+
+        if variant not in CPU_VARIANTS:
+            raise ValueError("Unknown CPU variant \'"+variant+"\'")
+        self.platform = platform
+        self.variant = variant
+        cmos = variant == "65c02"
+
+        DI = self.data_in
+        RDY = self.rdy
+        IRQ = self.irq
+        NMI = self.nmi
+
+        AB = self.address
+        DO = self.data_out
+        WE = self.we
+
+        PC = Signal(16, reset_less=True)
+        ABL = Signal(8, reset_less=True)
+        ABH = Signal(8, reset_less=True)
+        DIHOLD = Signal(8, reset_less=True)
+        DIMUX = Signal(8)
+        IRHOLD = Signal(8, reset_less=True)
+        IRHOLD_valid = Signal()
+        AXYS = Array(Signal(8, reset_less=True, name=n) for n in ("A", "S", "X", "Y"))
+        C = Signal(reset_less=True)
+        Z = Signal(reset_less=True)
+        I = Signal(reset_less=True)
+        D = Signal(reset_less=True)
+        V = Signal(reset_less=True)
+        N = Signal(reset_less=True)
+        IR = Signal(8)
+        PCH = PC[8:16]
+        PCL = PC[0:8]
+        NMI_edge = Signal(reset_less=True)
+        NMI_1 = Signal(reset_less=True)
+        regsel = Signal(2)
+        regfile = Signal(8)
+        P = Signal(8)
+        state = Signal(6, reset=BRK0)
+        PC_inc = Signal()
+        PC_temp = Signal(16)
+
+        src_reg = Signal(2, reset_less=True)
+        dst_reg = Signal(2, reset_less=True)
+        index_y = Signal(reset_less=True)
+        load_reg = Signal(reset_less=True)
+        inc = Signal(reset_less=True)
+        write_back = Signal(reset_less=True)
+        load_only = Signal(reset_less=True)
+        store = Signal(reset_less=True)
+        adc_sbc = Signal(reset_less=True)
+        compare = Signal(reset_less=True)
+        shift = Signal(reset_less=True)
+        rotate = Signal(reset_less=True)
+        backwards = Signal(reset_less=True)
+        cond_true = Signal()
+        cond_code = Signal(3, reset_less=True)
+        shift_right = Signal(reset_less=True)
+        alu_shift_right = Signal()
+        op = Signal(4, reset_less=True)
+        alu_op = Signal(4)
+        adc_bcd = Signal(reset_less=True)
+        adj_bcd = Signal(reset_less=True)
+        bit_ins = Signal(reset_less=True)
+        plp = Signal(reset_less=True)
+        php = Signal(reset_less=True)
+        clc = Signal(reset_less=True)
+        sec = Signal(reset_less=True)
+        cld = Signal(reset_less=True)
+        sed = Signal(reset_less=True)
+        cli = Signal(reset_less=True)
+        sei = Signal(reset_less=True)
+        clv = Signal(reset_less=True)
+        brk = Signal(reset_less=True)
+        stz = Signal(reset_less=True)
+        bra = Signal(reset_less=True)
+        tsb = Signal(reset_less=True)
+        trb = Signal(reset_less=True)
+        smb = Signal(reset_less=True)
+        rmb = Signal(reset_less=True)
+        bbs = Signal(reset_less=True)
+        bbr = Signal(reset_less=True)
+        ind_zp = Signal(reset_less=True)
+        bit_imm = Signal(reset_less=True)
+        jmp_indx = Signal(reset_less=True)
+        bit_mask = Signal(8, reset_less=True)
+        bit_rmw = Signal()
+        branch_bit = Signal(reset_less=True)
+        take_branch = Signal()
+        res = Signal(reset=1)
+        write_register = Signal()
+        ADJL = Signal(4)
+        ADJH = Signal(4)
+        AI = Signal(8)
+        BI = Signal(8)
+        CI = Signal()
+
+        alu = self.submodules.alu = _ALU()
+        ADD = alu.OUT
+        CO = alu.CO
+        AZ = alu.Z
+        AV = alu.V
+        AN = alu.N
+        HC = alu.HC
+
+        # Exposed for testbenches.
+        self.pc = PC
+        self.state = state
+        self.a = AXYS[SEL_A]
+        self.x = AXYS[SEL_X]
+        self.y = AXYS[SEL_Y]
+        self.s = AXYS[SEL_S]
+        self.p = P
+        self.insn_pc = Signal(16)
+        self.comb += self.insn_pc.eq(PC - 1)
+
+        interrupt = (~I & IRQ) | NMI_edge
+
+        self.comb += [
+            regfile.eq(AXYS[regsel]),
+            P.eq(Cat(C, Z, I, D, 1, 1, V, N)),
+            DIMUX.eq(Mux(RDY, DI, DIHOLD)),
+            IR.eq(Mux(interrupt, 0, Mux(IRHOLD_valid, IRHOLD, DIMUX))),
+
+            # Program counter increment/load.
+            _state_case(state, PC_temp, [
+                ((DECODE,), Mux(interrupt, Cat(ABL, ABH), PC)),
+                ((JMP1, JMPI1, JSR3, RTS3, RTI4), Cat(ADD, DIMUX)),
+                ((ABSX2,), Mux(jmp_indx, Cat(ABL, ADD), PC)),
+                ((BRA1,), Cat(ADD, ABH)),
+                ((BRA2,), Cat(PCL, ADD)),
+                ((BRK2,), Mux(res, 0xfffc, Mux(NMI_edge, 0xfffa, 0xfffe))),
+                ], PC),
+            _state_case(state, PC_inc, [
+                ((DECODE,), ~interrupt),
+                ((ABS0, ABSX0, FETCH, BRA0, BRA2, BRK3, JMPI1, JMP1, RTI4, RTS3, BBR0), 1),
+                ((ABSX2,), jmp_indx),
+                ((BRA1,), ~(CO ^ backwards)),
+                ], 0),
+
+            # Address generator.
+            _state_case(state, AB, [
+                ((ABSX1, INDX3, INDY2, JMP1, JMPI1, RTI4, ABS1), Cat(ADD, DIMUX)),
+                ((BRA2, INDY3, ABSX2), Cat(ABL, ADD)),
+                ((BRA1,), Cat(ADD, ABH)),
+                ((JSR0, PUSH1, RTS0, RTI0, BRK0), Cat(regfile, Constant(0x01, 8))),
+                ((BRK1, JSR1, PULL1, RTS1, RTS2, RTI1, RTI2, RTI3, BRK2), Cat(ADD, Constant(0x01, 8))),
+                ((INDY1, INDX1, ZPX1, INDX2), Cat(ADD, Constant(0x00, 8))),
+                ((ZP0, INDY0), Cat(DIMUX, Constant(0x00, 8))),
+                ((REG, READ, WRITE, WAIT, STOP), Cat(ABL, ABH)),
+                ], PC),
+
+            # Data out mux.
+            _state_case(state, DO, [
+                ((WRITE,), ADD),
+                ((JSR0, BRK0), PCH),
+                ((JSR1, BRK1), PCL),
+                ((PUSH1,), Mux(php, P, ADD)),
+                ((BRK2,), Mux(IRQ | NMI_edge, P & 0b1110_1111, P)),
+                ], Mux(stz, 0, regfile)),
+
+            # Write enable.
+            _state_case(state, WE, [
+                ((BRK0, BRK1, BRK2, JSR0, JSR1, PUSH1, WRITE), 1),
+                ((INDX3, INDY3, ABSX2, ABS1, ZPX1, ZP0), store),
+                ], 0),
+
+            _state_case(state, write_register, [
+                ((DECODE,), load_reg & ~plp),
+                ((PULL1, RTS2, RTI3, BRK3, JSR0, JSR2), 1),
+                ], 0),
+
+            # BCD adjust terms for the low and high nibbles.
+            ADJL.eq(Mux(adj_bcd & (adc_bcd == HC), Mux(adc_bcd, 6, 10), 0)),
+            ADJH.eq(Mux(adj_bcd & (adc_bcd == CO), Mux(adc_bcd, 6, 10), 0)),
+
+            # Register select.
+            _state_case(state, regsel, [
+                ((INDY1, INDX0, ZPX0, ABSX0), Mux(index_y, SEL_Y, SEL_X)),
+                ((DECODE,), dst_reg),
+                ((BRK0, BRK3, JSR0, JSR2, PULL0, PULL1, PUSH1, RTI0, RTI3, RTS0, RTS2), SEL_S),
+                ], src_reg),
+
+            # ALU operation.
+            _state_case(state, alu_op, [
+                ((READ, FETCH, REG), op),
+                ((BRA1,), Mux(backwards, OP_SUB, OP_ADD)),
+                ((PUSH1, BRK0, BRK1, BRK2, JSR0, JSR1), OP_SUB),
+                ], OP_ADD),
+            _state_case(state, alu_shift_right, [
+                ((FETCH, REG, READ), shift_right),
+                ], 0),
+
+            # ALU A input.
+            _state_case(state, AI, [
+                ((JSR1, RTS1, RTI1, RTI2, BRK1, BRK2, INDX1), ADD),
+                ((REG, ZPX0, INDX0, ABSX0, RTI0, RTS0, JSR0, JSR2, BRK0, PULL0,
+                  PUSH0, PUSH1), regfile),
+                ((INDY1,), Mux(ind_zp, 0, regfile)),
+                ((BRA0, READ), DIMUX),
+                ((BRA1,), ABH),
+                ((FETCH,), Mux(load_only, 0, regfile)),
+                ], 0),
+
+            # ALU B input.
+            _state_case(state, BI, [
+                ((BRA1, RTS1, RTI0, RTI1, RTI2, INDX1, REG, JSR0, JSR1, JSR2,
+                  BRK0, BRK1, BRK2, PUSH0, PUSH1, PULL0, RTS0), 0),
+                ((READ,), Mux(tsb, regfile, Mux(trb, ~regfile,
+                          Mux(smb, bit_mask, Mux(rmb, ~bit_mask, 0))))),
+                ((BRA0,), PCL),
+                ], DIMUX),
+
+            # ALU carry in.
+            _state_case(state, CI, [
+                ((INDY2, BRA1, ABSX1), CO),
+                ((READ, REG), Mux(rotate, C, Mux(shift, 0, inc))),
+                ((FETCH,), Mux(rotate, C, Mux(compare, 1, Mux(shift | load_only, 0, C)))),
+                ((PULL0, RTI0, RTI1, RTI2, RTS0, RTS1, INDY0, INDX1), 1),
+                ], 0),
+
+            Case(cond_code, {
+                0b000: cond_true.eq(~N),
+                0b001: cond_true.eq(N),
+                0b010: cond_true.eq(~V),
+                0b011: cond_true.eq(V),
+                0b100: cond_true.eq(~C),
+                0b101: cond_true.eq(C),
+                0b110: cond_true.eq(~Z),
+                0b111: cond_true.eq(Z),
+                }),
+            take_branch.eq(Mux(bbr | bbs, branch_bit ^ bbr, cond_true | bra)),
+            bit_rmw.eq(tsb | trb | smb | rmb),
+
+            alu.op.eq(alu_op),
+            alu.right.eq(alu_shift_right),
+            alu.AI.eq(AI),
+            alu.BI.eq(BI),
+            alu.CI.eq(CI),
+            alu.BCD.eq(adc_bcd & (state == FETCH)),
+            alu.RDY.eq(RDY),
+            ]
+
+        adjusted_low = Signal(4)
+        adjusted_high = Signal(4)
+        self.comb += [
+            adjusted_low.eq(ADD[0:4] + ADJL),
+            adjusted_high.eq(ADD[4:8] + ADJH),
+            ]
+
+        decoding = (state == DECODE) & RDY
+        # ADC and SBC, and just ADC; these are latched in BRK0 too.
+        adc_sbc_patterns = ["x11x_xx01"] + (["x111_0010"] if cmos else [])
+        adc_patterns = ["011x_xx01"] + (["0111_0010"] if cmos else [])
+        decoded = {
+            "load_reg": load_reg, "dst_reg": dst_reg, "src_reg": src_reg,
+            "index_y": index_y, "store": store, "write_back": write_back,
+            "load_only": load_only, "inc": inc, "shift": shift,
+            "compare": compare, "shift_right": shift_right, "rotate": rotate,
+            "op": op, "bit_ins": bit_ins, "php": php, "clc": clc, "plp": plp,
+            "sec": sec, "cli": cli, "sei": sei, "clv": clv, "cld": cld,
+            "sed": sed, "brk": brk, "stz": stz, "bra": bra, "tsb": tsb,
+            "trb": trb, "smb": smb, "rmb": rmb, "bbs": bbs, "bbr": bbr,
+            "ind_zp": ind_zp, "bit_imm": bit_imm, "jmp_indx": jmp_indx,
+            "bit_mask": bit_mask,
+            }
+        decode_table = Array(Constant(_pack(_decode(ir, cmos)), _DECODE_WIDTH) for ir in range(256))
+        next_state_table = Array(Constant(_next_state(ir, cmos), 6) for ir in range(256))
+
+
+        # Next state, from DECODE or from the addressing mode sequences.
+        transitions = {
+            DECODE: state.eq(next_state_table[IR]),
+            ZP0: state.eq(Mux(write_back, READ, Mux(bbr | bbs, BBR0, FETCH))),
+            ZPX0: state.eq(ZPX1),
+            ZPX1: state.eq(Mux(write_back, READ, FETCH)),
+            ABS0: state.eq(ABS1),
+            ABS1: state.eq(Mux(write_back, READ, FETCH)),
+            ABSX0: state.eq(ABSX1),
+            ABSX1: state.eq(Mux(CO | store | write_back | jmp_indx, ABSX2, FETCH)),
+            ABSX2: state.eq(Mux(jmp_indx, JMP0, Mux(write_back, READ, FETCH))),
+            INDX0: state.eq(INDX1),
+            INDX1: state.eq(INDX2),
+            INDX2: state.eq(INDX3),
+            INDX3: state.eq(FETCH),
+            INDY0: state.eq(INDY1),
+            INDY1: state.eq(INDY2),
+            INDY2: state.eq(Mux(CO | store, INDY3, FETCH)),
+            INDY3: state.eq(FETCH),
+            READ: state.eq(WRITE),
+            WRITE: state.eq(FETCH),
+            FETCH: state.eq(DECODE),
+            REG: state.eq(DECODE),
+            PUSH0: state.eq(PUSH1),
+            PUSH1: state.eq(DECODE),
+            PULL0: state.eq(PULL1),
+            PULL1: state.eq(PULL2),
+            PULL2: state.eq(DECODE),
+            JSR0: state.eq(JSR1),
+            JSR1: state.eq(JSR2),
+            JSR2: state.eq(JSR3),
+            JSR3: state.eq(FETCH),
+            RTI0: state.eq(RTI1),
+            RTI1: state.eq(RTI2),
+            RTI2: state.eq(RTI3),
+            RTI3: state.eq(RTI4),
+            RTI4: state.eq(DECODE),
+            RTS0: state.eq(RTS1),
+            RTS1: state.eq(RTS2),
+            RTS2: state.eq(RTS3),
+            RTS3: state.eq(FETCH),
+            BRA0: state.eq(Mux(take_branch, BRA1, DECODE)),
+            BRA1: state.eq(Mux(CO ^ backwards, BRA2, DECODE)),
+            BRA2: state.eq(DECODE),
+            JMP0: state.eq(JMP1),
+            JMP1: state.eq(DECODE),
+            JMPI0: state.eq(JMPI1),
+            JMPI1: state.eq(JMP0),
+            BRK0: state.eq(BRK1),
+            BRK1: state.eq(BRK2),
+            BRK2: state.eq(BRK3),
+            BRK3: state.eq(JMP0),
+            BBR0: state.eq(BRA0),
+            WAIT: state.eq(Mux(IRQ | NMI_edge, DECODE, WAIT)),
+            STOP: state.eq(STOP),
+            }
+
+        self.sync += [
+            If(RDY,
+                PC.eq(PC_temp + PC_inc),
+                DIHOLD.eq(DI),
+                backwards.eq(DIMUX[7]),
+                If(state == BBR0, branch_bit.eq((DIMUX & bit_mask) != 0)),
+                cond_code.eq(IR[5:8]),
+                Case(state, transitions),
+            ),
+            If((state != PUSH0) & (state != PUSH1) & RDY &
+               (state != PULL0) & (state != PULL1) & (state != PULL2),
+                ABL.eq(AB[0:8]),
+                ABH.eq(AB[8:16]),
+            ),
+            adj_bcd.eq(adc_sbc & D),
+            If(write_register & RDY,
+                AXYS[regsel].eq(Mux(state == JSR0, DIMUX, Cat(adjusted_low, adjusted_high)))
+            ),
+
+            # Processor status register.
+            If(shift & (state == WRITE),
+                C.eq(CO)
+            ).Elif(state == RTI2,
+                C.eq(DIMUX[0])
+            ).Elif(~write_back & (state == DECODE),
+                If(adc_sbc | shift | compare,
+                    C.eq(CO)
+                ).Elif(plp,
+                    C.eq(ADD[0])
+                ).Else(
+                    If(sec, C.eq(1)),
+                    If(clc, C.eq(0)),
+                )
+            ),
+            If((state == READ) & (tsb | trb),
+                Z.eq((DIMUX & regfile) == 0)
+            ).Elif((state == WRITE) & ~bit_rmw,
+                Z.eq(AZ)
+            ).Elif(state == RTI2,
+                Z.eq(DIMUX[1])
+            ).Elif(state == DECODE,
+                If(plp,
+                    Z.eq(ADD[1])
+                ).Elif((load_reg & (regsel != SEL_S)) | compare | bit_ins,
+                    Z.eq(AZ)
+                )
+            ),
+            If((state == WRITE) & ~bit_rmw,
+                N.eq(AN)
+            ).Elif(state == RTI2,
+                N.eq(DIMUX[7])
+            ).Elif(state == DECODE,
+                If(plp,
+                    N.eq(ADD[7])
+                ).Elif((load_reg & (regsel != SEL_S)) | compare,
+                    N.eq(AN)
+                )
+            ).Elif((state == FETCH) & bit_ins & ~bit_imm,
+                N.eq(DIMUX[7])
+            ),
+            If(state == BRK3,
+                I.eq(1)
+            ).Elif(state == RTI2,
+                I.eq(DIMUX[2])
+            ).Elif(state == REG,
+                If(sei, I.eq(1)),
+                If(cli, I.eq(0)),
+            ).Elif(state == DECODE,
+                If(plp, I.eq(ADD[2]))
+            ),
+            If(state == RTI2,
+                D.eq(DIMUX[3])
+            ).Elif(state == DECODE,
+                If(sed, D.eq(1)),
+                If(cld, D.eq(0)),
+                If(plp, D.eq(ADD[3])),
+            ).Elif((state == BRK3) & cmos,
+                D.eq(0)
+            ),
+            If(state == RTI2,
+                V.eq(DIMUX[6])
+            ).Elif(state == DECODE,
+                If(adc_sbc, V.eq(AV)),
+                If(clv, V.eq(0)),
+                If(plp, V.eq(ADD[6])),
+            ).Elif((state == FETCH) & bit_ins & ~bit_imm,
+                V.eq(DIMUX[6])
+            ),
+
+            # IR hold for the states that prefetch the next opcode.
+            If(RDY,
+                If((state == PULL0) | (state == PUSH0),
+                    IRHOLD.eq(DIMUX),
+                    IRHOLD_valid.eq(1)
+                ).Elif(state == DECODE,
+                    IRHOLD_valid.eq(0)
+                )
+            ),
+
+            If(state == DECODE, res.eq(0)),
+
+            # Instruction decoder.
+            If(decoding,
+                Cat(*[decoded[name] for name, width in _DECODE_FIELDS]).eq(decode_table[IR]),
+            ),
+            If(((state == DECODE) | (state == BRK0)) & RDY,
+                adc_sbc.eq(_casex(IR, *adc_sbc_patterns)),
+                adc_bcd.eq(_casex(IR, *adc_patterns) & D),
+            ),
+
+            NMI_1.eq(NMI),
+            If(NMI_edge & (state == BRK3),
+                NMI_edge.eq(0)
+            ).Elif(NMI & ~NMI_1,
+                NMI_edge.eq(1)
+            ),
+            ]
+
+        # Like A6502's reset input: resets the core on top of the system
+        # reset. The reset_less registers are the ones cpu.v never resets.
+        ResetInserter()(self)
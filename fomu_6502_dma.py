@@ -0,0 +1,276 @@
+from migen import *
+from fomu_6502_bus import Bus6502
+from fomu_6502_fabric import address_prefixes, balanced_or
+
+# Register offsets. SOURCE, DEST and LENGTH are 16 bits, little endian.
+SOURCE = 0
+DEST = 2
+LENGTH = 4
+MODE = 6
+CONTROL = 7
+FILL_VALUE = 8
+
+# MODE bits, and the operation in bits 4-5.
+SOURCE_INCREMENT = 0x01
+DEST_INCREMENT = 0x02
+IRQ_ENABLE = 0x04
+COPY = 0x00
+FILL = 0x10
+COMPARE = 0x20
+MOVE = 0x30
+
+# CONTROL bits: START when written, BUSY, DONE and MISMATCH when read.
+START = 0x01
+BUSY = 0x01
+DONE = 0x02
+MISMATCH = 0x04
+
+class DMAPort(Module):
+    """The bus as the fabric sees it: the master's, except while the DMA
+    controller has it, when the master is held with RDY. The controller
+    can also make 16-bit accesses (wide) to devices that take them."""
+
+    def __init__(self, master):
+        self.address = Signal(16)
+        self.data_out = Signal(8)
+        self.data_in = Signal(8)
+        self.we = Signal()
+        self.irq = Signal()
+        self.nmi = Signal()
+        self.rdy = Signal(reset=1)
+        self.wide = Signal()
+        self.data_out_high = Signal(8)
+        self.data_in_high = Signal(8)
+
+        # Driven by the DMA controller.
+        self.active = Signal()
+        self.dma_address = Signal(16)
+        self.dma_data_out = Signal(8)
+        self.dma_we = Signal()
+        self.dma_wide = Signal()
+
+        self.comb += [
+            If(self.active,
+                self.address.eq(self.dma_address),
+                self.data_out.eq(self.dma_data_out),
+                self.we.eq(self.dma_we),
+                self.wide.eq(self.dma_wide)
+            ).Else(
+                self.address.eq(master.address),
+                self.data_out.eq(master.data_out),
+                self.we.eq(master.we)
+            ),
+            master.data_in.eq(self.data_in),
+            master.rdy.eq(self.rdy & ~self.active),
+            master.irq.eq(self.irq),
+            master.nmi.eq(self.nmi),
+            ]
+
+class FomuDMA(Bus6502, Module):
+    """Block copies, fills and compares on the 6502 bus.
+
+    Set SOURCE, DEST and LENGTH, pick the operation in MODE, and write
+    START to CONTROL. The controller then takes the bus from the CPU, which
+    waits with RDY low until it is done. LENGTH 0 does nothing.
+
+      COPY     copies LENGTH bytes from SOURCE to DEST. SOURCE_INCREMENT and
+               DEST_INCREMENT in MODE pick whether each address counts up
+               after every byte (for memory) or stays put (for a register
+               such as the Wishbone bridge's STREAM or the serial port's
+               DATA).
+      FILL     writes FILL_VALUE to LENGTH bytes from DEST.
+      COMPARE  compares LENGTH bytes at SOURCE and DEST, stopping at the
+               first difference with MISMATCH set in CONTROL and SOURCE,
+               DEST and LENGTH left at the bytes that differ.
+      MOVE     copies memory to memory, working down from the top when the
+               blocks overlap with DEST above SOURCE, so either way round
+               the destination ends up as the source was.
+
+    A copy takes three cycles a byte: the read, a cycle in which the data
+    comes back (RAM at 0 is read, which has no side effects) and the write.
+    A compare takes three a byte and a fill one, or two when DEST is fixed.
+    Within wide_regions (the SPRAM, which is 16 bits wide) two bytes move at
+    once while the addresses are aligned, halving all of those. Like the
+    CPU, the controller only moves on when RDY is high, so wait states and
+    stalls work as they do for it.
+
+    Reading CONTROL gives BUSY, DONE and MISMATCH. DONE is set when an
+    operation finishes and cleared by writing it back or starting another;
+    while it and IRQ_ENABLE in MODE are set, IRQ is raised. SOURCE, DEST and
+    LENGTH read back where it got to. Other offsets read as 0.
+
+    master is what drives the bus otherwise (the CPU, or Bus6502Window);
+    the fabric connects to port instead.
+    """
+
+    def __init__(self, platform, master, wide_regions=[]):
+        super().__init__(platform)
+        self.submodules.port = port = DMAPort(master)
+
+        source = Signal(16)
+        dest = Signal(16)
+        length = Signal(16)
+        mode = Signal(8)
+        fill_value = Signal(8)
+        done = Signal()
+        mismatch = Signal()
+        data = Signal(16)
+        op = Signal(8)
+        self.comb += op.eq(mode & 0x30)
+
+        # Steps: the read (of SOURCE), the cycle its data comes back in, the
+        # write (to DEST) and, for compares, the read of DEST.
+        READ, COLLECT, WRITE, READ_DEST = range(4)
+        step = Signal(2)
+
+        # Moves between overlapping blocks run backwards; then each wide
+        # access is of the byte below the address as well. Moves are always
+        # of memory.
+        backward = Signal()
+        source_step = Signal()
+        dest_step = Signal()
+        self.comb += [
+            source_step.eq(mode[0] | (op == MOVE)),
+            dest_step.eq(mode[1] | (op == MOVE)),
+            ]
+
+        # Whether the next access can be wide. It is decided at the read and
+        # held for the rest of the byte pair; fills decide at every write.
+        def in_wide_region(address):
+            return balanced_or(address[16-bits:] == value
+                for r in wide_regions for value, bits in address_prefixes(r.start, r.size))
+        source_ok = Signal()
+        dest_ok = Signal()
+        can_wide = Signal()
+        wide = Signal()
+        wide_now = Signal()
+        wide_access = Signal()
+        count = Signal(2)
+        self.comb += [
+            source_ok.eq(source_step & (source[0] == backward) & in_wide_region(source)),
+            dest_ok.eq(dest_step & (dest[0] == backward) & in_wide_region(dest)),
+            If(op == FILL,
+                can_wide.eq(dest_ok & (length >= 2))
+            ).Else(
+                can_wide.eq(source_ok & dest_ok & (length >= 2))
+            ),
+            wide_now.eq(Mux((step == READ) | (op == FILL), can_wide, wide)),
+            wide_access.eq(wide_now & (step != COLLECT)),
+            count.eq(Mux(wide_now, 2, 1)),
+            ]
+
+        access = self.access()[0]
+        address = Signal(16)
+        self.comb += [
+            Case(step, {
+                READ: address.eq(source),
+                COLLECT: address.eq(0),
+                WRITE: address.eq(dest),
+                READ_DEST: address.eq(dest)
+                }),
+            port.dma_address.eq(Mux(wide_access & backward, address - 1, address)),
+            port.dma_we.eq(step == WRITE),
+            port.dma_wide.eq(wide_access),
+            If(op == FILL,
+                port.dma_data_out.eq(fill_value),
+                port.data_out_high.eq(fill_value)
+            ).Else(
+                port.dma_data_out.eq(data[:8]),
+                port.data_out_high.eq(data[8:])
+            ),
+            self.irq.eq(done & mode[2]),
+            ]
+
+        def advance(n):
+            return [
+                If(source_step, source.eq(Mux(backward, source - n, source + n))),
+                If(dest_step, dest.eq(Mux(backward, dest - n, dest + n))),
+                length.eq(length - n),
+                If(length == n,
+                    port.active.eq(0),
+                    done.eq(1)
+                )
+            ]
+        stop = [port.active.eq(0), done.eq(1), mismatch.eq(1)]
+
+        self.sync += [
+            If(port.active & port.rdy,
+                Case(step, {
+                    READ: [
+                        wide.eq(can_wide),
+                        step.eq(Mux(op == COMPARE, READ_DEST, COLLECT))
+                    ],
+                    # For compares the source data comes back while DEST is
+                    # read, and DEST's here.
+                    READ_DEST: [data.eq(Cat(port.data_in, port.data_in_high)), step.eq(COLLECT)],
+                    COLLECT: If(op == COMPARE,
+                        step.eq(READ),
+                        If(data[:8] != port.data_in,
+                            stop
+                        ).Elif(wide & (data[8:] != port.data_in_high),
+                            stop,
+                            source.eq(source + 1),
+                            dest.eq(dest + 1),
+                            length.eq(length - 1)
+                        ).Else(
+                            advance(Mux(wide, 2, 1))
+                        )
+                    ).Else(
+                        data.eq(Cat(port.data_in, port.data_in_high)),
+                        step.eq(WRITE)
+                    ),
+                    WRITE: [
+                        advance(count),
+                        # Fills write back to back, except to a register,
+                        # which must see each write separately.
+                        If(op == FILL,
+                            step.eq(Mux(mode[1], WRITE, COLLECT))
+                        ).Else(
+                            step.eq(READ)
+                        )
+                    ]
+                })
+            ),
+            If(access & self.we,
+                Case(self.address, {
+                    0: source[0:8].eq(self.data_in),
+                    1: source[8:16].eq(self.data_in),
+                    2: dest[0:8].eq(self.data_in),
+                    3: dest[8:16].eq(self.data_in),
+                    4: length[0:8].eq(self.data_in),
+                    5: length[8:16].eq(self.data_in),
+                    MODE: mode.eq(self.data_in),
+                    CONTROL: [
+                        If(self.data_in[1], done.eq(0)),
+                        If(self.data_in[0],
+                            done.eq(0),
+                            mismatch.eq(0),
+                            step.eq(Mux(op == FILL, WRITE, READ)),
+                            port.active.eq(length != 0),
+                            backward.eq(0),
+                            If((op == MOVE) & (dest > source),
+                                backward.eq(1),
+                                source.eq(source + length - 1),
+                                dest.eq(dest + length - 1)
+                            )
+                        )
+                    ],
+                    FILL_VALUE: fill_value.eq(self.data_in),
+                    "default": []
+                })
+            ),
+            If(access,
+                Case(self.address, {
+                    0: self.data_out.eq(source[0:8]),
+                    1: self.data_out.eq(source[8:16]),
+                    2: self.data_out.eq(dest[0:8]),
+                    3: self.data_out.eq(dest[8:16]),
+                    4: self.data_out.eq(length[0:8]),
+                    5: self.data_out.eq(length[8:16]),
+                    MODE: self.data_out.eq(mode),
+                    CONTROL: self.data_out.eq(Cat(port.active, done, mismatch)),
+                    FILL_VALUE: self.data_out.eq(fill_value),
+                    "default": self.data_out.eq(0)
+                })
+            )
+            ]
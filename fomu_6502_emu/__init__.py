@@ -0,0 +1,9 @@
+"""Fast instruction-level emulator of the Fomu 6502 SoC.
+
+Fomu.memory_map is the source of truth for the address space; each entry
+with a model in fomu_6502_emu.devices gets the same window it has in the
+gateware.
+"""
+from fomu_6502_emu.cpu import CPU6502, CPU65C02, IllegalInstruction
+from fomu_6502_emu.devices import RAM, ROM, PagedRAM, PagingRegister, LEDController, WishboneBridge, WishboneMemory, WishboneError, USBSerial
+from fomu_6502_emu.machine import FomuMachine, CPU_CLASSES, default_devices
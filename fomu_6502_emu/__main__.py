@@ -0,0 +1,57 @@
+import argparse
+import time
+
+from fomu_6502_emu import FomuMachine, CPU_CLASSES
+
+parser = argparse.ArgumentParser(description="Run 6502 firmware on the Fomu emulator")
+parser.add_argument(
+    "--load", nargs=2, metavar=("ADDRESS", "FILE"), action="append", default=[],
+    help="Load a raw binary at ADDRESS (hex) before reset")
+parser.add_argument(
+    "--rom", metavar="FILE",
+    help="ROM image, as for build.py --rom-image")
+parser.add_argument(
+    "--rom-region", default="high_os_rom",
+    help="Memory map entry the ROM replaces (default high_os_rom)")
+parser.add_argument(
+    "--flash", metavar="FILE",
+    help="Contents of the SPI flash behind low_os_rom")
+parser.add_argument(
+    "--cpu-variant", choices=sorted(CPU_CLASSES), default="standard",
+    help="CPU core to emulate, as for build.py --cpu-variant (default standard)")
+parser.add_argument(
+    "--instructions", type=int, default=1000000,
+    help="Maximum number of instructions to execute")
+parser.add_argument(
+    "--until", type=lambda s: int(s, 16), default=None,
+    help="Stop when the PC reaches this address (hex)")
+args = parser.parse_args()
+
+rom_image = None
+if args.rom:
+    from fomu_soc import Fomu
+    from fomu_6502_rom import load_rom_image
+    rom_image = load_rom_image(args.rom, Fomu.memory_map[args.rom_region].start)
+
+flash_image = None
+if args.flash:
+    with open(args.flash, "rb") as f:
+        flash_image = f.read()
+
+machine = FomuMachine(rom_image=rom_image, flash_image=flash_image, rom_region=args.rom_region,
+                      cpu_variant=args.cpu_variant)
+for address, filename in args.load:
+    with open(filename, "rb") as f:
+        machine.load(int(address, 16), f.read())
+machine.reset()
+
+start = time.perf_counter()
+executed = machine.run(args.instructions, args.until)
+elapsed = time.perf_counter() - start
+
+print(machine.cpu)
+print("Executed", executed, "instructions,", machine.cpu.cycles, "cycles in %.3fs" % elapsed,
+      "(%.2f MIPS)" % (executed / elapsed / 1e6 if elapsed else 0))
+rgb = machine.devices.get("rgb")
+if rgb is not None:
+    print("LED PWM (R, G, B):", rgb.rgb)
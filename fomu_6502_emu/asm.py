@@ -0,0 +1,76 @@
+"""A small 6502 assembler, for test and benchmark programs built in Python.
+
+    code = assemble(0x0200, [
+        ("LDX", "#", 0),
+        "loop",
+        ("STA", "abs,x", 0x0300),
+        ("INX", ""),
+        ("BNE", "rel", "loop"),
+        ])
+
+A program is a list of instructions, (mnemonic, mode, operand), and label
+strings, which name the address of the instruction after them. Modes are
+written as they are in source: "" (implied or accumulator), "#", "zp",
+"zp,x", "zp,y", "abs", "abs,x", "abs,y", "(abs)", "(zp,x)", "(zp),y" and
+"rel", and for the 65C02 "(zp)", "(abs,x)" and "zp,rel" (BBRn/BBSn, whose
+operands are the zero page address and the branch target). Operands of
+abs, rel and zp,rel instructions may be labels.
+
+The opcodes come from the emulator's tables, so anything the emulator runs
+can be assembled; pass cmos=True for the 65C02's.
+"""
+from fomu_6502_emu.cpu import OPCODES, OPCODES_65C02
+
+_WRITTEN = {
+    "imp": "", "acc": "", "imm": "#", "zp": "zp", "zpx": "zp,x", "zpy": "zp,y",
+    "abs": "abs", "absx": "abs,x", "absy": "abs,y", "ind": "(abs)", "indx": "(zp,x)",
+    "indy": "(zp),y", "rel": "rel", "izp": "(zp)", "iax": "(abs,x)", "zprel": "zp,rel",
+    }
+SIZES = {
+    "": 1, "#": 2, "zp": 2, "zp,x": 2, "zp,y": 2, "abs": 3, "abs,x": 3, "abs,y": 3,
+    "(abs)": 3, "(zp,x)": 2, "(zp),y": 2, "rel": 2, "(zp)": 2, "(abs,x)": 3, "zp,rel": 3,
+    }
+
+def _by_mnemonic(opcodes):
+    return {(mnemonic, _WRITTEN[mode]): opcode for opcode, (mnemonic, mode, cycles) in opcodes.items()}
+
+NMOS_OPCODES = _by_mnemonic(OPCODES)
+CMOS_OPCODES = _by_mnemonic(OPCODES_65C02)
+
+def assemble(origin, program, cmos=False):
+    """Assemble program to run at origin. Returns the bytes."""
+    opcodes = CMOS_OPCODES if cmos else NMOS_OPCODES
+    labels = {}
+    address = origin
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = address
+        else:
+            address += SIZES[item[1]]
+    code = bytearray()
+
+    def branch(target):
+        offset = labels.get(target, target) - (origin + len(code) + 1)
+        if not -128 <= offset < 128:
+            raise ValueError("Branch to "+str(target)+" out of range")
+        code.append(offset & 0xFF)
+
+    for item in program:
+        if isinstance(item, str):
+            continue
+        mnemonic, mode = item[0], item[1]
+        if (mnemonic, mode) not in opcodes:
+            raise ValueError("No "+mnemonic+" "+(mode or "(implied)")+
+                             (" on the 65C02" if cmos else " on the NMOS 6502"))
+        code.append(opcodes[(mnemonic, mode)])
+        if mode == "rel":
+            branch(item[2])
+        elif mode == "zp,rel":
+            code.append(item[2])
+            branch(item[3])
+        elif SIZES[mode] == 3:
+            operand = labels.get(item[2], item[2])
+            code += bytes([operand & 0xFF, operand >> 8])
+        elif SIZES[mode] == 2:
+            code.append(item[2])
+    return bytes(code)
@@ -0,0 +1,585 @@
+"""Instruction-level NMOS 6502 and 65C02 cores.
+
+Each opcode is compiled once, at import time, into its own small Python
+function that has the addressing mode and the operation inlined. Each CPU
+binds those to its own memory to build a 256-entry dispatch table, so
+executing an instruction is one list index and one call.
+
+Memory is a flat 64K bytearray shared with the machine. Pages that hold
+devices with side effects get a handler in read_handlers/write_handlers;
+everything else (RAM, ROM contents, unmapped zeros) is read straight out of
+the bytearray. Zero page, the stack and instruction/operand fetches always
+use the bytearray directly, so code must run from RAM or ROM.
+
+Cycle counts are the nominal NMOS or 65C02 figures, including
+page-crossing and taken-branch penalties. Arlet's core differs by a cycle
+here and there, so treat them as an estimate rather than a cycle-exact
+count.
+"""
+
+import sys
+
+class IllegalInstruction(Exception):
+    """Raised when the CPU fetches an opcode its instruction set doesn't
+    define."""
+    def __init__(self, opcode, pc):
+        super().__init__("Illegal opcode 0x%02X at 0x%04X" % (opcode, pc))
+        self.opcode = opcode
+        self.pc = pc
+
+# Processor status bits.
+FLAG_C = 0x01
+FLAG_Z = 0x02
+FLAG_I = 0x04
+FLAG_D = 0x08
+FLAG_B = 0x10
+FLAG_U = 0x20
+FLAG_V = 0x40
+FLAG_N = 0x80
+
+# Vectors.
+NMI_VECTOR = 0xFFFA
+RESET_VECTOR = 0xFFFC
+IRQ_VECTOR = 0xFFFE
+
+# Opcode table: opcode -> (mnemonic, addressing mode, base cycles).
+OPCODES = {
+    0x69: ("ADC", "imm", 2), 0x65: ("ADC", "zp", 3), 0x75: ("ADC", "zpx", 4),
+    0x6D: ("ADC", "abs", 4), 0x7D: ("ADC", "absx", 4), 0x79: ("ADC", "absy", 4),
+    0x61: ("ADC", "indx", 6), 0x71: ("ADC", "indy", 5),
+    0x29: ("AND", "imm", 2), 0x25: ("AND", "zp", 3), 0x35: ("AND", "zpx", 4),
+    0x2D: ("AND", "abs", 4), 0x3D: ("AND", "absx", 4), 0x39: ("AND", "absy", 4),
+    0x21: ("AND", "indx", 6), 0x31: ("AND", "indy", 5),
+    0x0A: ("ASL", "acc", 2), 0x06: ("ASL", "zp", 5), 0x16: ("ASL", "zpx", 6),
+    0x0E: ("ASL", "abs", 6), 0x1E: ("ASL", "absx", 7),
+    0x90: ("BCC", "rel", 2), 0xB0: ("BCS", "rel", 2), 0xF0: ("BEQ", "rel", 2),
+    0x30: ("BMI", "rel", 2), 0xD0: ("BNE", "rel", 2), 0x10: ("BPL", "rel", 2),
+    0x50: ("BVC", "rel", 2), 0x70: ("BVS", "rel", 2),
+    0x24: ("BIT", "zp", 3), 0x2C: ("BIT", "abs", 4),
+    0x00: ("BRK", "imp", 7),
+    0x18: ("CLC", "imp", 2), 0xD8: ("CLD", "imp", 2), 0x58: ("CLI", "imp", 2),
+    0xB8: ("CLV", "imp", 2),
+    0xC9: ("CMP", "imm", 2), 0xC5: ("CMP", "zp", 3), 0xD5: ("CMP", "zpx", 4),
+    0xCD: ("CMP", "abs", 4), 0xDD: ("CMP", "absx", 4), 0xD9: ("CMP", "absy", 4),
+    0xC1: ("CMP", "indx", 6), 0xD1: ("CMP", "indy", 5),
+    0xE0: ("CPX", "imm", 2), 0xE4: ("CPX", "zp", 3), 0xEC: ("CPX", "abs", 4),
+    0xC0: ("CPY", "imm", 2), 0xC4: ("CPY", "zp", 3), 0xCC: ("CPY", "abs", 4),
+    0xC6: ("DEC", "zp", 5), 0xD6: ("DEC", "zpx", 6), 0xCE: ("DEC", "abs", 6),
+    0xDE: ("DEC", "absx", 7),
+    0xCA: ("DEX", "imp", 2), 0x88: ("DEY", "imp", 2),
+    0x49: ("EOR", "imm", 2), 0x45: ("EOR", "zp", 3), 0x55: ("EOR", "zpx", 4),
+    0x4D: ("EOR", "abs", 4), 0x5D: ("EOR", "absx", 4), 0x59: ("EOR", "absy", 4),
+    0x41: ("EOR", "indx", 6), 0x51: ("EOR", "indy", 5),
+    0xE6: ("INC", "zp", 5), 0xF6: ("INC", "zpx", 6), 0xEE: ("INC", "abs", 6),
+    0xFE: ("INC", "absx", 7),
+    0xE8: ("INX", "imp", 2), 0xC8: ("INY", "imp", 2),
+    0x4C: ("JMP", "abs", 3), 0x6C: ("JMP", "ind", 5),
+    0x20: ("JSR", "abs", 6),
+    0xA9: ("LDA", "imm", 2), 0xA5: ("LDA", "zp", 3), 0xB5: ("LDA", "zpx", 4),
+    0xAD: ("LDA", "abs", 4), 0xBD: ("LDA", "absx", 4), 0xB9: ("LDA", "absy", 4),
+    0xA1: ("LDA", "indx", 6), 0xB1: ("LDA", "indy", 5),
+    0xA2: ("LDX", "imm", 2), 0xA6: ("LDX", "zp", 3), 0xB6: ("LDX", "zpy", 4),
+    0xAE: ("LDX", "abs", 4), 0xBE: ("LDX", "absy", 4),
+    0xA0: ("LDY", "imm", 2), 0xA4: ("LDY", "zp", 3), 0xB4: ("LDY", "zpx", 4),
+    0xAC: ("LDY", "abs", 4), 0xBC: ("LDY", "absx", 4),
+    0x4A: ("LSR", "acc", 2), 0x46: ("LSR", "zp", 5), 0x56: ("LSR", "zpx", 6),
+    0x4E: ("LSR", "abs", 6), 0x5E: ("LSR", "absx", 7),
+    0xEA: ("NOP", "imp", 2),
+    0x09: ("ORA", "imm", 2), 0x05: ("ORA", "zp", 3), 0x15: ("ORA", "zpx", 4),
+    0x0D: ("ORA", "abs", 4), 0x1D: ("ORA", "absx", 4), 0x19: ("ORA", "absy", 4),
+    0x01: ("ORA", "indx", 6), 0x11: ("ORA", "indy", 5),
+    0x48: ("PHA", "imp", 3), 0x08: ("PHP", "imp", 3),
+    0x68: ("PLA", "imp", 4), 0x28: ("PLP", "imp", 4),
+    0x2A: ("ROL", "acc", 2), 0x26: ("ROL", "zp", 5), 0x36: ("ROL", "zpx", 6),
+    0x2E: ("ROL", "abs", 6), 0x3E: ("ROL", "absx", 7),
+    0x6A: ("ROR", "acc", 2), 0x66: ("ROR", "zp", 5), 0x76: ("ROR", "zpx", 6),
+    0x6E: ("ROR", "abs", 6), 0x7E: ("ROR", "absx", 7),
+    0x40: ("RTI", "imp", 6), 0x60: ("RTS", "imp", 6),
+    0xE9: ("SBC", "imm", 2), 0xE5: ("SBC", "zp", 3), 0xF5: ("SBC", "zpx", 4),
+    0xED: ("SBC", "abs", 4), 0xFD: ("SBC", "absx", 4), 0xF9: ("SBC", "absy", 4),
+    0xE1: ("SBC", "indx", 6), 0xF1: ("SBC", "indy", 5),
+    0x38: ("SEC", "imp", 2), 0xF8: ("SED", "imp", 2), 0x78: ("SEI", "imp", 2),
+    0x85: ("STA", "zp", 3), 0x95: ("STA", "zpx", 4), 0x8D: ("STA", "abs", 4),
+    0x9D: ("STA", "absx", 5), 0x99: ("STA", "absy", 5), 0x81: ("STA", "indx", 6),
+    0x91: ("STA", "indy", 6),
+    0x86: ("STX", "zp", 3), 0x96: ("STX", "zpy", 4), 0x8E: ("STX", "abs", 4),
+    0x84: ("STY", "zp", 3), 0x94: ("STY", "zpx", 4), 0x8C: ("STY", "abs", 4),
+    0xAA: ("TAX", "imp", 2), 0xA8: ("TAY", "imp", 2), 0xBA: ("TSX", "imp", 2),
+    0x8A: ("TXA", "imp", 2), 0x9A: ("TXS", "imp", 2), 0x98: ("TYA", "imp", 2),
+    }
+
+# The 65C02's: the NMOS set plus these, including the Rockwell bit
+# instructions. izp is (zp), iax is (abs,X), and zprel is a zero page
+# address followed by a branch offset.
+OPCODES_65C02 = dict(OPCODES)
+OPCODES_65C02.update({
+    0x12: ("ORA", "izp", 5), 0x32: ("AND", "izp", 5), 0x52: ("EOR", "izp", 5),
+    0x72: ("ADC", "izp", 5), 0x92: ("STA", "izp", 5), 0xB2: ("LDA", "izp", 5),
+    0xD2: ("CMP", "izp", 5), 0xF2: ("SBC", "izp", 5),
+    0x89: ("BIT", "imm", 2), 0x34: ("BIT", "zpx", 4), 0x3C: ("BIT", "absx", 4),
+    0x1A: ("INC", "acc", 2), 0x3A: ("DEC", "acc", 2),
+    0x6C: ("JMP", "ind", 6), 0x7C: ("JMP", "iax", 6),
+    0x80: ("BRA", "rel", 2),
+    0xDA: ("PHX", "imp", 3), 0x5A: ("PHY", "imp", 3),
+    0xFA: ("PLX", "imp", 4), 0x7A: ("PLY", "imp", 4),
+    0x64: ("STZ", "zp", 3), 0x74: ("STZ", "zpx", 4), 0x9C: ("STZ", "abs", 4),
+    0x9E: ("STZ", "absx", 5),
+    0x04: ("TSB", "zp", 5), 0x0C: ("TSB", "abs", 6),
+    0x14: ("TRB", "zp", 5), 0x1C: ("TRB", "abs", 6),
+    0xCB: ("WAI", "imp", 3), 0xDB: ("STP", "imp", 3),
+    })
+for bit in range(8):
+    OPCODES_65C02[0x07 + (bit << 4)] = ("RMB" + str(bit), "zp", 5)
+    OPCODES_65C02[0x87 + (bit << 4)] = ("SMB" + str(bit), "zp", 5)
+    OPCODES_65C02[0x0F + (bit << 4)] = ("BBR" + str(bit), "zprel", 5)
+    OPCODES_65C02[0x8F + (bit << 4)] = ("BBS" + str(bit), "zprel", 5)
+
+# Operand fetch for each addressing mode. On entry 'pc' points at the byte
+# after the opcode; on exit 'ea' holds the effective address and 'pc' has
+# been moved past the operand. '{penalty}' is replaced with a page-crossing
+# cycle adjustment for the read instructions that pay one.
+_MODES = {
+    "imp":  "",
+    "acc":  "",
+    "imm":  "ea = pc\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "zp":   "ea = mem[pc]\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "zpx":  "ea = (mem[pc] + c.x) & 0xFF\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "zpy":  "ea = (mem[pc] + c.y) & 0xFF\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "abs":  "ea = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)\n"
+            "pc = (pc + 2) & 0xFFFF\n",
+    "absx": "base = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)\n"
+            "ea = (base + c.x) & 0xFFFF\n"
+            "pc = (pc + 2) & 0xFFFF\n"
+            "{penalty}",
+    "absy": "base = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)\n"
+            "ea = (base + c.y) & 0xFFFF\n"
+            "pc = (pc + 2) & 0xFFFF\n"
+            "{penalty}",
+    "ind":  "ptr = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)\n"
+            # The NMOS part doesn't carry into the high byte of the pointer.
+            "ea = mem[ptr] | (mem[(ptr & 0xFF00) | ((ptr + 1) & 0xFF)] << 8)\n"
+            "pc = (pc + 2) & 0xFFFF\n",
+    "indx": "zp = (mem[pc] + c.x) & 0xFF\n"
+            "ea = mem[zp] | (mem[(zp + 1) & 0xFF] << 8)\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "indy": "zp = mem[pc]\n"
+            "base = mem[zp] | (mem[(zp + 1) & 0xFF] << 8)\n"
+            "ea = (base + c.y) & 0xFFFF\n"
+            "pc = (pc + 1) & 0xFFFF\n"
+            "{penalty}",
+    "rel":  "",
+    "izp":  "zp = mem[pc]\n"
+            "ea = mem[zp] | (mem[(zp + 1) & 0xFF] << 8)\n"
+            "pc = (pc + 1) & 0xFFFF\n",
+    "iax":  "ptr = ((mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)) + c.x) & 0xFFFF\n"
+            "ea = mem[ptr] | (mem[(ptr + 1) & 0xFFFF] << 8)\n"
+            "pc = (pc + 2) & 0xFFFF\n",
+    "zprel": "ea = mem[pc]\n"
+             "pc = (pc + 1) & 0xFFFF\n",
+    }
+
+# The 65C02 fixed the page wrap.
+_CMOS_MODES = dict(_MODES)
+_CMOS_MODES["ind"] = ("ptr = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)\n"
+                      "ea = mem[ptr] | (mem[(ptr + 1) & 0xFFFF] << 8)\n"
+                      "pc = (pc + 2) & 0xFFFF\n")
+
+_PAGE_PENALTY = "if (base ^ ea) & 0xFF00:\n    cycles += 1\n"
+
+# Zero page modes never touch I/O, so they read and write the bytearray
+# directly. Everything else goes through the per-page handlers.
+_DIRECT_MODES = ("zp", "zpx", "zpy", "zprel")
+
+def _read(mode):
+    if mode == "imm" or mode in _DIRECT_MODES:
+        return "v = mem[ea]\n"
+    return "h = rh[ea >> 8]\n" \
+           "v = mem[ea] if h is None else h(ea)\n"
+
+def _write(mode, value):
+    if mode in _DIRECT_MODES:
+        return "mem[ea] = %s\n" % value
+    return "h = wh[ea >> 8]\n" \
+           "if h is None:\n" \
+           "    mem[ea] = %s\n" \
+           "else:\n" \
+           "    h(ea, %s)\n" % (value, value)
+
+_SET_NZ = "c.n = c.z = {0}\n"
+
+_ADC = (
+    "a = c.a\n"
+    "if c.d:\n"
+    "    lo = (a & 0x0F) + (v & 0x0F) + c.c\n"
+    "    hi = (a & 0xF0) + (v & 0xF0)\n"
+    "    c.z = (a + v + c.c) & 0xFF\n"
+    "    if lo > 0x09:\n"
+    "        hi += 0x10\n"
+    "        lo += 0x06\n"
+    "    c.n = hi & 0xFF\n"
+    "    c.v = (~(a ^ v) & (a ^ hi)) & 0x80\n"
+    "    if hi > 0x90:\n"
+    "        hi += 0x60\n"
+    "    c.c = 1 if hi > 0xFF else 0\n"
+    "    c.a = (lo & 0x0F) | (hi & 0xF0)\n"
+    "else:\n"
+    "    r = a + v + c.c\n"
+    "    c.c = r >> 8\n"
+    "    r &= 0xFF\n"
+    "    c.v = (~(a ^ v) & (a ^ r)) & 0x80\n"
+    "    c.a = c.n = c.z = r\n"
+    )
+
+_SBC = (
+    "a = c.a\n"
+    "r = a - v - (1 - c.c)\n"
+    "c.v = ((a ^ v) & (a ^ r)) & 0x80\n"
+    "c.n = c.z = r & 0xFF\n"
+    "if c.d:\n"
+    "    lo = (a & 0x0F) - (v & 0x0F) - (1 - c.c)\n"
+    "    hi = (a >> 4) - (v >> 4)\n"
+    "    if lo & 0x10:\n"
+    "        lo -= 6\n"
+    "        hi -= 1\n"
+    "    if hi & 0x10:\n"
+    "        hi -= 6\n"
+    "    c.a = ((hi << 4) | (lo & 0x0F)) & 0xFF\n"
+    "else:\n"
+    "    c.a = r & 0xFF\n"
+    "c.c = 0 if r < 0 else 1\n"
+    )
+
+def _compare(reg):
+    return ("r = %s - v\n" % reg +
+            "c.c = 0 if r < 0 else 1\n"
+            "c.n = c.z = r & 0xFF\n")
+
+# Read-modify-write operations: 'v' in, 'r' out.
+_RMW = {
+    "ASL": "c.c = v >> 7\n"
+           "r = (v << 1) & 0xFF\n",
+    "LSR": "c.c = v & 1\n"
+           "r = v >> 1\n",
+    "ROL": "r = ((v << 1) | c.c) & 0xFF\n"
+           "c.c = v >> 7\n",
+    "ROR": "r = (v >> 1) | (c.c << 7)\n"
+           "c.c = v & 1\n",
+    "INC": "r = (v + 1) & 0xFF\n",
+    "DEC": "r = (v - 1) & 0xFF\n",
+    }
+
+_BRANCHES = {
+    "BCC": "not c.c", "BCS": "c.c",
+    "BNE": "c.z", "BEQ": "not c.z",
+    "BPL": "not (c.n & 0x80)", "BMI": "c.n & 0x80",
+    "BVC": "not c.v", "BVS": "c.v",
+    "BRA": "True",
+    }
+
+_BRANCH = ("    off = mem[pc]\n"
+           "    base = (pc + 1) & 0xFFFF\n"
+           "    pc = (base + off - (off & 0x80) * 2) & 0xFFFF\n"
+           "    cycles += 2 if (base ^ pc) & 0xFF00 else 1\n"
+           "else:\n"
+           "    pc = (pc + 1) & 0xFFFF\n")
+
+_PUSH = "mem[0x100 | c.s] = {0}\n" \
+        "c.s = (c.s - 1) & 0xFF\n"
+_PULL = "c.s = (c.s + 1) & 0xFF\n" \
+        "{0} = mem[0x100 | c.s]\n"
+
+_IMPLIED = {
+    "CLC": "c.c = 0\n", "SEC": "c.c = 1\n",
+    "CLD": "c.d = 0\n", "SED": "c.d = 1\n",
+    "CLI": "c.i = 0\n", "SEI": "c.i = 1\n",
+    "CLV": "c.v = 0\n",
+    "NOP": "",
+    "DEX": "c.x = c.n = c.z = (c.x - 1) & 0xFF\n",
+    "DEY": "c.y = c.n = c.z = (c.y - 1) & 0xFF\n",
+    "INX": "c.x = c.n = c.z = (c.x + 1) & 0xFF\n",
+    "INY": "c.y = c.n = c.z = (c.y + 1) & 0xFF\n",
+    "TAX": "c.x = c.n = c.z = c.a\n",
+    "TAY": "c.y = c.n = c.z = c.a\n",
+    "TSX": "c.x = c.n = c.z = c.s\n",
+    "TXA": "c.a = c.n = c.z = c.x\n",
+    "TYA": "c.a = c.n = c.z = c.y\n",
+    "TXS": "c.s = c.x\n",
+    "PHA": _PUSH.format("c.a"),
+    "PHX": _PUSH.format("c.x"),
+    "PHY": _PUSH.format("c.y"),
+    "PHP": _PUSH.format("c.get_p() | 0x30"),
+    "PLA": _PULL.format("c.a") + "c.n = c.z = c.a\n",
+    "PLX": _PULL.format("c.x") + "c.n = c.z = c.x\n",
+    "PLY": _PULL.format("c.y") + "c.n = c.z = c.y\n",
+    "PLP": _PULL.format("p") + "c.set_p(p)\n",
+    "RTS": _PULL.format("lo") + _PULL.format("hi") +
+           "pc = (((hi << 8) | lo) + 1) & 0xFFFF\n",
+    "RTI": _PULL.format("p") + "c.set_p(p)\n" +
+           _PULL.format("lo") + _PULL.format("hi") +
+           "pc = (hi << 8) | lo\n",
+    "BRK": "pc = (pc + 1) & 0xFFFF\n" +
+           _PUSH.format("pc >> 8") + _PUSH.format("pc & 0xFF") +
+           _PUSH.format("c.get_p() | 0x30") +
+           "c.i = 1\n"
+           "pc = mem[0xFFFE] | (mem[0xFFFF] << 8)\n",
+    # WAI stops run() until an interrupt is pending; run() then carries on
+    # from the next instruction, taking the interrupt first if it can.
+    "WAI": "if not c.interrupt_pending:\n"
+           "    c.waiting = True\n"
+           "    c.stopped = True\n",
+    # STP stops run() for good: every run() after it stops again at once.
+    "STP": "pc = c.pc\n"
+           "c.stopped = True\n",
+    }
+
+def _body(mnemonic, mode, cmos):
+    """Python source for the operation part of one opcode."""
+    if mnemonic == "BRK" and cmos:
+        # The 65C02 also clears D.
+        return _IMPLIED["BRK"] + "c.d = 0\n"
+    if mnemonic in _IMPLIED:
+        return _IMPLIED[mnemonic]
+    if mnemonic in _BRANCHES:
+        return "if %s:\n" % _BRANCHES[mnemonic] + _BRANCH
+    if mnemonic[:3] in ("BBR", "BBS"):
+        test = "v & 0x%02X" % (1 << int(mnemonic[3]))
+        return (_read(mode) +
+                "if %s:\n" % (test if mnemonic[2] == "S" else "not " + test) + _BRANCH)
+    if mnemonic[:3] in ("RMB", "SMB"):
+        bit = 1 << int(mnemonic[3])
+        change = "v | 0x%02X" % bit if mnemonic[0] == "S" else "v & 0x%02X" % (0xFF ^ bit)
+        return _read(mode) + _write(mode, change)
+    if mnemonic == "TSB":
+        return _read(mode) + "c.z = c.a & v\n" + _write(mode, "v | c.a")
+    if mnemonic == "TRB":
+        return _read(mode) + "c.z = c.a & v\n" + _write(mode, "v & (c.a ^ 0xFF)")
+    if mnemonic == "STZ":
+        return _write(mode, "0")
+    if mnemonic == "JMP":
+        return "pc = ea\n"
+    if mnemonic == "JSR":
+        return ("ret = (pc - 1) & 0xFFFF\n" +
+                _PUSH.format("ret >> 8") + _PUSH.format("ret & 0xFF") +
+                "pc = ea\n")
+    if mnemonic in ("STA", "STX", "STY"):
+        return _write(mode, "c." + mnemonic[2].lower())
+    if mnemonic in _RMW:
+        if mode == "acc":
+            return "v = c.a\n" + _RMW[mnemonic] + "c.a = c.n = c.z = r\n"
+        return _read(mode) + _RMW[mnemonic] + "c.n = c.z = r\n" + _write(mode, "r")
+
+    # Everything left reads an operand.
+    src = _read(mode)
+    if mnemonic in ("LDA", "LDX", "LDY"):
+        reg = "c." + mnemonic[2].lower()
+        return src + "%s = c.n = c.z = v\n" % reg
+    if mnemonic == "AND":
+        return src + "c.a = c.n = c.z = c.a & v\n"
+    if mnemonic == "ORA":
+        return src + "c.a = c.n = c.z = c.a | v\n"
+    if mnemonic == "EOR":
+        return src + "c.a = c.n = c.z = c.a ^ v\n"
+    if mnemonic == "BIT":
+        if mode == "imm":
+            return src + "c.z = c.a & v\n"
+        return src + "c.z = c.a & v\nc.n = v\nc.v = v & 0x40\n"
+    if mnemonic == "ADC":
+        return src + _ADC
+    if mnemonic == "SBC":
+        return src + _SBC
+    if mnemonic == "CMP":
+        return src + _compare("c.a")
+    if mnemonic == "CPX":
+        return src + _compare("c.x")
+    if mnemonic == "CPY":
+        return src + _compare("c.y")
+    raise ValueError("No implementation for " + mnemonic)
+
+def _indent(text):
+    return "".join("    " + line + "\n" for line in text.splitlines())
+
+def _compile(opcode, mnemonic, mode, cycles, cmos):
+    """Compile one opcode into a factory that binds it to a machine's
+    memory and page handlers."""
+    # Stores and read-modify-write instructions always pay for the index
+    # addition, so only plain reads get a page-crossing penalty.
+    pays_penalty = mnemonic not in _RMW and mnemonic not in ("STA", "STX", "STY", "STZ")
+    modes = _CMOS_MODES if cmos else _MODES
+    mode_src = modes[mode].format(penalty=_PAGE_PENALTY if pays_penalty else "")
+    src = ("def make(mem, rh, wh):\n"
+           "    def op_%02X(c):\n" % opcode +
+           "        cycles = %d\n" % cycles +
+           "        pc = (c.pc + 1) & 0xFFFF\n" +
+           _indent(_indent(mode_src)) +
+           _indent(_indent(_body(mnemonic, mode, cmos))) +
+           "        c.pc = pc\n"
+           "        return cycles\n"
+           "    return op_%02X\n" % opcode)
+    namespace = {}
+    exec(compile(src, "<6502 op %02X %s %s>" % (opcode, mnemonic, mode), "exec"), namespace)
+    return namespace["make"]
+
+def _make_illegal(mem, rh, wh):
+    def illegal(c):
+        raise IllegalInstruction(mem[c.pc], c.pc)
+    return illegal
+
+def compile_opcodes(opcodes=OPCODES, cmos=False):
+    """Compile an opcode table into 256 opcode factories. cmos picks the
+    65C02's behaviour where it differs for the same opcode."""
+    factories = [_make_illegal] * 256
+    for opcode, (mnemonic, mode, cycles) in opcodes.items():
+        factories[opcode] = _compile(opcode, mnemonic, mode, cycles, cmos)
+    return factories
+
+NMOS_OPCODES = compile_opcodes()
+CMOS_OPCODES = compile_opcodes(OPCODES_65C02, cmos=True)
+
+class CPU6502(object):
+    """NMOS 6502 register state plus a dispatch loop.
+
+    mem is a 65536-byte bytearray. read_handlers and write_handlers are
+    256-entry lists indexed by address page; None means the page is plain
+    memory, otherwise the entry is called as h(address) or h(address, value).
+    """
+
+    def __init__(self, mem, read_handlers=None, write_handlers=None, opcodes=NMOS_OPCODES):
+        self.mem = mem
+        self.read_handlers = read_handlers or [None] * 256
+        self.write_handlers = write_handlers or [None] * 256
+        # The dispatch table: one function per opcode, each closed over
+        # this CPU's memory and handler lists.
+        self.table = [make(mem, self.read_handlers, self.write_handlers) for make in opcodes]
+
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.s = 0xFD
+        self.pc = 0
+        # Flags. Z is set when c.z is zero and N is bit 7 of c.n, so that
+        # loads and ALU ops can update both with a single assignment.
+        self.c = 0
+        self.z = 1
+        self.n = 0
+        self.v = 0
+        self.d = 0
+        self.i = 1
+
+        self.cycles = 0
+        self.instructions = 0
+        self.irq_line = False
+        self.nmi_pending = False
+        # Checked once per instruction; set whenever either line above is.
+        self.interrupt_pending = False
+        self.stopped = False
+        # Set by WAI until an interrupt is pending.
+        self.waiting = False
+
+    def get_p(self):
+        return ((self.n & 0x80) | (FLAG_V if self.v else 0) | FLAG_U |
+                (FLAG_D if self.d else 0) | (FLAG_I if self.i else 0) |
+                (0 if self.z else FLAG_Z) | (FLAG_C if self.c else 0))
+
+    def set_p(self, p):
+        self.n = p & FLAG_N
+        self.v = p & FLAG_V
+        self.d = 1 if p & FLAG_D else 0
+        self.i = 1 if p & FLAG_I else 0
+        self.z = 0 if p & FLAG_Z else 1
+        self.c = p & FLAG_C
+
+    def vector(self, address):
+        return self.mem[address] | (self.mem[address + 1] << 8)
+
+    def reset(self):
+        self.s = 0xFD
+        self.i = 1
+        self.d = 0
+        self.nmi_pending = False
+        self.interrupt_pending = self.irq_line
+        self.stopped = False
+        self.waiting = False
+        self.pc = self.vector(RESET_VECTOR)
+        self.cycles += 7
+
+    def nmi(self):
+        """Latch an NMI edge; it is taken before the next instruction."""
+        self.nmi_pending = True
+        self.interrupt_pending = True
+
+    def set_irq(self, level):
+        """Drive the (level-sensitive) IRQ line."""
+        self.irq_line = bool(level)
+        self.interrupt_pending = self.nmi_pending or self.irq_line
+
+    def _interrupt(self, vector):
+        mem = self.mem
+        for value in (self.pc >> 8, self.pc & 0xFF, self.get_p() & ~FLAG_B):
+            mem[0x100 | self.s] = value
+            self.s = (self.s - 1) & 0xFF
+        self.i = 1
+        self.pc = self.vector(vector)
+        self.cycles += 7
+
+    def step(self):
+        """Execute one instruction (or take one interrupt)."""
+        return self.run(1)
+
+    def run(self, max_instructions=None, until_pc=None):
+        """Run until max_instructions have executed, the PC reaches
+        until_pc, or something calls stop(). Returns the number of
+        instructions executed."""
+        c = self
+        mem = self.mem
+        table = self.table
+        limit = sys.maxsize if max_instructions is None else max_instructions
+        stop_at = -1 if until_pc is None else until_pc
+        executed = 0
+        cycles = 0
+        self.stopped = False
+        if self.waiting:
+            if not self.interrupt_pending:
+                return 0
+            self.waiting = False
+
+        for executed in range(1, limit + 1):
+            if c.interrupt_pending:
+                if c.nmi_pending:
+                    c.nmi_pending = False
+                    c.interrupt_pending = c.irq_line
+                    c._interrupt(NMI_VECTOR)
+                elif not c.i:
+                    c._interrupt(IRQ_VECTOR)
+                if c.pc == stop_at:
+                    executed -= 1
+                    break
+            cycles += table[mem[c.pc]](c)
+            if c.pc == stop_at or c.stopped:
+                break
+
+        self.cycles += cycles
+        self.instructions += executed
+        return executed
+
+    def stop(self):
+        """Ask run() to return after the current instruction."""
+        self.stopped = True
+
+    def __repr__(self):
+        return "PC:%04X A:%02X X:%02X Y:%02X S:%02X P:%02X" % (
+            self.pc, self.a, self.x, self.y, self.s, self.get_p())
+
+class CPU65C02(CPU6502):
+    """The 65C02, as cpu_65c02.v implements it: the CMOS_OPCODES, and
+    interrupts clear D."""
+
+    def __init__(self, mem, read_handlers=None, write_handlers=None, opcodes=CMOS_OPCODES):
+        super().__init__(mem, read_handlers, write_handlers, opcodes)
+
+    def _interrupt(self, vector):
+        super()._interrupt(vector)
+        self.d = 0
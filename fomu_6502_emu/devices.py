@@ -0,0 +1,447 @@
+"""Behavioural models of the devices on the Fomu 6502 bus.
+
+A device model has a 'kind':
+
+  "ram"  plain read/write memory, held in the machine's bytearray.
+  "rom"  read-only memory; its image is copied into the bytearray and
+         writes are dropped.
+  "io"   registers with side effects; read(offset) and write(offset, value)
+         are called for every access inside the device's window.
+
+The CPU makes no dummy accesses: a store is one write, and a
+read-modify-write instruction one read and one write. The gateware's devices
+ignore the extra reads the real CPU makes (see Bus6502.completed_reads()),
+and testbench.py's registers run checks the two agree.
+
+Offsets are relative to the start of the device's memory map entry, just as
+Bus6502.address is in the gateware. A device that can interrupt keeps its
+level in 'irq' and calls machine.update_irq() when it changes; the machine
+ORs them onto the CPU's IRQ line, as BusFabric does.
+"""
+import collections
+
+class RAM(object):
+    """FomuSPRAM: plain memory."""
+    kind = "ram"
+
+class ROM(object):
+    """FomuROM: fixed contents, writes ignored."""
+    kind = "rom"
+
+    def __init__(self, image):
+        self.image = bytes(image)
+
+class PagedRAM(object):
+    """FomuPagedSPRAM: banks of RAM, one of which is visible in the window.
+
+    The visible bank lives in the machine's bytearray like any other RAM, so
+    code can run from it; selecting a bank swaps the window contents out to
+    the bank store and the new bank in. A bank number with nothing behind
+    it shows a window of zeros. Unlike the hardware, writes to it stick
+    until the next bank switch.
+    """
+    kind = "ram"
+
+    def __init__(self, banks=6, size=0x4000):
+        self.banks = [bytearray(size) for i in range(banks)]
+        self.size = size
+        self.bank = 0
+        self.base = None
+        self.machine = None
+
+    def select(self, bank):
+        if bank == self.bank:
+            return
+        mem = self.machine.mem
+        window = slice(self.base, self.base + self.size)
+        if self.bank < len(self.banks):
+            self.banks[self.bank][:] = mem[window]
+        if bank < len(self.banks):
+            mem[window] = self.banks[bank]
+        else:
+            mem[window] = bytes(self.size)
+        self.bank = bank
+
+class PagingRegister(object):
+    """FomuPagingRegister: offset 0 selects the PagedRAM bank."""
+    kind = "io"
+
+    def __init__(self, paged):
+        self.paged = paged
+
+    def read(self, offset):
+        return self.paged.bank if offset == 0 else 0
+
+    def write(self, offset, value):
+        if offset == 0:
+            self.paged.select(value)
+
+class LEDController(object):
+    """SBLED: the SB_LEDDA_IP register file.
+
+    The LEDDA IP is write-only, and SBLED never drives data_out, so reads
+    return 0 just as they do on hardware. Register names follow the iCE40
+    LED driver usage guide.
+    """
+    kind = "io"
+
+    LEDDPWRR = 0x1
+    LEDDPWRG = 0x2
+    LEDDPWRB = 0x3
+    LEDDBCRR = 0x5
+    LEDDBCFR = 0x6
+    LEDDCR0 = 0x8
+    LEDDBR = 0x9
+    LEDDONR = 0xA
+    LEDDOFR = 0xB
+
+    def __init__(self):
+        self.registers = bytearray(16)
+        self.writes = []
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, value):
+        self.registers[offset & 0xF] = value
+        self.writes.append((offset & 0xF, value))
+
+    @property
+    def rgb(self):
+        """Current (red, green, blue) PWM duty registers."""
+        return (self.registers[self.LEDDPWRR],
+                self.registers[self.LEDDPWRG],
+                self.registers[self.LEDDPWRB])
+
+class WishboneError(Exception):
+    """Raised by a Wishbone target model to signal ERR or RTY."""
+
+class WishboneMemory(object):
+    """Sparse 32-bit Wishbone target, used when nothing else is attached."""
+
+    def __init__(self):
+        self.words = {}
+
+    def read(self, address):
+        return self.words.get(address, 0)
+
+    def write(self, address, value):
+        self.words[address] = value
+
+class WishboneBridge(object):
+    """FomuBridge: DATA (bytes 0-3) and ADDRESS (bytes 4-7), little endian,
+    then CONTROL, STREAM and STATUS at 8-10.
+
+    Reading byte 0 of DATA reads the word at ADDRESS into DATA, and writing
+    byte 3 of DATA writes it; with INCREMENT in CONTROL, ADDRESS moves on
+    after each. STREAM reads and writes the words from ADDRESS upwards a
+    byte at a time, least significant first. An ERR/RTY from the target sets
+    ERROR in STATUS and raises NMI. Bus cycles take no time here, so
+    READ_AHEAD only changes when ADDRESS moves: a prefetched word has
+    already moved it past the word being read, and POSTED writes finish
+    straight away, so BUSY is never set.
+    """
+    kind = "io"
+
+    INCREMENT = 0x01
+    READ_AHEAD = 0x02
+    POSTED = 0x04
+    ERROR = 0x01
+
+    def __init__(self, target=None):
+        self.target = target if target is not None else WishboneMemory()
+        self.data = 0
+        self.address = 0
+        self.control = 0
+        self.error = 0
+        self.stream_in = []
+        self.stream_out = []
+        self.next_word = None
+        self.stream_byte = 0
+        self.machine = None
+
+    def read(self, offset):
+        offset &= 0xF
+        if offset == 0:
+            self.data = self._bus_read()
+            if self.control & self.INCREMENT:
+                self._step()
+        if offset < 4:
+            return (self.data >> (8 * offset)) & 0xFF
+        if offset < 8:
+            return (self.address >> (8 * (offset - 4))) & 0xFF
+        if offset == 8:
+            return self.control
+        if offset == 9:
+            if not self.stream_in:
+                if self.next_word is None:
+                    self._fill()
+                word, self.next_word = self.next_word, None
+                self.stream_in = [(word >> (8 * i)) & 0xFF for i in range(4)]
+            self.stream_byte = self.stream_in.pop(0)
+            if self.control & self.READ_AHEAD and self.next_word is None:
+                self._fill()
+            return self.stream_byte
+        if offset == 10:
+            return self.error
+        return 0
+
+    def write(self, offset, value):
+        offset &= 0xF
+        if offset < 4:
+            shift = 8 * offset
+            self.data = (self.data & ~(0xFF << shift)) | (value << shift)
+            if offset == 3:
+                self._bus_write(self.data)
+                if self.control & self.INCREMENT:
+                    self._step()
+        elif offset < 8:
+            shift = 8 * (offset - 4)
+            self.address = (self.address & ~(0xFF << shift)) | (value << shift)
+        elif offset == 8:
+            self.control = value
+            self.stream_in = []
+            self.stream_out = []
+            self.next_word = None
+            if self.control & self.READ_AHEAD:
+                self._fill()
+        elif offset == 9:
+            self.stream_out.append(value)
+            if len(self.stream_out) == 4:
+                self._bus_write(sum(b << (8 * i) for i, b in enumerate(self.stream_out)))
+                self.stream_out = []
+                self._step()
+        elif offset == 10:
+            if value & self.ERROR:
+                self.error = 0
+
+    def _step(self):
+        self.address = (self.address + 1) & 0xFFFFFFFF
+
+    def _fill(self):
+        self.next_word = self._bus_read()
+        self._step()
+
+    def _bus_read(self):
+        try:
+            return self.target.read(self.address) & 0xFFFFFFFF
+        except WishboneError:
+            self._error()
+            return 0
+
+    def _bus_write(self, value):
+        try:
+            self.target.write(self.address, value)
+        except WishboneError:
+            self._error()
+
+    def _error(self):
+        self.error = self.ERROR
+        if self.machine is not None:
+            self.machine.cpu.nmi()
+
+class USBSerial(object):
+    """FomuUSBSerial: DATA, STATUS and IRQ_ENABLE at offsets 0-2.
+
+    send() queues bytes as if the host had sent them, and whatever the 6502
+    writes to DATA collects in tx. Neither direction ever fills up, so
+    TX_READY is always set.
+    """
+    kind = "io"
+
+    RX_READY = 0x01
+    TX_READY = 0x02
+
+    def __init__(self):
+        self.rx = collections.deque()
+        self.tx = bytearray()
+        self.irq_enable = 0
+        self.irq = False
+        self.machine = None
+
+    def send(self, data):
+        self.rx.extend(data)
+        self._update_irq()
+
+    def status(self):
+        return (self.RX_READY if self.rx else 0) | self.TX_READY
+
+    def read(self, offset):
+        offset &= 0xF
+        if offset == 0:
+            value = self.rx.popleft() if self.rx else 0
+            self._update_irq()
+            return value
+        if offset == 1:
+            return self.status()
+        if offset == 2:
+            return self.irq_enable
+        return 0
+
+    def write(self, offset, value):
+        offset &= 0xF
+        if offset == 0:
+            self.tx.append(value)
+        elif offset == 2:
+            self.irq_enable = value
+            self._update_irq()
+
+    def _update_irq(self):
+        self.irq = bool(self.status() & self.irq_enable)
+        if self.machine is not None:
+            self.machine.update_irq()
+
+class DMAController(object):
+    """FomuDMA: SOURCE, DEST and LENGTH (16 bits each, little endian), MODE,
+    CONTROL and FILL_VALUE at offsets 0-8.
+
+    Writing START runs the whole operation (COPY, FILL, COMPARE or MOVE, in
+    MODE bits 4-5) at once, through the machine's read and write so device
+    side effects happen, and adds the cycles the gateware takes for byte
+    accesses (three a byte, one for fills) to the CPU's cycle count; the
+    16-bit accesses the gateware makes to SPRAM are not modelled.
+    """
+    kind = "io"
+
+    SOURCE_INCREMENT = 0x01
+    DEST_INCREMENT = 0x02
+    IRQ_ENABLE = 0x04
+    COPY = 0x00
+    FILL = 0x10
+    COMPARE = 0x20
+    MOVE = 0x30
+    START = 0x01
+    DONE = 0x02
+    MISMATCH = 0x04
+
+    def __init__(self):
+        self.regs = bytearray(9)
+        self.status = 0
+        self.irq = False
+        self.machine = None
+
+    def read(self, offset):
+        offset &= 0xF
+        if offset == 7:
+            return self.status
+        if offset < 9:
+            return self.regs[offset]
+        return 0
+
+    def write(self, offset, value):
+        offset &= 0xF
+        if offset == 7:
+            if value & (self.START | self.DONE):
+                self.status &= ~self.DONE
+            if value & self.START:
+                self.status = 0
+                self._run()
+        elif offset < 9:
+            self.regs[offset] = value
+        self._update_irq()
+
+    def _run(self):
+        source = self.regs[0] | (self.regs[1] << 8)
+        dest = self.regs[2] | (self.regs[3] << 8)
+        length = self.regs[4] | (self.regs[5] << 8)
+        mode = self.regs[6]
+        op = mode & 0x30
+        if length == 0:
+            return
+        machine = self.machine
+        source_step = 1 if mode & self.SOURCE_INCREMENT or op == self.MOVE else 0
+        dest_step = 1 if mode & self.DEST_INCREMENT or op == self.MOVE else 0
+        if op == self.MOVE and dest > source:
+            source += length - 1
+            dest += length - 1
+            source_step = dest_step = -1
+        cycles = 0
+        while length:
+            if op == self.FILL:
+                machine.write(dest, self.regs[8])
+                cycles += 1 if dest_step else 2
+            elif op == self.COMPARE:
+                cycles += 3
+                if machine.read(source) != machine.read(dest):
+                    self.status |= self.MISMATCH
+                    break
+            else:
+                machine.write(dest, machine.read(source))
+                cycles += 3
+            source = (source + source_step) & 0xFFFF
+            dest = (dest + dest_step) & 0xFFFF
+            length -= 1
+        self.regs[0:6] = bytes([source & 0xFF, source >> 8, dest & 0xFF, dest >> 8,
+                                length & 0xFF, length >> 8])
+        self.status |= self.DONE
+        machine.cpu.cycles += cycles
+
+    def _update_irq(self):
+        self.irq = bool(self.status & self.DONE and self.regs[6] & self.IRQ_ENABLE)
+        if self.machine is not None:
+            self.machine.update_irq()
+
+class MathUnit(object):
+    """FomuMath: A and B (16 bits), R (32 bits), OP and STATUS at offsets
+    0-9.
+
+    Operations finish as soon as OP is written. The gateware takes 16
+    cycles to divide, so a division adds them to the CPU's cycle count, as
+    though R were read straight away.
+    """
+    kind = "io"
+
+    MUL = 1
+    MAC = 2
+    DIV32 = 3
+    DIV16 = 4
+    OVERFLOW = 0x02
+
+    def __init__(self):
+        self.a = 0
+        self.b = 0
+        self.r = 0
+        self.status = 0
+        self.irq = False
+        self.machine = None
+
+    def read(self, offset):
+        offset &= 0xF
+        if offset < 2:
+            return (self.a >> (8 * offset)) & 0xFF
+        if offset < 4:
+            return (self.b >> (8 * (offset - 2))) & 0xFF
+        if offset < 8:
+            return (self.r >> (8 * (offset - 4))) & 0xFF
+        if offset == 9:
+            return self.status
+        return 0
+
+    def write(self, offset, value):
+        offset &= 0xF
+        if offset < 2:
+            shift = 8 * offset
+            self.a = (self.a & ~(0xFF << shift)) | (value << shift)
+        elif offset < 4:
+            shift = 8 * (offset - 2)
+            self.b = (self.b & ~(0xFF << shift)) | (value << shift)
+        elif offset < 8:
+            shift = 8 * (offset - 4)
+            self.r = (self.r & ~(0xFF << shift)) | (value << shift)
+        elif offset == 8:
+            self.status = 0
+            if value == self.MUL:
+                self.r = self.a * self.b
+            elif value == self.MAC:
+                self.r = (self.r + self.a * self.b) & 0xFFFFFFFF
+            elif value in (self.DIV32, self.DIV16):
+                if value == self.DIV32:
+                    dividend, divisor = self.r, self.a
+                else:
+                    dividend, divisor = self.r & 0xFFFF, self.a & 0xFF
+                if (dividend >> 16) >= divisor:
+                    self.status = self.OVERFLOW
+                    return
+                self.r = (dividend // divisor) | ((dividend % divisor) << 16)
+                if self.machine is not None:
+                    self.machine.cpu.cycles += 16
@@ -0,0 +1,172 @@
+from fomu_6502_emu.cpu import CPU6502, CPU65C02
+from fomu_6502_emu.devices import RAM, ROM, PagedRAM, PagingRegister, LEDController, WishboneBridge, USBSerial, DMAController, MathUnit
+
+# The emulator's model of each of fomu_6502_cpu.CPU_VARIANTS.
+CPU_CLASSES = {
+    "standard": CPU6502,
+    "65c02": CPU65C02,
+    }
+
+def default_devices(rom_image=None, flash_image=None, rom_region="high_os_rom"):
+    """Device models for the entries in Fomu.memory_map that have a
+    submodule behind them. Entries without a model stay unmapped, as they
+    do in the gateware, and read back as 0. flash_image is the contents of
+    the SPI flash behind low_os_rom; the cache in front of it only changes
+    timing, so it is modelled as a plain ROM. rom_image replaces the device
+    at rom_region, as Fomu's rom_image does."""
+    from fomu_6502_rom import boot_rom_image
+    if flash_image is None:
+        flash_image = b""
+    paged = PagedRAM()
+    devices = {
+        "ram": RAM(),
+        "paged_rom": paged,
+        "paging_register": PagingRegister(paged),
+        "low_os_rom": ROM(bytes(flash_image) + b"\xff" * 0x10000),
+        "rgb": LEDController(),
+        "wishbone": WishboneBridge(),
+        "usb_serial": USBSerial(),
+        "dma": DMAController(),
+        "math": MathUnit(),
+        "high_os_rom": ROM(boot_rom_image()),
+        }
+    if rom_image is not None:
+        devices[rom_region] = ROM(rom_image)
+    return devices
+
+class FomuMachine(object):
+    """The whole Fomu 6502 address space, built from a memory map.
+
+    memory_map is a name -> AddressRange dict and defaults to
+    Fomu.memory_map. devices maps the same names to models from
+    fomu_6502_emu.devices and defaults to default_devices(). cpu_variant
+    is "standard" or "65c02", as for build.py --cpu-variant.
+    """
+
+    def __init__(self, memory_map=None, devices=None, rom_image=None, flash_image=None,
+                 rom_region="high_os_rom", cpu_variant="standard"):
+        if memory_map is None:
+            from fomu_soc import Fomu
+            memory_map = Fomu.memory_map
+        if devices is None:
+            devices = default_devices(rom_image, flash_image, rom_region)
+
+        self.memory_map = memory_map
+        self.devices = devices
+        self.mem = bytearray(0x10000)
+
+        # Work out which device (if any) answers at every address.
+        owner = [None] * 0x10000
+        self.irq_devices = []
+        for name, address_range in memory_map.items():
+            device = devices.get(name)
+            if device is None:
+                print("Warning: Memory map defines \'"+name+"\' but no device model exists.")
+                continue
+            for address in range(address_range.start, address_range.start + address_range.size):
+                owner[address] = (device, address - address_range.start)
+            if device.kind == "rom":
+                image = device.image[:address_range.size]
+                self.mem[address_range.start:address_range.start + len(image)] = image
+            device.machine = self
+            device.base = address_range.start
+            if hasattr(device, "irq"):
+                self.irq_devices.append(device)
+
+        read_handlers = [None] * 256
+        write_handlers = [None] * 256
+        for page in range(256):
+            slots = owner[page << 8:(page + 1) << 8]
+            if all(slot is not None and slot[0].kind == "ram" for slot in slots):
+                continue
+            write_handlers[page] = self._page_writer(slots)
+            if any(slot is not None and slot[0].kind == "io" for slot in slots):
+                read_handlers[page] = self._page_reader(slots)
+
+        # The CPU core takes zero page and stack accesses straight from the
+        # bytearray, so those pages must be plain RAM.
+        if write_handlers[0] is not None or write_handlers[1] is not None:
+            raise ValueError("Zero page and stack must be RAM")
+
+        if cpu_variant not in CPU_CLASSES:
+            raise ValueError("Unknown CPU variant \'"+cpu_variant+"\'")
+        self.cpu = CPU_CLASSES[cpu_variant](self.mem, read_handlers, write_handlers)
+
+    def _page_reader(self, slots):
+        mem = self.mem
+        io = [(slot[0].read, slot[1]) if slot is not None and slot[0].kind == "io" else None
+              for slot in slots]
+        def read(address):
+            target = io[address & 0xFF]
+            if target is None:
+                return mem[address]
+            return target[0](target[1]) & 0xFF
+        return read
+
+    def _page_writer(self, slots):
+        mem = self.mem
+        # None means drop the write (ROM or unmapped), True means RAM.
+        targets = []
+        for slot in slots:
+            if slot is None or slot[0].kind == "rom":
+                targets.append(None)
+            elif slot[0].kind == "ram":
+                targets.append(True)
+            else:
+                targets.append((slot[0].write, slot[1]))
+        def write(address, value):
+            target = targets[address & 0xFF]
+            if target is True:
+                mem[address] = value
+            elif target is not None:
+                target[0](target[1], value)
+        return write
+
+    def reset(self):
+        self.cpu.reset()
+
+    def update_irq(self):
+        """Drive the CPU's IRQ line from every device's irq level."""
+        self.cpu.set_irq(any(device.irq for device in self.irq_devices))
+
+    def run(self, max_instructions=None, until_pc=None):
+        return self.cpu.run(max_instructions, until_pc)
+
+    def read(self, address):
+        """Read a byte as the CPU would, including device side effects."""
+        handler = self.cpu.read_handlers[address >> 8]
+        return self.mem[address] if handler is None else handler(address)
+
+    def write(self, address, value):
+        """Write a byte as the CPU would."""
+        handler = self.cpu.write_handlers[address >> 8]
+        if handler is None:
+            self.mem[address] = value
+        else:
+            handler(address, value)
+
+    def load(self, address, data):
+        """Copy data straight into memory, bypassing ROM write protection.
+        Useful for dropping a test program into RAM."""
+        self.mem[address:address + len(data)] = bytes(data)
+
+    def watch_write(self, address, callback=None):
+        """Stop run() (and call callback(value), if given) whenever the CPU
+        writes to address. Zero page and stack writes bypass the page
+        handlers, so only addresses from 0x0200 up can be watched."""
+        if address < 0x200:
+            raise ValueError("Can't watch zero page or stack writes")
+        page = address >> 8
+        inner = self.cpu.write_handlers[page]
+        mem = self.mem
+        cpu = self.cpu
+        def write(addr, value):
+            if inner is None:
+                mem[addr] = value
+            else:
+                inner(addr, value)
+            if addr == address:
+                if callback is not None:
+                    callback(value)
+                cpu.stop()
+        self.cpu.write_handlers[page] = write
@@ -0,0 +1,204 @@
+"""Cycle counts for multiply and divide, in software and on FomuMath.
+
+    python3 -m fomu_6502_emu.mathbench
+
+Each routine takes its operands from zero page and leaves its result
+there, so the software and coprocessor versions are called the same way.
+Counts include the JSR and RTS. The emulator charges a division its whole
+16 cycles; the gateware overlaps some of them with the instructions before
+R is read.
+"""
+import random
+
+from fomu_6502_emu import FomuMachine
+from fomu_6502_emu.asm import assemble
+
+MATH = 0xFE60
+A, B, R, OP = MATH, MATH + 2, MATH + 4, MATH + 8
+MUL, MAC, DIV32, DIV16 = 1, 2, 3, 4
+
+# Zero page: X at $10-$11, Y at $12-$13, the 32-bit result at $14-$17 and
+# a 32-bit sum at $18-$1B. Dot products read 8 words from each table, and
+# the software one keeps its index at $1C while it multiplies.
+X, Y, RESULT, SUM, INDEX = 0x10, 0x12, 0x14, 0x18, 0x1C
+TABLE_X, TABLE_Y = 0x0400, 0x0420
+
+def copy_in(pairs):
+    """Load the coprocessor from zero page: [(zero page, register), ...]."""
+    program = []
+    for zp, register in pairs:
+        program += [("LDA", "zp", zp), ("STA", "abs", register)]
+    return program
+
+def copy_out(pairs):
+    program = []
+    for register, zp in pairs:
+        program += [("LDA", "abs", register), ("STA", "zp", zp)]
+    return program
+
+# RESULT = X * Y, shifting Y out from the bottom and the product in from
+# the top.
+SOFT_MUL = [
+    ("LDA", "#", 0), ("STA", "zp", RESULT + 2), ("STA", "zp", RESULT + 3),
+    ("LDX", "#", 16),
+    "loop",
+    ("LSR", "zp", Y + 1), ("ROR", "zp", Y), ("BCC", "rel", "skip"),
+    ("LDA", "zp", RESULT + 2), ("CLC", ""), ("ADC", "zp", X), ("STA", "zp", RESULT + 2),
+    ("LDA", "zp", RESULT + 3), ("ADC", "zp", X + 1), ("STA", "zp", RESULT + 3),
+    "skip",
+    ("ROR", "zp", RESULT + 3), ("ROR", "zp", RESULT + 2),
+    ("ROR", "zp", RESULT + 1), ("ROR", "zp", RESULT),
+    ("DEX", ""), ("BNE", "rel", "loop"),
+    ("RTS", ""),
+    ]
+
+HARD_MUL = (copy_in([(X, A), (X + 1, A + 1), (Y, B), (Y + 1, B + 1)]) +
+            [("LDA", "#", MUL), ("STA", "abs", OP)] +
+            copy_out([(R + i, RESULT + i) for i in range(4)]) +
+            [("RTS", "")])
+
+# RESULT (32 bits) / X, leaving the quotient in RESULT's low half and the
+# remainder in its high half.
+SOFT_DIV32 = [
+    ("LDX", "#", 16),
+    "loop",
+    ("ASL", "zp", RESULT), ("ROL", "zp", RESULT + 1),
+    ("ROL", "zp", RESULT + 2), ("ROL", "zp", RESULT + 3),
+    ("BCS", "rel", "subtract"),
+    ("LDA", "zp", RESULT + 3), ("CMP", "zp", X + 1), ("BCC", "rel", "next"),
+    ("BNE", "rel", "subtract"),
+    ("LDA", "zp", RESULT + 2), ("CMP", "zp", X), ("BCC", "rel", "next"),
+    "subtract",
+    ("LDA", "zp", RESULT + 2), ("SBC", "zp", X), ("STA", "zp", RESULT + 2),
+    ("LDA", "zp", RESULT + 3), ("SBC", "zp", X + 1), ("STA", "zp", RESULT + 3),
+    ("INC", "zp", RESULT),
+    "next",
+    ("DEX", ""), ("BNE", "rel", "loop"),
+    ("RTS", ""),
+    ]
+
+HARD_DIV32 = (copy_in([(X, A), (X + 1, A + 1)] + [(RESULT + i, R + i) for i in range(4)]) +
+              [("LDA", "#", DIV32), ("STA", "abs", OP)] +
+              copy_out([(R + i, RESULT + i) for i in range(4)]) +
+              [("RTS", "")])
+
+# RESULT's low half / X's low byte: the quotient goes back in RESULT's low
+# half and the remainder in RESULT + 2.
+SOFT_DIV16 = [
+    ("LDA", "#", 0), ("LDX", "#", 16),
+    "loop",
+    ("ASL", "zp", RESULT), ("ROL", "zp", RESULT + 1), ("ROL", ""),
+    ("BCS", "rel", "subtract"),
+    ("CMP", "zp", X), ("BCC", "rel", "next"),
+    "subtract",
+    ("SBC", "zp", X), ("INC", "zp", RESULT),
+    "next",
+    ("DEX", ""), ("BNE", "rel", "loop"),
+    ("STA", "zp", RESULT + 2),
+    ("RTS", ""),
+    ]
+
+HARD_DIV16 = (copy_in([(X, A), (RESULT, R), (RESULT + 1, R + 1)]) +
+              [("LDA", "#", DIV16), ("STA", "abs", OP)] +
+              copy_out([(R + i, RESULT + i) for i in range(3)]) +
+              [("RTS", "")])
+
+# SUM = the sum of TABLE_X[i] * TABLE_Y[i] for 8 words.
+def soft_dot(mul):
+    return [
+        ("LDA", "#", 0)] + [("STA", "zp", SUM + i) for i in range(4)] + [
+        ("LDX", "#", 0),
+        "loop",
+        ("LDA", "abs,x", TABLE_X), ("STA", "zp", X), ("LDA", "abs,x", TABLE_X + 1), ("STA", "zp", X + 1),
+        ("LDA", "abs,x", TABLE_Y), ("STA", "zp", Y), ("LDA", "abs,x", TABLE_Y + 1), ("STA", "zp", Y + 1),
+        ("STX", "zp", INDEX), ("JSR", "abs", mul), ("LDX", "zp", INDEX),
+        ("CLC", "")] + sum([[("LDA", "zp", SUM + i), ("ADC", "zp", RESULT + i), ("STA", "zp", SUM + i)]
+                            for i in range(4)], []) + [
+        ("INX", ""), ("INX", ""), ("CPX", "#", 16), ("BNE", "rel", "loop"),
+        ("RTS", ""),
+        ]
+
+HARD_DOT = [
+    ("LDA", "#", 0)] + [("STA", "abs", R + i) for i in range(4)] + [
+    ("LDX", "#", 0),
+    "loop",
+    ("LDA", "abs,x", TABLE_X), ("STA", "abs", A), ("LDA", "abs,x", TABLE_X + 1), ("STA", "abs", A + 1),
+    ("LDA", "abs,x", TABLE_Y), ("STA", "abs", B), ("LDA", "abs,x", TABLE_Y + 1), ("STA", "abs", B + 1),
+    ("LDA", "#", MAC), ("STA", "abs", OP),
+    ("INX", ""), ("INX", ""), ("CPX", "#", 16), ("BNE", "rel", "loop"),
+    ] + copy_out([(R + i, SUM + i) for i in range(4)]) + [
+    ("RTS", ""),
+    ]
+
+ROUTINE = 0x0200
+HELPER = 0x0500
+CALLER = 0x0300
+
+def run(machine, program, zero_page, helper=None):
+    """Call program with zero_page loaded from $10 up. Returns the cycles
+    taken, including the JSR and RTS."""
+    machine.load(ROUTINE, assemble(ROUTINE, program))
+    if helper is not None:
+        machine.load(HELPER, assemble(HELPER, helper))
+    machine.load(CALLER, assemble(CALLER, [("JSR", "abs", ROUTINE), "end", ("JMP", "abs", "end")]))
+    machine.mem[0x10:0x10 + len(zero_page)] = zero_page
+    machine.cpu.pc = CALLER
+    start = machine.cpu.cycles
+    machine.run(100000, CALLER + 3)
+    return machine.cpu.cycles - start
+
+def main():
+    machine = FomuMachine()
+    machine.reset()
+    random.seed(6502)
+    print("{:<28} {:>9} {:>12}".format("", "software", "coprocessor"))
+
+    def report(name, soft, hard):
+        print("{:<28} {:>9} {:>12}   {:.1f}x".format(name, soft, hard, soft / hard))
+
+    def word(value, size):
+        return value.to_bytes(size, "little")
+
+    totals = [0, 0]
+    for trial in range(100):
+        x, y = random.randrange(65536), random.randrange(65536)
+        for i, program in enumerate((SOFT_MUL, HARD_MUL)):
+            totals[i] += run(machine, program, word(x, 2) + word(y, 2) + word(0, 4))
+            if machine.mem[RESULT:RESULT + 4] != word(x * y, 4):
+                raise ValueError("16x16 multiply of "+hex(x)+" and "+hex(y)+" went wrong")
+    report("16x16 multiply", totals[0] // 100, totals[1] // 100)
+
+    totals = [0, 0]
+    for trial in range(100):
+        x = random.randrange(1, 65536)
+        n = random.randrange(x << 16)
+        for i, program in enumerate((SOFT_DIV32, HARD_DIV32)):
+            totals[i] += run(machine, program, word(x, 2) + word(0, 2) + word(n, 4))
+            if machine.mem[RESULT:RESULT + 4] != word(n // x, 2) + word(n % x, 2):
+                raise ValueError("32/16 divide of "+hex(n)+" by "+hex(x)+" went wrong")
+    report("32/16 divide", totals[0] // 100, totals[1] // 100)
+
+    totals = [0, 0]
+    for trial in range(100):
+        x = random.randrange(1, 256)
+        n = random.randrange(65536)
+        for i, program in enumerate((SOFT_DIV16, HARD_DIV16)):
+            totals[i] += run(machine, program, word(x, 2) + word(0, 2) + word(n, 2))
+            if machine.mem[RESULT:RESULT + 3] != word(n // x, 2) + word(n % x, 1):
+                raise ValueError("16/8 divide of "+hex(n)+" by "+hex(x)+" went wrong")
+    report("16/8 divide", totals[0] // 100, totals[1] // 100)
+
+    xs = [random.randrange(65536) for i in range(8)]
+    ys = [random.randrange(65536) for i in range(8)]
+    machine.load(TABLE_X, b"".join(word(v, 2) for v in xs))
+    machine.load(TABLE_Y, b"".join(word(v, 2) for v in ys))
+    expected = word(sum(x * y for x, y in zip(xs, ys)) & 0xFFFFFFFF, 4)
+    cycles = []
+    for program, helper in ((soft_dot(HELPER), SOFT_MUL), (HARD_DOT, None)):
+        cycles.append(run(machine, program, b"", helper))
+        if machine.mem[SUM:SUM + 4] != expected:
+            raise ValueError("Dot product went wrong")
+    report("8-term multiply-accumulate", cycles[0], cycles[1])
+
+if __name__ == "__main__":
+    main()
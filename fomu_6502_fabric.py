@@ -0,0 +1,303 @@
+from migen import *
+
+def address_prefixes(start, size):
+    """Split [start, start+size) into the fewest aligned power-of-two
+    blocks. Each block is returned as (value, bits): the address matches
+    when address[16-bits:] == value."""
+    prefixes = []
+    end = start + size
+    while start < end:
+        block = 1
+        while start % (block * 2) == 0 and start + block * 2 <= end:
+            block *= 2
+        bits = 16 - (block.bit_length() - 1)
+        prefixes.append((start >> (16 - bits), bits))
+        start += block
+    return prefixes
+
+def check_memory_map(memory_map):
+    """Raise ValueError unless every range is non-empty, inside the 64K
+    address space, aligned and clear of every other range."""
+    ranges = sorted(memory_map.items(), key=lambda item: item[1].start)
+    for name, address_range in ranges:
+        if address_range.size <= 0:
+            raise ValueError("Memory map entry '"+name+"' has no size")
+        if address_range.start < 0 or address_range.start + address_range.size > 0x10000:
+            raise ValueError("Memory map entry '"+name+"' lies outside the address space")
+        # Ranges must start on a boundary of the biggest power of two that
+        # fits in them, or they decode to a scatter of small prefixes.
+        alignment = 1 << (address_range.size.bit_length() - 1)
+        if address_range.start % alignment:
+            raise ValueError("Memory map entry '"+name+"' at "+hex(address_range.start)+
+                             " is not aligned to "+hex(alignment))
+    for (name, a), (next_name, b) in zip(ranges, ranges[1:]):
+        if a.start + a.size > b.start:
+            raise ValueError("Memory map entries '"+name+"' and '"+next_name+"' overlap")
+
+def _lut4s(inputs):
+    """LUT4s in a tree reducing this many inputs to one."""
+    return max(0, -(-(inputs - 1) // 3))
+
+def _lut4_depth(inputs):
+    depth = 0
+    while inputs > 1:
+        inputs = -(-inputs // 4)
+        depth += 1
+    return depth
+
+def balanced_or(terms):
+    """OR the terms together as a balanced tree rather than a chain."""
+    terms = list(terms)
+    if not terms:
+        return Constant(0)
+    while len(terms) > 1:
+        terms = [terms[i] | terms[i+1] if i + 1 < len(terms) else terms[i]
+                 for i in range(0, len(terms), 2)]
+    return terms[0]
+
+class BusFabric(Module):
+    """Address decoder and read mux for the 6502 bus, generated from the
+    memory map.
+
+    Each entry is decoded from the fewest aligned address prefixes, giving a
+    one-hot fast select (for the current address) and slow select (for the
+    address the CPU is reading data back for, one cycle later). The slow
+    selects are held while RDY is low, so a device that stalls the CPU keeps
+    the data bus until it lets go. Read data, RDY, IRQ and NMI are combined
+    with balanced AND-OR trees, so adding a device adds a LUT level only
+    every time the device count doubles.
+
+    An entry with wait_states set holds RDY low for that many extra cycles
+    on every access to it. While it waits the fabric keeps presenting that
+    access to the devices (the CPU has already moved its address bus on), so
+    a slow device sees the same address, WE and write data throughout and
+    its output is sampled on the last cycle. When no entry has wait states
+    none of this logic is built.
+
+    With registered=True the read mux output is registered, giving the
+    devices a whole cycle to answer, at the cost of one wait state on every
+    access. During that wait the CPU's address can still be changing (the
+    high byte of an absolute address comes from the data it is waiting
+    for), so devices only see an access on its last cycle, or while a wait
+    state holds it; a device with held is still selected on the first
+    cycle, as a read there is harmless and fills its kept word, but gets
+    no WE.
+    A device with a held signal (FomuSPRAM) can say, while a read is
+    presented, that it will have the data in flip-flops on held_data the
+    next cycle; those reads skip the wait state.
+
+    Every device gets the RDY the master sees on bus_rdy, and write_waiting,
+    set while RDY is low and the master is presenting a write to the
+    device. A device holding RDY after a read uses it to see whether the
+    read was an indexed store's, made the cycle before writing the same
+    address; that address doesn't depend on the data being waited for, so
+    it is right on the registered bus too.
+
+    A master with a wide signal (the DMA controller) can make 16-bit
+    accesses, of the byte at an even address and the one above it, to
+    devices that have one too; the upper byte goes out on data_out_high and
+    comes back on data_in_high. Other devices never see wide set, so a
+    master must only use it on addresses it knows take it.
+    """
+
+    def __init__(self, master, memory_map, devices, registered=False):
+        check_memory_map(memory_map)
+        self.memory_map = memory_map
+        self.registered = registered
+        self.fast_sel = {}
+        self.slow_sel = {}
+        self.report = []
+
+        rdy = Signal(reset=1)
+        self.rdy = rdy
+        wide_master = hasattr(master, "wide")
+
+        # Wait state generation. The counter is loaded with the wait states
+        # of whatever the CPU addresses, then counts down with RDY held low.
+        max_wait_states = max(r.wait_states for r in memory_map.values())
+        if max_wait_states:
+            wait = Signal(max=max_wait_states+1)
+            held_address = Signal(16)
+            held_data = Signal(8)
+            held_we = Signal()
+            address = Signal(16)
+            data_out = Signal(8)
+            we = Signal()
+            held_wide = Signal()
+            held_data_high = Signal(8)
+            wide = Signal()
+            data_out_high = Signal(8)
+            self.sync += If(rdy,
+                    held_address.eq(master.address),
+                    held_data.eq(master.data_out),
+                    held_we.eq(master.we)
+                )
+            self.comb += If(wait != 0,
+                    address.eq(held_address),
+                    data_out.eq(held_data),
+                    we.eq(held_we)
+                ).Else(
+                    address.eq(master.address),
+                    data_out.eq(master.data_out),
+                    we.eq(master.we)
+                )
+            if wide_master:
+                self.sync += If(rdy,
+                        held_wide.eq(master.wide),
+                        held_data_high.eq(master.data_out_high)
+                    )
+                self.comb += If(wait != 0,
+                        wide.eq(held_wide),
+                        data_out_high.eq(held_data_high)
+                    ).Else(
+                        wide.eq(master.wide),
+                        data_out_high.eq(master.data_out_high)
+                    )
+        else:
+            address = master.address
+            data_out = master.data_out
+            we = master.we
+            if wide_master:
+                wide = master.wide
+                data_out_high = master.data_out_high
+        wait_terms = []
+
+        if registered:
+            present = Signal()
+        else:
+            present = Constant(1)
+
+        data_terms = []
+        data_high_terms = []
+        held_terms = []
+        held_data_terms = []
+        held_data_high_terms = []
+        rdy_terms = []
+        irq_terms = []
+        nmi_terms = []
+
+        for name, address_range in memory_map.items():
+            fast_sel = Signal(name=name+"_sel")
+            slow_sel = Signal(name=name+"_sel_slow")
+            self.fast_sel[name] = fast_sel
+            self.slow_sel[name] = slow_sel
+
+            prefixes = address_prefixes(address_range.start, address_range.size)
+            self.comb += fast_sel.eq(balanced_or(
+                address[16-bits:] == value for value, bits in prefixes))
+            self.sync += If(rdy, slow_sel.eq(fast_sel))
+            if address_range.wait_states:
+                wait_terms.append(Replicate(fast_sel, len(wait)) &
+                                  Constant(address_range.wait_states, len(wait)))
+
+            # Rough LUT4 cost: a compare tree per prefix, then an OR tree.
+            luts = sum(_lut4s(bits) for value, bits in prefixes) + _lut4s(len(prefixes))
+            depth = max(_lut4_depth(bits) for value, bits in prefixes) + _lut4_depth(len(prefixes))
+            self.report.append((name, len(prefixes), max(bits for value, bits in prefixes), luts, depth,
+                                address_range.wait_states))
+
+            module = devices.get(name)
+            if module is None:
+                print("Warning: Memory map defines \'"+name+"\' but no submodule exists.")
+                continue
+
+            data_terms.append(Replicate(slow_sel, 8) & module.data_out)
+            rdy_terms.append(slow_sel & ~module.rdy)
+            irq_terms.append(module.irq)
+            nmi_terms.append(module.nmi)
+
+            if hasattr(module, "held"):
+                cs = fast_sel
+            else:
+                cs = fast_sel & present
+            self.comb += [
+                module.cs.eq(cs),
+                module.cs_slow.eq(slow_sel),
+                module.address.eq(address - address_range.start),
+                module.data_in.eq(data_out),
+                module.we.eq(we & present),
+                module.bus_rdy.eq(rdy),
+                module.write_waiting.eq(fast_sel & we & ~rdy)
+                ]
+            if wide_master and hasattr(module, "wide"):
+                data_high_terms.append(Replicate(slow_sel, 8) & module.data_out_high)
+                self.comb += [
+                    module.wide.eq(wide),
+                    module.data_in_high.eq(data_out_high)
+                    ]
+            if registered and hasattr(module, "held"):
+                held_terms.append(fast_sel & module.held)
+                held_data_terms.append(Replicate(slow_sel, 8) & module.held_data)
+                if wide_master and hasattr(module, "wide"):
+                    held_data_high_terms.append(Replicate(slow_sel, 8) & module.held_data_high)
+
+        data_mux = Signal(8)
+        rdy_mux = Signal()
+        if max_wait_states:
+            self.sync += If(rdy,
+                    wait.eq(balanced_or(wait_terms))
+                ).Elif(wait != 0,
+                    wait.eq(wait - 1)
+                )
+            self.comb += rdy_mux.eq(~balanced_or(rdy_terms) & (wait == 0))
+        else:
+            self.comb += rdy_mux.eq(~balanced_or(rdy_terms))
+        self.comb += [
+            data_mux.eq(balanced_or(data_terms)),
+            master.irq.eq(balanced_or(irq_terms)),
+            master.nmi.eq(balanced_or(nmi_terms)),
+            master.rdy.eq(rdy),
+            ]
+
+        if wide_master:
+            data_high_mux = Signal(8)
+            self.comb += data_high_mux.eq(balanced_or(data_high_terms))
+
+        if registered:
+            # The first cycle of every access is spent registering the mux;
+            # after that RDY follows the device, a cycle late like the data.
+            # A read the device holds is taken from held_data instead, with
+            # no wait.
+            held = Signal()
+            self.sync += held.eq(rdy & balanced_or(held_terms))
+            if wide_master:
+                data_high_reg = Signal(8)
+                self.sync += data_high_reg.eq(data_high_mux)
+                self.comb += master.data_in_high.eq(Mux(held, balanced_or(held_data_high_terms), data_high_reg))
+            data_reg = Signal(8)
+            rdy_reg = Signal()
+            first_cycle = Signal()
+            self.sync += [
+                data_reg.eq(data_mux),
+                rdy_reg.eq(rdy_mux),
+                first_cycle.eq(rdy),
+                ]
+            self.comb += [
+                master.data_in.eq(Mux(held, balanced_or(held_data_terms), data_reg)),
+                rdy.eq(held | (rdy_reg & ~first_cycle)),
+                ]
+            if max_wait_states:
+                self.comb += present.eq(rdy | (wait != 0))
+            else:
+                self.comb += present.eq(rdy)
+        else:
+            if wide_master:
+                self.comb += master.data_in_high.eq(data_high_mux)
+            self.comb += [
+                master.data_in.eq(data_mux),
+                rdy.eq(rdy_mux),
+                ]
+
+        # Each data bit is an AND-OR over the devices; a LUT4 takes two
+        # select/data pairs.
+        pairs = -(-len(data_terms) // 2)
+        self.mux_luts = 8 * (pairs + _lut4s(pairs))
+        self.mux_depth = 1 + _lut4_depth(pairs)
+
+    def print_report(self):
+        print("Address decoder (estimated LUT4s):")
+        for name, prefixes, bits, luts, depth, wait_states in self.report:
+            print("  {:<16} {} prefix(es) of up to {:>2} bits, {:>2} LUTs, depth {}, {} wait state(s)".format(
+                name, prefixes, bits, luts, depth, wait_states))
+        print("  Read mux: {} LUTs, depth {}{}".format(
+            self.mux_luts, self.mux_depth, ", registered" if self.registered else ""))
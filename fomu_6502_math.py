@@ -0,0 +1,162 @@
+from migen import *
+from fomu_6502_bus import Bus6502
+
+# Register offsets. A and B are 16 bits and R 32 bits, little endian.
+A = 0
+B = 2
+R = 4
+OP = 8
+STATUS = 9
+
+# Operations, written to OP.
+MUL = 1
+MAC = 2
+DIV32 = 3
+DIV16 = 4
+
+# STATUS bits.
+BUSY = 0x01
+OVERFLOW = 0x02
+
+class MAC16Multiplier(Module):
+    """An SB_MAC16 DSP block as an unregistered 16x16 unsigned multiplier.
+
+    With simulation=True it is replaced by a plain multiply, so migen's
+    simulator can run it."""
+
+    def __init__(self, simulation=False):
+        self.a = Signal(16)
+        self.b = Signal(16)
+        self.product = Signal(32)
+
+        if simulation:
+            self.comb += self.product.eq(self.a * self.b)
+            return
+
+        self.specials += Instance("SB_MAC16",
+                                  p_NEG_TRIGGER=0,
+                                  p_A_REG=0, p_B_REG=0, p_C_REG=0, p_D_REG=0,
+                                  p_TOP_8x8_MULT_REG=0, p_BOT_8x8_MULT_REG=0,
+                                  p_PIPELINE_16x16_MULT_REG1=0, p_PIPELINE_16x16_MULT_REG2=0,
+                                  p_TOPOUTPUT_SELECT=0b11, p_TOPADDSUB_LOWERINPUT=0b00,
+                                  p_TOPADDSUB_UPPERINPUT=0, p_TOPADDSUB_CARRYSELECT=0b00,
+                                  p_BOTOUTPUT_SELECT=0b11, p_BOTADDSUB_LOWERINPUT=0b00,
+                                  p_BOTADDSUB_UPPERINPUT=0, p_BOTADDSUB_CARRYSELECT=0b00,
+                                  p_MODE_8x8=0, p_A_SIGNED=0, p_B_SIGNED=0,
+                                  i_CLK=ClockSignal(), i_CE=1,
+                                  i_A=self.a, i_B=self.b, i_C=0, i_D=0,
+                                  i_AHOLD=0, i_BHOLD=0, i_CHOLD=0, i_DHOLD=0,
+                                  i_IRSTTOP=0, i_IRSTBOT=0, i_ORSTTOP=0, i_ORSTBOT=0,
+                                  i_OLOADTOP=0, i_OLOADBOT=0, i_ADDSUBTOP=0, i_ADDSUBBOT=0,
+                                  i_OHOLDTOP=0, i_OHOLDBOT=0,
+                                  i_CI=0, i_ACCUMCI=0, i_SIGNEXTIN=0,
+                                  o_O=self.product
+                                  )
+
+class FomuMath(Bus6502, Module):
+    """Multiply and divide for the 6502, using one of the UP5K's DSP blocks.
+
+    Write the operands, then the operation to OP:
+
+      MUL    R = A * B
+      MAC    R = R + A * B
+      DIV32  R / A, leaving the quotient in R's low half and the remainder
+             in its high half
+      DIV16  R's low half / A's low byte, the same way
+
+    All unsigned. MUL and MAC are done by the next cycle. Division takes 16
+    cycles, during which BUSY is set in STATUS; reading R before it is done
+    holds the CPU with RDY until it is. A quotient that won't fit in 16 bits
+    (including any division by 0) sets OVERFLOW in STATUS, until the next
+    operation, and leaves R alone. Other offsets read as 0.
+    """
+
+    def __init__(self, platform, simulation=False):
+        super().__init__(platform)
+        self.submodules.multiplier = multiplier = MAC16Multiplier(simulation)
+
+        a = Signal(16)
+        b = Signal(16)
+        r = Signal(32)
+        busy = Signal()
+        overflow = Signal()
+        count = Signal(4)
+        divisor = Signal(16)
+        self.comb += [
+            multiplier.a.eq(a),
+            multiplier.b.eq(b),
+            ]
+
+        access, offset = self.access()
+        waiting = Signal()
+        self.comb += self.rdy.eq(~waiting)
+        self.sync += [
+            If(access & ~self.we & (self.address[2:4] == 1) & busy,
+                waiting.eq(1)
+            ).Elif(~busy,
+                waiting.eq(0)
+            )
+            ]
+
+        # Restoring division, a quotient bit a cycle: shift R left, and
+        # subtract the divisor from the top half when it fits.
+        top = Signal(17)
+        self.comb += top.eq(r[15:32])
+        self.sync += If(busy,
+            If(top >= divisor,
+                r.eq(Cat(1, r[0:15], top - divisor))
+            ).Else(
+                r.eq(Cat(0, r[0:15], top[:16]))
+            ),
+            count.eq(count + 1),
+            If(count == 15, busy.eq(0))
+        )
+
+        self.sync += If(access & self.we,
+            Case(self.address[:4], {
+                0: a[0:8].eq(self.data_in),
+                1: a[8:16].eq(self.data_in),
+                2: b[0:8].eq(self.data_in),
+                3: b[8:16].eq(self.data_in),
+                4: r[0:8].eq(self.data_in),
+                5: r[8:16].eq(self.data_in),
+                6: r[16:24].eq(self.data_in),
+                7: r[24:32].eq(self.data_in),
+                OP: [
+                    overflow.eq(0),
+                    count.eq(0),
+                    Case(self.data_in, {
+                        MUL: r.eq(multiplier.product),
+                        MAC: r.eq(r + multiplier.product),
+                        DIV32: If(r[16:32] >= a,
+                            overflow.eq(1)
+                        ).Else(
+                            divisor.eq(a),
+                            busy.eq(1)
+                        ),
+                        DIV16: If(a[0:8] == 0,
+                            overflow.eq(1)
+                        ).Else(
+                            divisor.eq(a[0:8]),
+                            r[16:32].eq(0),
+                            busy.eq(1)
+                        ),
+                        "default": []
+                    })
+                ],
+                "default": []
+            })
+        )
+
+        self.comb += Case(offset, {
+            0: self.data_out.eq(a[0:8]),
+            1: self.data_out.eq(a[8:16]),
+            2: self.data_out.eq(b[0:8]),
+            3: self.data_out.eq(b[8:16]),
+            4: self.data_out.eq(r[0:8]),
+            5: self.data_out.eq(r[8:16]),
+            6: self.data_out.eq(r[16:24]),
+            7: self.data_out.eq(r[24:32]),
+            STATUS: self.data_out.eq(Cat(busy, overflow)),
+            "default": self.data_out.eq(0)
+            })
@@ -0,0 +1,18 @@
+from migen import *
+from fomu_6502_bus import Bus6502
+
+class FomuPagingRegister(Bus6502, Module):
+    """Bank select for paged_rom. Offset 0 holds the number of the bank
+    mapped into the window and reads back what was last written; the rest
+    of the registers read as 0. Writes take effect from the next access."""
+
+    def __init__(self, platform):
+        super().__init__(platform)
+        self.bank = Signal(8)
+
+        self.sync += [
+            If(self.cs & self.we & (self.address == 0),
+                self.bank.eq(self.data_in)
+            ),
+            self.data_out.eq(Mux(self.address == 0, self.bank, 0))
+            ]
@@ -2,10 +2,22 @@ from migen import *
 from fomu_6502_bus import Bus6502
 
 class SBLED(Bus6502, Module):
-    def __init__(self, platform):
+    def __init__(self, platform, simulation=False):
         super().__init__(platform)
         
         pwm_out = Signal(3) # RGB driver inputs
+
+        if simulation:
+            # Stand-in for SB_LEDDA_IP: just the register file, so a
+            # testbench can see what the CPU wrote. PWMOUTn is the top
+            # bit of each duty cycle register, gated by LEDDCR0's enable.
+            self.registers = Array(Signal(8, name="leddr{:x}".format(i)) for i in range(16))
+            self.pwm_out = pwm_out
+            self.sync += If(self.cs & self.we, self.registers[self.address[:4]].eq(self.data_in))
+            self.comb += pwm_out.eq(Cat(self.registers[1][7], self.registers[2][7],
+                                        self.registers[3][7]) & Replicate(self.registers[8][7], 3))
+            return
+
         pads = platform.request("led")
 
         # Constant-current LED driver control and RGB to output pin mapping.
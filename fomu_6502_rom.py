@@ -1,43 +1,155 @@
 from migen import *
 from fomu_6502_bus import Bus6502
-from random import randint
+import json
+import os
+import random
+import subprocess
 
-class FomuROM(Bus6502, Module):
-    def __init__(self, platform):
-        super().__init__(platform)
-        rom_bytes = [
-            # Boot rom, starts at 0xFF00
-            0xA9, 0b11000000,  # LDA #&80
-            0x8D, 0x08, 0xFE,  # STA &FE08   - LEDDCR0
-            0xA9, 186,         # LDA #186
-            0x8D, 0x09, 0xFE,  # STA &FE09   - LEDDBR0
-            0xA9, 0x0C,        # LDA #&0C
-            0x8D, 0x10, 0xFE,  # STA &FE10   - LEDDONR
-            0x8D, 0x11, 0xFE,  # STA &FE11   - LEDDOFR
-            0xA9, 0xE2,        # LDA #&E2
-            0x8D, 0x05, 0xFE,  # STA &FE05   - LEDDBCRR
-            0x8D, 0x06, 0xFE,  # STA &FE06   - LEDDBCFR
-            0xA9, 0xFF,        # LDA #&FF
-            0x8D, 0x00, 0x00,  # STA #&0000 - Save FF to RAM address 0
-            0xA9, 0x00,        # LDA #&00
-            0x8D, 0x01, 0x00,  # STA #&0001 - Save 00 to RAM address 1
-            0xAD, 0x00, 0x00,  # LDA &0000  - Load from RAM address 0
-            0x8D, 0x01, 0xFE,  # STA &FE01  - LEDDPWRR
-            0xAD, 0x01, 0x00,  # LDA &0001  - Load from RAM address 1
-            0x8D, 0x02, 0xFE,  # STA &FE02  - LEDDPWRG
-            0x8D, 0x03, 0xFE   # STA &FE03  - LEDDPWRB
+def boot_rom_image():
+    """Return the 256 bytes of the debug boot ROM that lives at 0xFF00."""
+    rom_bytes = [
+        # Boot rom, starts at 0xFF00
+        0xA9, 0b11000000,  # LDA #&80
+        0x8D, 0x08, 0xFE,  # STA &FE08   - LEDDCR0
+        0xA9, 186,         # LDA #186
+        0x8D, 0x09, 0xFE,  # STA &FE09   - LEDDBR0
+        0xA9, 0x0C,        # LDA #&0C
+        0x8D, 0x10, 0xFE,  # STA &FE10   - LEDDONR
+        0x8D, 0x11, 0xFE,  # STA &FE11   - LEDDOFR
+        0xA9, 0xE2,        # LDA #&E2
+        0x8D, 0x05, 0xFE,  # STA &FE05   - LEDDBCRR
+        0x8D, 0x06, 0xFE,  # STA &FE06   - LEDDBCFR
+        0xA9, 0xFF,        # LDA #&FF
+        0x8D, 0x00, 0x00,  # STA #&0000 - Save FF to RAM address 0
+        0xA9, 0x00,        # LDA #&00
+        0x8D, 0x01, 0x00,  # STA #&0001 - Save 00 to RAM address 1
+        0xAD, 0x00, 0x00,  # LDA &0000  - Load from RAM address 0
+        0x8D, 0x01, 0xFE,  # STA &FE01  - LEDDPWRR
+        0xAD, 0x01, 0x00,  # LDA &0001  - Load from RAM address 1
+        0x8D, 0x02, 0xFE,  # STA &FE02  - LEDDPWRG
+        0x8D, 0x03, 0xFE   # STA &FE03  - LEDDPWRB
+    ]
+
+    while len(rom_bytes) < 250:
+        rom_bytes = rom_bytes + [0x00]
+
+    # Set up all vectors to point to 0xFF00
+    rom_bytes += [
+        0x00, 0xFF,
+        0x00, 0xFF,
+        0x00, 0xFF
         ]
+    return rom_bytes
 
-        while len(rom_bytes) < 250:
-            rom_bytes = rom_bytes + [0x00]
+def load_rom_image(path, start=0):
+    """Read a ROM image from a file. Intel HEX files (.hex, .ihex) hold 6502
+    addresses, and start is the address the ROM is mapped at; anything else
+    is taken as a raw binary to be placed at start."""
+    if os.path.splitext(path)[1].lower() not in (".hex", ".ihex"):
+        with open(path, "rb") as f:
+            return f.read()
 
-        # Set up all vectors to point to 0xFF00
-        rom_bytes += [
-            0x00, 0xFF,
-            0x00, 0xFF,
-            0x00, 0xFF
+    image = bytearray()
+    base = 0
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(":"):
+                raise ValueError(path+":"+str(line_number)+": not an Intel HEX record")
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+                raise ValueError(path+":"+str(line_number)+": bad Intel HEX record")
+            count, kind, data = record[0], record[3], record[4:-1]
+            address = base + ((record[1] << 8) | record[2])
+            if kind == 0x00:
+                offset = address - start
+                if offset < 0:
+                    raise ValueError(path+":"+str(line_number)+": data below the ROM at "+hex(start))
+                if len(image) < offset + count:
+                    image.extend(bytes(offset + count - len(image)))
+                image[offset:offset + count] = data
+            elif kind == 0x01:
+                break
+            elif kind == 0x02:
+                base = ((data[0] << 8) | data[1]) << 4
+            elif kind == 0x04:
+                base = ((data[0] << 8) | data[1]) << 16
+    return bytes(image)
+
+# The UP5K has 30 4Kbit block RAMs.
+EBR_BYTES = 30 * 512
+
+class FomuROM(Bus6502, Module):
+    """ROM in block RAM. image defaults to the debug boot ROM, and size to
+    the image's size; a shorter image is padded with zeros (BRK)."""
+    def __init__(self, platform, image=None, size=None):
+        super().__init__(platform)
+        if image is None:
+            image = boot_rom_image()
+        if size is None:
+            size = len(image)
+        if len(image) > size:
+            raise ValueError("ROM image is "+str(len(image))+" bytes, but the ROM is only "+str(size))
+        if size > EBR_BYTES:
+            print("Warning: A "+str(size)+" byte ROM is more block RAM than the UP5K has.")
+
+        self.specials.mem = Memory(8, size, init=list(image) + [0] * (size - len(image)))
+        port = self.mem.get_port()
+        self.specials += port
+        self.comb += [
+            port.adr.eq(self.address),
+            self.data_out.eq(port.dat_r)
             ]
 
-        byte_map = {i:self.data_out.eq(rom_bytes[i]) for i in range(256)}
-        self.sync += [Case(self.address, byte_map)]
-            
+# Swapping firmware into a finished bitstream. The ROM is built full of a
+# pseudo-random placeholder, which icebram can find again in the block RAM
+# contents of the placed design and replace with a real image, so a firmware
+# change doesn't need synthesis or place and route.
+PLACEHOLDER_NAME = "rom_placeholder"
+
+def placeholder_image(size, seed=6502):
+    """Pseudo-random ROM contents that icebram can find in the bitstream."""
+    rng = random.Random(seed)
+    return bytes(rng.randrange(256) for i in range(size))
+
+def write_hex(path, image):
+    """Write image as a hex file with a byte per line, as icebram expects."""
+    with open(path, "w") as f:
+        f.write("".join("%02x\n" % b for b in image))
+
+def save_placeholder(build_dir, region, size):
+    """Record the placeholder a bitstream in build_dir was built with, and
+    return the placeholder image."""
+    image = placeholder_image(size)
+    write_hex(os.path.join(build_dir, PLACEHOLDER_NAME + ".hex"), image)
+    with open(os.path.join(build_dir, PLACEHOLDER_NAME + ".json"), "w") as f:
+        json.dump({"region": region, "size": size}, f)
+    return image
+
+def load_placeholder(build_dir):
+    """Return (region, size) of the placeholder ROM in build_dir's bitstream."""
+    try:
+        with open(os.path.join(build_dir, PLACEHOLDER_NAME + ".json")) as f:
+            info = json.load(f)
+    except FileNotFoundError:
+        raise ValueError("No placeholder ROM in "+build_dir+"; build with --rom-placeholder first")
+    return info["region"], info["size"]
+
+def swap_rom(build_dir, image, build_name="top", icebram="icebram", icepack="icepack"):
+    """Patch image into the placeholder ROM of the bitstream in build_dir
+    and repack it. The placed design (build_name.txt) is left alone, so
+    this can be done again and again."""
+    region, size = load_placeholder(build_dir)
+    if len(image) > size:
+        raise ValueError("ROM image is "+str(len(image))+" bytes, but the ROM is only "+str(size))
+    new_hex = os.path.join(build_dir, PLACEHOLDER_NAME + "_new.hex")
+    write_hex(new_hex, bytes(image) + bytes(size - len(image)))
+
+    asc = os.path.join(build_dir, build_name + ".txt")
+    patched = os.path.join(build_dir, build_name + "_rom.txt")
+    with open(asc) as source, open(patched, "w") as dest:
+        subprocess.check_call([icebram, os.path.join(build_dir, PLACEHOLDER_NAME + ".hex"), new_hex],
+                              stdin=source, stdout=dest)
+    subprocess.check_call([icepack, patched, os.path.join(build_dir, build_name + ".bin")])
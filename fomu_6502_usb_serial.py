@@ -0,0 +1,65 @@
+from migen import *
+from fomu_6502_bus import Bus6502
+from fomu_cdc import StreamCrossing
+
+# Register offsets, and the bits of STATUS and IRQ_ENABLE.
+DATA = 0
+STATUS = 1
+IRQ_ENABLE = 2
+RX_READY = 0x01
+TX_READY = 0x02
+
+class FomuUSBSerial(Bus6502, Module):
+    """The USB CDC-ACM serial port, as the 6502 sees it.
+
+    Reading DATA (offset 0) takes the next byte the host sent, and writing
+    it queues a byte for the host. STATUS (offset 1) has RX_READY set while
+    there is a byte to read and TX_READY while there is room to write one;
+    reading DATA with nothing there gives 0, and writing with no room drops
+    the byte. IRQ_ENABLE (offset 2) raises IRQ while any of its bits are
+    also set in STATUS. Other offsets read as 0.
+
+    Each access to DATA moves exactly one byte, even when the bus holds it
+    for two cycles. A read takes its byte once the CPU has moved on, so the
+    read an indexed store (STA DATA,X) makes before writing takes nothing,
+    and a read-modify-write instruction (INC DATA) takes one.
+
+    The USB side is clocked by usb_domain: the OUT endpoint writes rx_data
+    with rx_we while rx_writable, and the IN endpoint reads tx_data with
+    tx_re while tx_readable."""
+
+    def __init__(self, platform, usb_domain="usb_12", depth=16):
+        super().__init__(platform)
+        self.submodules.rx = rx = StreamCrossing(usb_domain, "sys", depth=depth)
+        self.submodules.tx = tx = StreamCrossing("sys", usb_domain, depth=depth)
+
+        self.rx_data = rx.din
+        self.rx_we = rx.we
+        self.rx_writable = rx.writable
+        self.tx_data = tx.dout
+        self.tx_re = tx.re
+        self.tx_readable = tx.readable
+
+        status = Signal(8)
+        irq_enable = Signal(8)
+        access = self.access()[0]
+        start, read_done, cancelled, offset = self.completed_reads(access)
+        self.comb += [
+            status.eq(Cat(rx.readable, tx.writable)),
+            rx.re.eq(read_done & (offset == DATA)),
+            tx.din.eq(self.data_in),
+            tx.we.eq(access & self.we & (self.address == DATA)),
+            self.irq.eq((status & irq_enable) != 0)
+            ]
+        self.sync += [
+            If(access & self.we & (self.address == IRQ_ENABLE),
+                irq_enable.eq(self.data_in)
+            ),
+            If(access,
+                Case(self.address, {
+                    DATA: self.data_out.eq(Mux(rx.readable, rx.dout, 0)),
+                    STATUS: self.data_out.eq(status),
+                    IRQ_ENABLE: self.data_out.eq(irq_enable),
+                    "default": self.data_out.eq(0)})
+            )
+            ]
@@ -1,15 +1,73 @@
 from migen import *
-from migen.genlib.fsm import FSM
+from migen.genlib.fifo import SyncFIFO
 
 from fomu_6502_bus import Bus6502
 
+# Register offsets. DATA and ADDRESS are 32 bits, little endian.
+DATA = 0
+ADDRESS = 4
+CONTROL = 8
+STREAM = 9
+STATUS = 10
+
+# CONTROL bits.
+INCREMENT = 0x01
+READ_AHEAD = 0x02
+POSTED = 0x04
+
+# STATUS bits.
+ERROR = 0x01
+BUSY = 0x02
+
 class FomuBridge(Bus6502, Module):
-    def __init__(self, platform):
+    """The 6502's window onto a Wishbone bus.
+
+    Word at a time: write ADDRESS, then reading DATA byte 0 reads the word
+    at ADDRESS into DATA, and writing DATA byte 3 writes DATA to ADDRESS.
+    The CPU is held with RDY until the cycle finishes, so the byte 0 read
+    returns the new word. With INCREMENT set in CONTROL, ADDRESS moves on
+    by one after each of these.
+
+    Byte at a time: STREAM reads the words from ADDRESS upwards a byte at a
+    time, least significant byte first, and writes gather bytes into words
+    the same way, writing each to ADDRESS as its fourth byte arrives.
+    ADDRESS always moves on after a stream word. With READ_AHEAD set the
+    next word is fetched while the CPU is taking bytes from the last, so a
+    STREAM read only stalls when the bus is slower than the CPU; otherwise
+    each word is fetched when its first byte is read. Stop READ_AHEAD before
+    changing ADDRESS, or the words already fetched from the old ADDRESS come
+    out first. Writing CONTROL throws away any bytes the stream has
+    buffered.
+
+    Writes go through a queue of write_queue words. Normally the CPU waits
+    for each one to finish, but with POSTED set in CONTROL it carries on as
+    soon as the word is queued, and only waits when the queue is full. Reads
+    wait for queued writes to go first. ADDRESS moves on when a word is
+    queued.
+
+    A cycle that ends in ERR or RTY sets ERROR in STATUS (write it back to
+    clear it) and pulses NMI; a failed read returns 0. With posted writes
+    the error comes some time after the write that caused it. BUSY in STATUS
+    is set while a cycle is in progress or writes are queued, so polling it
+    waits for posted writes to finish.
+
+    Each access acts once however many cycles the bus holds it for. Reads
+    of DATA byte 0, and STREAM reads with no byte ready, hold the CPU for a
+    cycle first to see whether it is about to write the same register, as
+    an indexed store reads its target the cycle before writing it; if so
+    the read starts no bus cycle. A STREAM read takes its byte once the CPU
+    has moved on, so the indexed store's read takes nothing, and a
+    read-modify-write instruction takes one byte.
+    """
+
+    def __init__(self, platform, write_queue=4):
         super().__init__(platform)
 
         # Internal registers.
         self.address_reg = Signal(32)
         self.data_reg = Signal(32)
+        self.control = Signal(8)
+        error = Signal()
 
         # Wishbone signals.
         self.wishbone_adr_o = Signal(32)
@@ -19,86 +77,198 @@ class FomuBridge(Bus6502, Module):
         self.wishbone_cyc_o = Signal()
         self.wishbone_err_i = Signal()
         self.wishbone_rty_i = Signal()
-        self.wishbone_sel_o = Signal()
+        self.wishbone_sel_o = Signal(4)
         self.wishbone_stb_o = Signal()
         self.wishbone_we_o = Signal()
 
-        # The wishbone address is always whatever we're given in the
-        # address register.
+        access, offset = self.access()
+        start, read_done, cancelled, run_offset = self.completed_reads(access)
+        writing = Signal()
+        self.comb += writing.eq(access & self.we)
+
+        # Queued writes, address above data.
+        self.submodules.queue = queue = SyncFIFO(64, write_queue)
+
+        # Outstanding work. The CPU waits for reads, and for writes unless
+        # they are posted. peek holds it for a cycle after a read that may
+        # be an indexed store's.
+        peek = Signal()
+        word_read = Signal()
+        stream_wait = Signal()
+        writing_back = Signal()
         self.comb += [
-            self.wishbone_adr_o.eq(self.address_reg)
+            writing_back.eq(Mux(self.control[2], ~queue.writable,
+                queue.readable | (self.wishbone_cyc_o & self.wishbone_we_o))),
+            self.rdy.eq(~(peek | word_read | stream_wait | writing_back))
             ]
-        
-        # Rule is that a write to the MSB of the data triggers a write,
-        # and a read from the LSB of the data triggers a read. The other
-        # bits of the data are not affected until those actions take place.
-        # Bear in mind that 6502s have a bad habit of double-reads with
-        # some instructions, and so care must be taken not to accidentally
-        # read twice!
-
-        # Layout of our registers is just DATA, ADDRESS, sequentially as
-        # bytes in 6502-space.
-
-        is_read_to_lsb = self.cs & (self.address == 0x00) & ~self.we
-        is_write_to_msb = self.cs & (self.address == 0x03) & self.we
-
-        # Regardless of what else you do, we always read/write from the
-        # relevant registers. Because we're given CS early this can be
-        # sync.
+
+        # Stream state: cur holds the bytes of the current read word still
+        # to be taken, next the prefetched word; gather collects written
+        # bytes until there are four.
+        cur = Signal(32)
+        cur_count = Signal(3)
+        next_word = Signal(32)
+        next_valid = Signal()
+        stream_ready = Signal()
+        stream_out = Signal(8)
+        gather = Signal(32)
+        gather_count = Signal(2)
+        self.comb += [
+            stream_ready.eq((cur_count != 0) | next_valid),
+            stream_out.eq(Mux(cur_count != 0, cur[:8], next_word[:8]))
+            ]
+
+        # The bus cycle in progress, and what it is for.
+        WORD, WRITE, FILL = range(3)
+        kind = Signal(2)
+        cancel = Signal()
+        done = Signal()
+        failed = Signal()
+        fill = Signal()
+        self.comb += [
+            done.eq(self.wishbone_cyc_o & (self.wishbone_ack_i | self.wishbone_err_i | self.wishbone_rty_i)),
+            failed.eq(self.wishbone_err_i | self.wishbone_rty_i),
+            fill.eq(~next_valid & (self.control[1] | (stream_wait & (cur_count == 0)))),
+            self.wishbone_stb_o.eq(self.wishbone_cyc_o),
+            self.wishbone_sel_o.eq(0xF),
+            queue.re.eq(~self.wishbone_cyc_o),
+            ]
+
+        # Start the most urgent piece of work when the bus is free.
+        self.sync += If(~self.wishbone_cyc_o,
+            self.wishbone_adr_o.eq(self.address_reg),
+            If(queue.readable,
+                self.wishbone_cyc_o.eq(1),
+                self.wishbone_we_o.eq(1),
+                self.wishbone_adr_o.eq(queue.dout[32:]),
+                self.wishbone_dat_o.eq(queue.dout[:32]),
+                kind.eq(WRITE)
+            ).Elif(word_read,
+                self.wishbone_cyc_o.eq(1),
+                self.wishbone_we_o.eq(0),
+                kind.eq(WORD)
+            ).Elif(fill,
+                self.wishbone_cyc_o.eq(1),
+                self.wishbone_we_o.eq(0),
+                kind.eq(FILL)
+            )
+        ).Elif(done,
+            self.wishbone_cyc_o.eq(0)
+        )
+
+        # Words written are queued in the cycle the CPU writes their last
+        # byte; the CPU is held before the queue can overflow.
+        last_byte = Signal()
+        self.comb += [
+            last_byte.eq((self.address[:4] == STREAM) & (gather_count == 3)),
+            queue.we.eq(writing & ((self.address[:4] == 3) | last_byte)),
+            queue.din.eq(Cat(Mux(last_byte, gather[8:], self.data_reg[:24]), self.data_in, self.address_reg)),
+            ]
+
+        read_data = Signal(32)
+        self.comb += read_data.eq(Mux(failed, 0, self.wishbone_dat_i))
+
+        # ADDRESS moves on by one for each word read or queued, which can
+        # happen together (a prefetch finishing as a word is written), unless
+        # the CPU writes it.
+        step = Signal(2)
+        self.comb += step.eq(
+            (done & (((kind == WORD) & self.control[0]) | ((kind == FILL) & ~cancel))) +
+            (writing & (((self.address[:4] == 3) & self.control[0]) | last_byte)))
+
         self.sync += [
-            Case(self.address, {
-                0: self.data_out.eq(self.data_reg[0]),
-                1: self.data_out.eq(self.data_reg[1]),
-                2: self.data_out.eq(self.data_reg[2]),
-                3: self.data_out.eq(self.data_reg[3]),
-                4: self.data_out.eq(self.address_reg[0]),
-                5: self.data_out.eq(self.address_reg[1]),
-                6: self.data_out.eq(self.address_reg[2]),
-                7: self.data_out.eq(self.address_reg[3])})
-                ]
-
-        # FSM to manage interaction with wishbone.
-        sm = FSM(reset_state="RESET")
-        self.submodules += sm
-        sm.act("RESET",
-                   NextValue(self.wishbone_cyc_o, False),
-                   NextValue(self.wishbone_stb_o, False),
-                   NextValue(self.nmi, False),
-                   NextState("IDLE"))
-        sm.act("IDLE",
-                   If(is_read_to_lsb, NextState("START_READ")),
-                   If(is_write_to_msb, NextState("START_WRITE")))
-        sm.act("START_READ",
-                   NextValue(self.rdy, False), # Pause the 6502.
-                   NextValue(self.wishbone_cyc_o, True), # Start the wishbone cycle.
-                   NextValue(self.wishbone_stb_o, True), # Trigger the strobe
-                   NextValue(self.wishbone_we_o, False), # We're reading.
-                   If(self.wishbone_ack_i, NextState("READ_COMPLETE")),
-                   If(self.wishbone_rty_i | self.wishbone_err_i,
-                          NextValue(self.nmi, True),
-                          NextState("RESET"))
-                   )
-        sm.act("READ_COMPLETE",
-                   NextValue(self.rdy, True), # Let the 6502 know we're done.
-                   NextValue(self.wishbone_cyc_o, False), # Wishbone cycle complete.
-                   NextValue(self.wishbone_stb_o, False), # Strobe low too.
-                   NextValue(self.data_reg, self.wishbone_dat_i), # Save the read data.
-                   NextState("IDLE"))
-        sm.act("START_WRITE",
-                   NextValue(self.rdy, False), # Tell the 6502 to wait.
-                   NextValue(self.wishbone_cyc_o, True), # Start the wishbone cycle.
-                   NextValue(self.wishbone_stb_o, True), # Strobe active too.
-                   NextValue(self.wishbone_dat_o, self.data_reg), # Send the data.
-                   If(self.wishbone_ack_i, NextState("WRITE_COMPLETE")),
-                   If(self.wishbone_rty_i | self.wishbone_err_i,
-                          NextValue(self.nmi, True),
-                          NextState("RESET"))
-                   )
-        sm.act("WRITE_COMPLETE",
-                   NextValue(self.rdy, True), # Let the 6502 know we're done
-                   NextValue(self.wishbone_cyc_o, False), # Wishbone cycle complete
-                   NextValue(self.wishbone_stb_o, False), # Strobe complete.
-                   NextState("IDLE")
-                   )
-                   
-        
+            self.nmi.eq(done & failed),
+            If(done,
+                If(failed, error.eq(1)),
+                Case(kind, {
+                    WORD: [
+                        self.data_reg.eq(read_data),
+                        word_read.eq(0)
+                    ],
+                    FILL: If(~cancel,
+                        next_word.eq(read_data),
+                        next_valid.eq(1)
+                    ),
+                }),
+                cancel.eq(0)
+            ),
+            If(~writing | (self.address[2:4] != ADDRESS >> 2),
+                self.address_reg.eq(self.address_reg + step)
+            ),
+
+            # A read of DATA byte 0 reads a word, and a STREAM read with no
+            # byte ready waits for one, unless the CPU is about to write the
+            # register, when the read was an indexed store's.
+            If(start & ~self.we & ((self.address[:4] == DATA) |
+                                   ((self.address[:4] == STREAM) & ~stream_ready)),
+                peek.eq(1)
+            ),
+            If(peek,
+                peek.eq(0),
+                If(~(self.write_waiting & (self.address[:4] == run_offset)),
+                    If(run_offset == DATA,
+                        word_read.eq(1)
+                    ).Else(
+                        stream_wait.eq(1)
+                    )
+                )
+            ),
+            If(stream_wait & stream_ready,
+                stream_wait.eq(0)
+            ),
+
+            # Stream reads take from cur, then from the prefetched word, once
+            # the CPU has moved on.
+            If(read_done & (run_offset == STREAM),
+                If(cur_count != 0,
+                    cur.eq(cur[8:]),
+                    cur_count.eq(cur_count - 1)
+                ).Elif(next_valid,
+                    cur.eq(next_word[8:]),
+                    cur_count.eq(3),
+                    next_valid.eq(0)
+                )
+            ),
+
+            # Register writes from the CPU.
+            If(writing,
+                Case(self.address[:4], {
+                    0: self.data_reg[0:8].eq(self.data_in),
+                    1: self.data_reg[8:16].eq(self.data_in),
+                    2: self.data_reg[16:24].eq(self.data_in),
+                    3: self.data_reg[24:32].eq(self.data_in),
+                    4: self.address_reg[0:8].eq(self.data_in),
+                    5: self.address_reg[8:16].eq(self.data_in),
+                    6: self.address_reg[16:24].eq(self.data_in),
+                    7: self.address_reg[24:32].eq(self.data_in),
+                    CONTROL: [
+                        self.control.eq(self.data_in),
+                        cur_count.eq(0),
+                        next_valid.eq(0),
+                        gather_count.eq(0),
+                        If(self.wishbone_cyc_o & (kind == FILL), cancel.eq(1))
+                    ],
+                    STREAM: [
+                        gather.eq(Cat(gather[8:], self.data_in)),
+                        gather_count.eq(gather_count + 1)
+                    ],
+                    STATUS: If(self.data_in[0], error.eq(0)),
+                    "default": []
+                })
+            )
+            ]
+
+        self.comb += Case(offset, {
+            0: self.data_out.eq(self.data_reg[0:8]),
+            1: self.data_out.eq(self.data_reg[8:16]),
+            2: self.data_out.eq(self.data_reg[16:24]),
+            3: self.data_out.eq(self.data_reg[24:32]),
+            4: self.data_out.eq(self.address_reg[0:8]),
+            5: self.data_out.eq(self.address_reg[8:16]),
+            6: self.data_out.eq(self.address_reg[16:24]),
+            7: self.data_out.eq(self.address_reg[24:32]),
+            CONTROL: self.data_out.eq(self.control),
+            STREAM: self.data_out.eq(stream_out),
+            STATUS: self.data_out.eq(Cat(error, self.wishbone_cyc_o | queue.readable)),
+            "default": self.data_out.eq(0)
+            })
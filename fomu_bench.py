@@ -0,0 +1,194 @@
+import datetime
+import json
+import os
+import re
+import subprocess
+
+from migen.fhdl.tools import list_inputs, list_targets, list_signals, list_special_ios
+from migen.fhdl.verilog import convert
+from fomu_flow import Stage, parse_nextpnr_timing
+
+# What the benchmark counts, by yosys cell type.
+CELL_CLASSES = {
+    "SB_LUT4": "luts",
+    "SB_CARRY": "carries",
+    "SB_RAM40_4K": "ebrs",
+    "SB_SPRAM256KA": "sprams",
+    "SB_MAC16": "dsps",
+    }
+
+_UTILISATION = re.compile(r"^Info:\s+(\w+):\s+(\d+)/\s*(\d+)", re.MULTILINE)
+
+def _reads(f):
+    return list_inputs(f) | list_special_ios(f, True, False, True)
+
+def _drives(f):
+    return list_targets(f) | list_special_ios(f, False, True, True)
+
+def submodule_fragments(soc):
+    """Finalise each named submodule of an elaborated (but not yet built)
+    SoC on its own. Returns {name: fragment}, plus the SoC's own logic
+    under None. The SoC can't be built after this."""
+    fragments = {name: module.get_fragment() for name, module in soc._submodules if name}
+    fragments[None] = soc._fragment
+    return fragments
+
+def submodule_ports(fragments, name, pads):
+    """The signals that have to be ports of submodule name when it is
+    synthesised on its own: whatever it reads but doesn't drive, whatever
+    it drives that the rest of the SoC reads, and any pads it uses."""
+    f = fragments[name]
+    drives = _drives(f)
+    elsewhere = set()
+    for other, g in fragments.items():
+        if other != name:
+            elsewhere |= _reads(g)
+    signals = list_signals(f) | list_special_ios(f, True, True, True)
+    return (_reads(f) - drives) | (drives & elsewhere) | (signals & pads)
+
+def cell_counts(netlist, top):
+    """Counts of the CELL_CLASSES (and flip-flops) in a yosys JSON netlist."""
+    with open(netlist) as f:
+        cells = json.load(f)["modules"][top]["cells"].values()
+    counts = {name: 0 for name in CELL_CLASSES.values()}
+    counts["dffs"] = 0
+    for cell in cells:
+        if cell["type"] in CELL_CLASSES:
+            counts[CELL_CLASSES[cell["type"]]] += 1
+        elif cell["type"].startswith("SB_DFF"):
+            counts["dffs"] += 1
+    return counts
+
+def parse_nextpnr_utilisation(log):
+    """Returns {bel type: (used, available)} from a nextpnr log."""
+    return {bel: (int(used), int(available)) for bel, used, available in _UTILISATION.findall(log)}
+
+def synthesise_submodules(flow, platform, soc):
+    """Synthesise each submodule of soc out of context, through flow's
+    build cache, into <build_dir>/bench. Returns {name: cell counts}.
+
+    Numbers from out-of-context synthesis miss any optimisation across the
+    submodule's boundary, but they move when the submodule does."""
+    bench_dir = os.path.join(flow.build_dir, "bench")
+    os.makedirs(bench_dir, exist_ok=True)
+    fragments = submodule_fragments(soc)
+    pads = platform.constraint_manager.get_io_signals()
+    overrides = platform.toolchain.special_overrides
+    results = {}
+    for name in sorted(n for n in fragments if n is not None):
+        # Prefixed, so the cpu submodule doesn't clash with cpu.v's module.
+        top = "bench_" + name
+        ports = submodule_ports(fragments, name, pads)
+        convert(fragments[name], ports, name=top, special_overrides=overrides).write(
+            os.path.join(bench_dir, top + ".v"))
+        with open(os.path.join(bench_dir, top + ".ys"), "w") as f:
+            for source, language, library in sorted(platform.sources):
+                f.write("read_" + language + " " + source + "\n")
+            f.write("read_verilog " + top + ".v\n")
+            f.write("synth_ice40 -top " + top + " -json " + top + ".json\n")
+        flow.run_stage(Stage("yosys -q -l " + top + ".rpt " + top + ".ys", bench_dir, name="synth " + name))
+        results[name] = cell_counts(os.path.join(bench_dir, top + ".json"), top)
+    return results
+
+def synthesise_cores(flow, sources):
+    """Synthesise each CPU core on its own, through flow's build cache, into
+    <build_dir>/bench. sources is {variant: Verilog files}, as in
+    fomu_6502_cpu.CPU_SOURCES. Returns {variant: cell counts}, so the cost
+    of a variant can be read off against the standard core whichever one
+    the SoC was built with."""
+    bench_dir = os.path.join(flow.build_dir, "bench")
+    os.makedirs(bench_dir, exist_ok=True)
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for variant, files in sorted(sources.items()):
+        name = "core_" + variant
+        with open(os.path.join(bench_dir, name + ".ys"), "w") as f:
+            for source in files:
+                f.write("read_verilog " + os.path.join(base_dir, source) + "\n")
+            f.write("synth_ice40 -top cpu -json " + name + ".json\n")
+        flow.run_stage(Stage("yosys -q -l " + name + ".rpt " + name + ".ys", bench_dir, name="synth " + name))
+        results[variant] = cell_counts(os.path.join(bench_dir, name + ".json"), "cpu")
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_record(flow, revision, sys_clk_freq, submodules, cpu_variant="standard", cores=None):
+    """One history entry, from a finished flow, synthesise_submodules() and
+    synthesise_cores()."""
+    with open(os.path.join(flow.build_dir, flow.build_name + "_pnr.log")) as f:
+        log = f.read()
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_revision(),
+        "revision": revision,
+        "cpu_variant": cpu_variant,
+        "sys_clk_freq": sys_clk_freq,
+        "utilisation": parse_nextpnr_utilisation(log),
+        "fmax": {clock: fmax for clock, (fmax, target) in parse_nextpnr_timing(log).items()},
+        "submodules": submodules,
+        "cores": cores or {},
+        }
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def append_history(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def regressions(record, history, max_lut_growth=2.0, max_fmax_drop=5.0):
+    """Compare record against the last entry in history for the same
+    revision, CPU variant and clock that didn't itself regress. Returns a
+    list of complaints, empty if LUT usage grew by no more than
+    max_lut_growth percent and no clock's Fmax fell by more than
+    max_fmax_drop percent."""
+    previous = [r for r in history
+                if r["revision"] == record["revision"] and r["sys_clk_freq"] == record["sys_clk_freq"]
+                and r.get("cpu_variant", "standard") == record.get("cpu_variant", "standard")
+                and not r.get("regressions")]
+    if not previous:
+        return []
+    previous = previous[-1]
+    complaints = []
+
+    luts = record["utilisation"].get("ICESTORM_LC", (0, 0))[0]
+    old_luts = previous["utilisation"].get("ICESTORM_LC", (0, 0))[0]
+    if old_luts and (luts - old_luts) * 100 / old_luts > max_lut_growth:
+        complaints.append("Logic cells went from "+str(old_luts)+" to "+str(luts)+
+                          " since "+str(previous["commit"]))
+    for clock, old_fmax in previous["fmax"].items():
+        fmax = record["fmax"].get(clock)
+        if fmax is not None and (old_fmax - fmax) * 100 / old_fmax > max_fmax_drop:
+            complaints.append("Fmax of "+clock+" went from %.2f to %.2f MHz since " % (old_fmax, fmax)+
+                              str(previous["commit"]))
+    return complaints
+
+def print_record(record):
+    print("Utilisation:")
+    for bel, (used, available) in sorted(record["utilisation"].items()):
+        print("  {:<16} {:>5}/{:<5}".format(bel, used, available))
+    print("Fmax:")
+    for clock, fmax in sorted(record["fmax"].items()):
+        print("  {:<32} {:.2f} MHz".format(clock, fmax))
+    print("Submodules (synthesised out of context):")
+    for name, counts in sorted(record["submodules"].items()):
+        print("  {:<16} {:>5} LUTs, {:>5} DFFs, {:>4} carries, {} EBRs, {} SPRAMs, {} DSPs".format(
+            name, counts["luts"], counts["dffs"], counts["carries"], counts["ebrs"], counts["sprams"],
+            counts["dsps"]))
+    if record.get("cores"):
+        print("CPU cores (synthesised on their own; built with "+record["cpu_variant"]+"):")
+        standard = record["cores"].get("standard")
+        for variant, counts in sorted(record["cores"].items()):
+            line = "  {:<16} {:>5} LUTs, {:>5} DFFs, {:>4} carries".format(
+                variant, counts["luts"], counts["dffs"], counts["carries"])
+            if standard is not None and variant != "standard":
+                line += " ({:+d} LUTs on standard)".format(counts["luts"] - standard["luts"])
+            print(line)
@@ -0,0 +1,23 @@
+from migen import *
+from migen.genlib.fifo import AsyncFIFO
+
+# cd_sys (the CPU) and cd_usb_12/cd_usb_48 (USB) run from unrelated clocks,
+# so nothing may pass between them except through these. Single level
+# signals, such as status flags, should go through a MultiReg instead, and
+# single-cycle strobes through a PulseSynchronizer.
+
+class StreamCrossing(Module):
+    """Stream of words from one clock domain to another, through an
+    AsyncFIFO. The write side (din, we, writable) is clocked by from_domain
+    and the read side (dout, re, readable) by to_domain. dout is valid
+    whenever readable is high; re pops it."""
+    def __init__(self, from_domain, to_domain, width=8, depth=16):
+        fifo = ClockDomainsRenamer({"write": from_domain, "read": to_domain})(AsyncFIFO(width, depth))
+        self.submodules.fifo = fifo
+
+        self.din = fifo.din
+        self.we = fifo.we
+        self.writable = fifo.writable
+        self.dout = fifo.dout
+        self.re = fifo.re
+        self.readable = fifo.readable
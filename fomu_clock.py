@@ -1,95 +1,157 @@
 from migen import ClockDomain, Signal, Module, Instance, If
 from migen.genlib.resetsync import AsyncResetSynchronizer
+from collections import namedtuple
+
+PLLConfig = namedtuple("PLLConfig", ("divr", "divf", "divq", "half", "filter_range", "frequency"))
+
+def _filter_range(f_pfd):
+    # Loop filter setting for a given phase detector frequency, as icepll picks it.
+    for limit, setting in ((17e6, 1), (26e6, 2), (44e6, 3), (66e6, 4), (101e6, 5)):
+        if f_pfd < limit:
+            return setting
+    return 6
+
+def pll_config(f_in, f_out):
+    """Find the SB_PLL40_CORE settings (simple feedback) whose output is
+    closest to f_out, searching the same space icepll does. With half set,
+    the PLL is run at twice f_out and PLLOUT_SELECT is GENCLK_HALF, which is
+    the only way to get below the 16MHz output minimum."""
+    best = None
+    for divr in range(16):
+        f_pfd = f_in / (divr + 1)
+        if not 10e6 <= f_pfd <= 133e6:
+            continue
+        for divf in range(128):
+            f_vco = f_pfd * (divf + 1)
+            if not 533e6 <= f_vco <= 1066e6:
+                continue
+            for divq in range(1, 7):
+                f_pll = f_vco / (1 << divq)
+                if not 16e6 <= f_pll <= 275e6:
+                    continue
+                for half in (False, True):
+                    f = f_pll / 2 if half else f_pll
+                    # Prefer the full-rate output when it's just as close.
+                    if best is None or (abs(f - f_out), half) < (abs(best.frequency - f_out), best.half):
+                        best = PLLConfig(divr, divf, divq, half, _filter_range(f_pfd), f)
+    if best is None:
+        raise ValueError("No PLL configuration for "+str(f_in/1e6)+"MHz in")
+    return best
 
 class CRG(Module):
-    def __init__(self, platform, use_pll):
+    """Clock/reset generator. cd_usb_48 is the 48MHz oscillator and cd_usb_12
+    a quarter of it, for the USB core. cd_sys, which runs the CPU, comes from
+    the PLL at sys_clk_freq; without the PLL it can only be 12MHz. The
+    domains are asynchronous to each other, so anything passing between
+    them must go through fomu_cdc."""
+    def __init__(self, platform, use_pll, sys_clk_freq=12e6):
         clk48_raw = platform.request("clk48")
+        clk48 = Signal()
         clk12 = Signal()
+        pll_lock = Signal(reset=1)
 
         reset_delay = Signal(4, reset=4)
-        self.clock_domains.cd_por = ClockDomain()
+        self.clock_domains.cd_por = ClockDomain("por")
         self.reset = Signal()
 
-        self.clock_domains.cd_sys = ClockDomain()
-        self.clock_domains.cd_usb_12 = ClockDomain()
-        self.clock_domains.cd_usb_48 = ClockDomain()
-
-        platform.add_period_constraint(self.cd_usb_48.clk, 1e9/48e6)
-        platform.add_period_constraint(self.cd_sys.clk, 1e9/12e6)
-        platform.add_period_constraint(self.cd_usb_12.clk, 1e9/12e6)
-        platform.add_period_constraint(clk48_raw, 1e9/48e6)
-
-        # POR reset logic- POR generated from sys clk, POR logic feeds sys clk
-        # reset.
-        self.comb += [
-            self.cd_por.clk.eq(self.cd_sys.clk),
-            self.cd_sys.rst.eq(reset_delay != 0),
-            self.cd_usb_12.rst.eq(reset_delay != 0),
-        ]
+        self.clock_domains.cd_sys = ClockDomain("sys")
+        self.clock_domains.cd_usb_12 = ClockDomain("usb_12")
+        self.clock_domains.cd_usb_48 = ClockDomain("usb_48")
 
         if use_pll:
-            # POR reset logic- POR generated from sys clk, POR logic feeds sys clk
-            # reset.
-            self.comb += [
-                self.cd_usb_48.rst.eq(reset_delay != 0),
-            ]
-
-            self.comb += self.cd_usb_48.clk.eq(clk48_raw)
+            pll = pll_config(platform.clk_freq, sys_clk_freq)
+            if pll.frequency != sys_clk_freq:
+                print("Warning: Closest PLL setting gives a "+str(pll.frequency/1e6)+
+                      "MHz sys clock, not "+str(sys_clk_freq/1e6)+"MHz.")
+            self.sys_clk_freq = pll.frequency
+            clk_sys = Signal()
 
             self.specials += Instance(
                 "SB_PLL40_CORE",
                 # Parameters
-                p_DIVR = 0,
-                p_DIVF = 15,
-                p_DIVQ = 5,
-                p_FILTER_RANGE = 1,
+                p_DIVR = pll.divr,
+                p_DIVF = pll.divf,
+                p_DIVQ = pll.divq,
+                p_FILTER_RANGE = pll.filter_range,
                 p_FEEDBACK_PATH = "SIMPLE",
                 p_DELAY_ADJUSTMENT_MODE_FEEDBACK = "FIXED",
                 p_FDA_FEEDBACK = 15,
                 p_DELAY_ADJUSTMENT_MODE_RELATIVE = "FIXED",
                 p_FDA_RELATIVE = 0,
                 p_SHIFTREG_DIV_MODE = 1,
-                p_PLLOUT_SELECT = "GENCLK_HALF",
+                p_PLLOUT_SELECT = "GENCLK_HALF" if pll.half else "GENCLK",
                 p_ENABLE_ICEGATE = 0,
                 # IO
                 i_REFERENCECLK = clk48_raw,
-                o_PLLOUTCORE = clk12,
-                # o_PLLOUTGLOBAL = clk12,
+                o_PLLOUTCORE = clk_sys,
+                # o_PLLOUTGLOBAL = clk_sys,
                 #i_EXTFEEDBACK,
                 #i_DYNAMICDELAY,
-                #o_LOCK,
+                o_LOCK = pll_lock,
                 i_BYPASS = 0,
                 i_RESETB = 1,
                 #i_LATCHINPUTVALUE,
                 #o_SDO,
                 #i_SDI,
             )
+            self.comb += [
+                self.cd_usb_48.clk.eq(clk48_raw),
+                self.cd_sys.clk.eq(clk_sys),
+            ]
         else:
-            clk48 = Signal()
-            clk12_raw = Signal()
+            if sys_clk_freq != 12e6:
+                raise ValueError("Without the PLL the sys clock can only be 12MHz")
+            self.sys_clk_freq = sys_clk_freq
             self.specials += Instance(
                 "SB_GB",
                 i_USER_SIGNAL_TO_GLOBAL_BUFFER=clk48_raw,
                 o_GLOBAL_BUFFER_OUTPUT=clk48,
             )
-            self.comb += self.cd_usb_48.clk.eq(clk48)
-
-            clk12_counter = Signal(2)
-            self.sync.usb_48 += clk12_counter.eq(clk12_counter + 1)
+            self.comb += [
+                self.cd_usb_48.clk.eq(clk48),
+                self.cd_sys.clk.eq(clk12),
+            ]
 
-            self.comb += clk12_raw.eq(clk12_counter[1])
-            self.specials += Instance(
-                "SB_GB",
-                i_USER_SIGNAL_TO_GLOBAL_BUFFER=clk12_raw,
-                o_GLOBAL_BUFFER_OUTPUT=clk12,
-            )
+        # USB always gets 12MHz from dividing down the 48MHz clock.
+        clk12_counter = Signal(2)
+        clk12_raw = Signal()
+        self.sync.usb_48 += clk12_counter.eq(clk12_counter + 1)
 
-        self.comb += self.cd_sys.clk.eq(clk12)
+        self.comb += clk12_raw.eq(clk12_counter[1])
+        self.specials += Instance(
+            "SB_GB",
+            i_USER_SIGNAL_TO_GLOBAL_BUFFER=clk12_raw,
+            o_GLOBAL_BUFFER_OUTPUT=clk12,
+        )
         self.comb += self.cd_usb_12.clk.eq(clk12)
 
+        platform.add_period_constraint(self.cd_usb_48.clk, 1e9/48e6)
+        platform.add_period_constraint(self.cd_sys.clk, 1e9/self.sys_clk_freq)
+        platform.add_period_constraint(self.cd_usb_12.clk, 1e9/12e6)
+        platform.add_period_constraint(clk48_raw, 1e9/48e6)
+
+        # POR reset logic runs from the oscillator, so it works whatever the
+        # PLL is doing, and holds everything in reset until the PLL locks.
+        # Each domain gets its own synchronised copy of the reset.
+        self.comb += self.cd_por.clk.eq(clk48_raw)
         self.sync.por += \
             If(reset_delay != 0,
                 reset_delay.eq(reset_delay - 1)
             )
-        self.specials += AsyncResetSynchronizer(self.cd_por, self.reset)
+        self.specials += AsyncResetSynchronizer(self.cd_por, self.reset | ~pll_lock)
+        for cd in (self.cd_sys, self.cd_usb_12, self.cd_usb_48):
+            self.specials += AsyncResetSynchronizer(cd, reset_delay != 0)
+
+
+class SimCRG(Module):
+    """Clock/reset generator for migen simulation. run_simulation drives
+    sys_clk itself, so all that's left is the power-on reset."""
+    def __init__(self):
+        reset_delay = Signal(4, reset=4, reset_less=True)
+        self.clock_domains.cd_sys = ClockDomain("sys")
 
+        self.comb += self.cd_sys.rst.eq(reset_delay != 0)
+        self.sync += \
+            If(reset_delay != 0,
+                reset_delay.eq(reset_delay - 1)
+            )
@@ -0,0 +1,357 @@
+from migen import *
+from migen.genlib.fsm import FSM
+from fomu_6502_bus import Bus6502
+
+# Fast Read Quad I/O. The command goes out on DQ0 alone; the address, mode
+# byte and data use all four lines, with four dummy clocks before the data.
+# It needs the QE bit (bit 1 of status register 2) set, which FomuFlashROM
+# does at reset.
+QUAD_IO_READ = 0xEB
+DUMMY_CLOCKS = 4
+
+# Single line commands for setting QE. The status registers are written
+# together, SR1 then SR2, after a volatile write enable, so nothing is
+# programmed into the flash and the protection bits in SR1 are kept.
+READ_STATUS_1 = 0x05
+READ_STATUS_2 = 0x35
+VOLATILE_WRITE_ENABLE = 0x50
+WRITE_STATUS = 0x01
+
+class FomuFlashROM(Bus6502, Module):
+    """Execute-in-place window onto the SPI flash, read in quad I/O mode.
+
+    Reads go through a direct-mapped cache of line_bytes-byte lines held in
+    block RAM. A hit answers in a single cycle like any other ROM; a miss
+    holds RDY low while the whole line is read from flash (20 + 2*line_bytes
+    SPI clocks, at half the sys clock), then replays the access. The cache
+    is never written by the CPU, and writes to the window are ignored.
+
+    Out of reset the status registers are read, and if QE is clear it is
+    set, in volatile status; until then accesses to the window wait.
+
+    flash_base is where the window starts in flash, and size is the size of
+    the window. With simulation=True the pads are replaced by SimSPIFlash,
+    holding image, so migen's simulator can run it."""
+
+    def __init__(self, platform, pads=None, size=0x3c00, flash_base=0x80000,
+                 line_bytes=32, lines=32, simulation=False, image=None):
+        super().__init__(platform)
+
+        offset_bits = log2_int(line_bytes)
+        index_bits = log2_int(lines)
+        address_bits = bits_for(size - 1)
+        tag_bits = max(address_bits - offset_bits - index_bits, 1)
+
+        # Flash pins. The clock runs at half the sys clock, and output data
+        # changes while it is low.
+        self.cs_n = Signal(reset=1)
+        self.sclk = Signal()
+        self.dq_o = Signal(4)
+        self.dq_oe = Signal(4)
+        self.dq_i = Signal(4)
+
+        if simulation:
+            self.submodules.flash = flash = SimSPIFlash(image or [], flash_base)
+            self.comb += [
+                flash.cs_n.eq(self.cs_n),
+                flash.sclk.eq(self.sclk),
+                flash.dq_i.eq(self.dq_o),
+                self.dq_i.eq(flash.dq_o)
+                ]
+        else:
+            # Each line has its own output enable, so DQ1 can be read while
+            # WP# and HOLD# are still driven.
+            for i in range(4):
+                dq = TSTriple()
+                self.specials += dq.get_tristate(pads.dq[i])
+                self.comb += [
+                    dq.o.eq(self.dq_o[i]),
+                    dq.oe.eq(self.dq_oe[i]),
+                    self.dq_i[i].eq(dq.i)
+                    ]
+            self.comb += [
+                pads.cs_n.eq(self.cs_n),
+                pads.clk.eq(self.sclk)
+                ]
+
+        # Cache storage. Tag entries are the tag with a valid bit on top;
+        # block RAM starts out zeroed, so every line starts invalid.
+        data = Memory(8, line_bytes * lines)
+        tags = Memory(tag_bits + 1, lines)
+        data_rd = data.get_port()
+        data_wr = data.get_port(write_capable=True)
+        tag_rd = tags.get_port()
+        tag_wr = tags.get_port(write_capable=True)
+        self.specials += data, tags, data_rd, data_wr, tag_rd, tag_wr
+
+        # The address the cache read ports were given last cycle, and the
+        # access that missed. While refilling, the read ports are kept on
+        # the access that missed, so that it hits once the line is in.
+        refilling = Signal()
+        read_address = Signal(address_bits)
+        lookup_address = Signal(address_bits)
+        miss_address = Signal(address_bits)
+        was_write = Signal()
+        self.comb += [
+            read_address.eq(Mux(refilling, miss_address, self.address)),
+            data_rd.adr.eq(read_address),
+            tag_rd.adr.eq(read_address[offset_bits:]),
+            self.data_out.eq(data_rd.dat_r)
+            ]
+        self.sync += [
+            lookup_address.eq(read_address),
+            was_write.eq(self.we)
+            ]
+
+        hit = Signal()
+        self.comb += hit.eq(tag_rd.dat_r == Cat(lookup_address[offset_bits + index_bits:], 1))
+
+        # Flash transfer state.
+        command = Signal(8)
+        address_shift = Signal(32)
+        count = Signal(max=max(2 * line_bytes, 24) + 1)
+        line_offset = Signal(offset_bits)
+        high_nibble = Signal(4)
+        nibble = Signal()
+
+        self.comb += data_wr.adr.eq(Cat(line_offset, miss_address[offset_bits:]))
+
+        fsm = FSM(reset_state="INIT")
+        self.submodules += fsm
+        self.comb += self.rdy.eq(~refilling & (~self.cs_slow | was_write | hit))
+
+        # Setting QE. Commands and data go out on DQ0, MSB first, from the
+        # top of init_shift, and DQ1 is shifted into status_in. Each command
+        # gets its own state, which starts by lowering CS# and ends by
+        # raising it, so it is high for a cycle between commands.
+        init_shift = Signal(24)
+        status_in = Signal(8)
+        status_1 = Signal(8)
+        status_2 = Signal(8)
+        last_status = Signal(8)
+        self.comb += last_status.eq(Cat(self.dq_i[1], status_in[:7]))
+
+        def single_line(state, *then):
+            fsm.act(state,
+                refilling.eq(1),
+                self.dq_o.eq(Cat(init_shift[23], 0, 1, 1)), # Hold WP# and HOLD# high
+                self.dq_oe.eq(0b1101),
+                If(self.cs_n,
+                    NextValue(self.cs_n, 0)
+                ).Else(
+                    NextValue(self.sclk, ~self.sclk),
+                    If(self.sclk,
+                        NextValue(init_shift, init_shift << 1),
+                        NextValue(status_in, last_status),
+                        NextValue(count, count - 1),
+                        If(count == 1,
+                            NextValue(self.cs_n, 1),
+                            *then)
+                        )
+                    )
+                )
+
+        def start(command, bits, state):
+            return [
+                NextValue(init_shift, command << (24 - bits)),
+                NextValue(count, bits),
+                NextState(state)
+                ]
+
+        fsm.act("INIT",
+            refilling.eq(1),
+            *start(READ_STATUS_1 << 8, 16, "READ_STATUS_1")
+            )
+        single_line("READ_STATUS_1",
+            NextValue(status_1, last_status),
+            *start(READ_STATUS_2 << 8, 16, "READ_STATUS_2"))
+        single_line("READ_STATUS_2",
+            If(last_status[1],
+                NextState("IDLE")
+            ).Else(
+                NextValue(status_2, last_status | 0x02),
+                *start(VOLATILE_WRITE_ENABLE, 8, "WRITE_ENABLE")
+            ))
+        single_line("WRITE_ENABLE",
+            *start(Cat(status_2, status_1, Constant(WRITE_STATUS, 8)), 24, "WRITE_STATUS"))
+        # Then read SR1 until the write has finished, for flash that treats
+        # it as busy even for volatile status.
+        single_line("WRITE_STATUS",
+            *start(READ_STATUS_1 << 8, 16, "POLL"))
+        single_line("POLL",
+            If(last_status[0],
+                *start(READ_STATUS_1 << 8, 16, "POLL")
+            ).Else(
+                NextState("IDLE")
+            ))
+
+        fsm.act("IDLE",
+            If(self.cs_slow & ~was_write & ~hit,
+                NextValue(miss_address, lookup_address),
+                NextValue(command, QUAD_IO_READ),
+                # Address, then a mode byte of 0 to stay out of continuous
+                # read mode.
+                NextValue(address_shift, Cat(Constant(0, 8),
+                    (flash_base + Cat(Replicate(0, offset_bits), lookup_address[offset_bits:]))[:24])),
+                NextValue(count, 8),
+                NextValue(self.cs_n, 0),
+                NextState("COMMAND"))
+            )
+        fsm.act("COMMAND",
+            refilling.eq(1),
+            self.dq_o.eq(Cat(command[7], 0, 1, 1)), # Hold WP# and HOLD# high
+            self.dq_oe.eq(0b1111),
+            NextValue(self.sclk, ~self.sclk),
+            If(self.sclk,
+                NextValue(command, command << 1),
+                NextValue(count, count - 1),
+                If(count == 1,
+                    NextValue(count, 8),
+                    NextState("ADDRESS"))
+                )
+            )
+        fsm.act("ADDRESS",
+            refilling.eq(1),
+            self.dq_o.eq(address_shift[28:]),
+            self.dq_oe.eq(0b1111),
+            NextValue(self.sclk, ~self.sclk),
+            If(self.sclk,
+                NextValue(address_shift, address_shift << 4),
+                NextValue(count, count - 1),
+                If(count == 1,
+                    NextValue(count, DUMMY_CLOCKS),
+                    NextState("DUMMY"))
+                )
+            )
+        fsm.act("DUMMY",
+            refilling.eq(1),
+            NextValue(self.sclk, ~self.sclk),
+            If(self.sclk,
+                NextValue(count, count - 1),
+                If(count == 1,
+                    NextValue(count, 2 * line_bytes),
+                    NextValue(line_offset, 0),
+                    NextValue(nibble, 0),
+                    NextState("DATA"))
+                )
+            )
+        # Data is sampled at the end of each high phase, just before the
+        # flash moves on to the next nibble. High nibble first.
+        fsm.act("DATA",
+            refilling.eq(1),
+            NextValue(self.sclk, ~self.sclk),
+            data_wr.dat_w.eq(Cat(self.dq_i, high_nibble)),
+            If(self.sclk,
+                NextValue(high_nibble, self.dq_i),
+                NextValue(nibble, ~nibble),
+                data_wr.we.eq(nibble),
+                If(nibble,
+                    NextValue(line_offset, line_offset + 1)
+                ),
+                NextValue(count, count - 1),
+                If(count == 1,
+                    NextValue(self.cs_n, 1),
+                    NextState("TAG"))
+                )
+            )
+        fsm.act("TAG",
+            refilling.eq(1),
+            tag_wr.adr.eq(miss_address[offset_bits:]),
+            tag_wr.dat_w.eq(Cat(miss_address[offset_bits + index_bits:], 1)),
+            tag_wr.we.eq(1),
+            NextState("REPLAY")
+            )
+        # One more cycle with the read ports on the missed access, so the
+        # lookup sees the new line.
+        fsm.act("REPLAY",
+            refilling.eq(1),
+            NextState("IDLE")
+            )
+
+class SimSPIFlash(Module):
+    """Just enough of a quad I/O SPI flash for FomuFlashROM to read from in
+    migen simulation. It runs from the sys clock, watching for edges on
+    sclk, and understands QUAD_IO_READ and the commands for setting QE.
+    image is the flash contents from base up; everything else reads as
+    erased. status_2 is where status register 2 starts; with QE clear,
+    quad reads return 0xFF."""
+
+    def __init__(self, image, base=0, status_2=0):
+        self.cs_n = Signal(reset=1)
+        self.sclk = Signal()
+        self.dq_i = Signal(4)
+        self.dq_o = Signal(4)
+
+        self.specials.mem = Memory(8, max(len(image), 2), init=list(image) or [0xFF, 0xFF])
+        port = self.mem.get_port(async_read=True)
+        self.specials += port
+
+        last_sclk = Signal()
+        clocks = Signal(5)
+        command = Signal(8)
+        next_command = Signal(8)
+        address = Signal(24)
+        nibble = Signal()
+        rising = Signal()
+        falling = Signal()
+        in_image = Signal()
+
+        self.comb += [
+            rising.eq(self.sclk & ~last_sclk),
+            falling.eq(~self.sclk & last_sclk),
+            next_command.eq(Cat(self.dq_i[0], command[:7])),
+            port.adr.eq(address - base),
+            in_image.eq((address >= base) & (address < base + len(image)))
+            ]
+        self.sync += last_sclk.eq(self.sclk)
+
+        data_phase = 8 + 6 + 2 + DUMMY_CLOCKS
+        byte = Signal(8)
+        self.comb += byte.eq(Mux(in_image, port.dat_r, 0xFF))
+
+        # Status registers. Status reads repeat the register for as long as
+        # the clock runs, and writes take effect when CS# goes high.
+        self.status_1 = Signal(8)
+        self.status_2 = Signal(8, reset=status_2)
+        write_enabled = Signal()
+        status_out = Signal(8)
+        status_in = Signal(16)
+
+        self.sync += [
+            If(self.cs_n,
+                clocks.eq(0),
+                nibble.eq(0),
+                If((clocks == 8) & (command == VOLATILE_WRITE_ENABLE),
+                    write_enabled.eq(1)
+                ),
+                If((clocks == 24) & (command == WRITE_STATUS),
+                    If(write_enabled,
+                        self.status_1.eq(status_in[8:]),
+                        self.status_2.eq(status_in[:8])
+                    ),
+                    write_enabled.eq(0)
+                )
+            ).Else(
+                If(rising,
+                    If(clocks != 31, clocks.eq(clocks + 1)),
+                    If(clocks < 8,
+                        command.eq(next_command)
+                    ).Elif(clocks < 14,
+                        address.eq(Cat(self.dq_i, address[:20]))
+                    ),
+                    If(clocks == 7,
+                        status_out.eq(Mux(next_command == READ_STATUS_2, self.status_2, self.status_1))
+                    ),
+                    status_in.eq(Cat(self.dq_i[0], status_in[:15]))
+                ),
+                If(falling & (clocks >= 8) & ((command == READ_STATUS_1) | (command == READ_STATUS_2)),
+                    self.dq_o.eq(Cat(0, status_out[7])),
+                    status_out.eq(Cat(status_out[7], status_out[:7]))
+                ),
+                If(falling & (clocks >= data_phase) & (command == QUAD_IO_READ),
+                    self.dq_o.eq(Mux(self.status_2[1], Mux(nibble, byte[:4], byte[4:]), 0xF)),
+                    nibble.eq(~nibble),
+                    If(nibble, address.eq(address + 1))
+                )
+            )
+            ]
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+# What each tool in the icestorm flow is called in reports, and the
+# options after which its command line names a file it writes.
+STAGE_NAMES = {
+    "yosys": "synth",
+    "nextpnr-ice40": "pnr",
+    "arachne-pnr": "pnr",
+    "icetime": "timing",
+    "icepack": "pack",
+    }
+OUTPUT_OPTIONS = ("-l", "-o", "-r", "--asc", "--log", "-json", "-blif")
+
+def _digest_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class Stage(object):
+    """One command of the flow, with the files it reads and writes (relative
+    to the build directory)."""
+
+    def __init__(self, command, build_dir, name=None):
+        self.command = command
+        self.args = shlex.split(command)
+        self.tool = self.args[0]
+        self.name = name or STAGE_NAMES.get(self.tool, self.tool)
+        self.build_dir = build_dir
+
+        self.outputs = []
+        for option, value in zip(self.args, self.args[1:]):
+            if option in OUTPUT_OPTIONS and not value.startswith("-"):
+                self.outputs.append(value)
+        if self.tool == "icepack":
+            self.outputs.append(self.args[-1])
+
+        self.inputs = [a for a in self.args[1:]
+                       if a not in self.outputs and os.path.isfile(os.path.join(build_dir, a))]
+
+        # yosys is driven by a script, which names the sources and outputs.
+        if self.tool == "yosys":
+            for script in list(self.inputs):
+                with open(os.path.join(build_dir, script)) as f:
+                    for line in f:
+                        words = shlex.split(line)
+                        if words and words[0].startswith("read_"):
+                            self.inputs += [w for w in words[1:] if not w.startswith("-")]
+                        if words and words[0].startswith("write_"):
+                            self.outputs.append(words[-1])
+                        for option, value in zip(words, words[1:]):
+                            if option in OUTPUT_OPTIONS:
+                                self.outputs.append(value)
+
+    def key(self, tool_digest):
+        """Hash of everything the stage's outputs depend on."""
+        h = hashlib.sha256()
+        h.update(self.command.encode())
+        h.update(tool_digest.encode())
+        for name in sorted(self.inputs):
+            h.update(name.encode())
+            h.update(_digest_file(os.path.join(self.build_dir, name)).encode())
+        return h.hexdigest()
+
+class BuildCache(object):
+    """Content-addressed store of stage outputs, at path/<stage>/<key>/."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _entry(self, stage, key):
+        return os.path.join(self.path, stage, key)
+
+    def restore(self, stage, key, build_dir):
+        """Copy a cached stage's outputs into build_dir. Returns False if
+        there are none."""
+        entry = self._entry(stage, key)
+        try:
+            with open(os.path.join(entry, "manifest.json")) as f:
+                outputs = json.load(f)
+        except FileNotFoundError:
+            return False
+        for name in outputs:
+            shutil.copyfile(os.path.join(entry, name), os.path.join(build_dir, name))
+        return True
+
+    def store(self, stage, key, build_dir, outputs):
+        entry = self._entry(stage, key)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Fill a scratch directory and rename it into place, so a build that
+        # dies half way never leaves a partial entry.
+        scratch = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        outputs = [name for name in outputs if os.path.isfile(os.path.join(build_dir, name))]
+        for name in outputs:
+            os.makedirs(os.path.dirname(os.path.join(scratch, name)), exist_ok=True)
+            shutil.copyfile(os.path.join(build_dir, name), os.path.join(scratch, name))
+        with open(os.path.join(scratch, "manifest.json"), "w") as f:
+            json.dump(outputs, f)
+        try:
+            os.rename(scratch, entry)
+        except OSError:
+            # Someone else stored it first.
+            shutil.rmtree(scratch)
+
+class FomuFlow(object):
+    """Runs the icestorm flow that platform.build(..., run=False) left in
+    build_dir, one command at a time, skipping any command whose inputs,
+    command line and tool binary are unchanged since it was last run.
+
+    Because the keys are hashes of file contents, a change that leaves an
+    intermediate file the same (say, a PCF change doesn't alter top.json)
+    still hits for everything up to that point."""
+
+    def __init__(self, build_dir, cache_dir, build_name="top", seed=None, prebuilt=None):
+        self.build_dir = os.path.abspath(build_dir)
+        self.cache = BuildCache(os.path.abspath(cache_dir))
+        self.build_name = build_name
+        self.seed = seed
+        # {module: source file names} to synthesise out of context.
+        self.prebuilt = prebuilt or {}
+        self.hits = []
+        self.misses = []
+        self._tool_digests = {}
+
+    def commands(self):
+        """The tool invocations from the build script migen wrote. nextpnr
+        also gets a log file, for the timing report, and the seed. A seeded
+        run is one of a sweep, which wants a bitstream and timing from every
+        seed, so it doesn't stop on failing timing."""
+        with open(os.path.join(self.build_dir, "build_" + self.build_name + ".sh")) as f:
+            commands = [line.strip() for line in f
+                        if line.strip() and not line.startswith("#") and line.split()[0] in STAGE_NAMES]
+        for i, command in enumerate(commands):
+            if command.startswith("nextpnr-ice40 "):
+                command += " --log " + self.build_name + "_pnr.log"
+                if self.seed is not None:
+                    command += " --seed " + str(self.seed) + " --timing-allow-fail"
+                commands[i] = command
+        return commands
+
+    def tool_digest(self, tool):
+        """Identifies the tool binary, so a toolchain upgrade misses."""
+        if tool not in self._tool_digests:
+            path = shutil.which(tool)
+            self._tool_digests[tool] = _digest_file(path) if path else tool
+        return self._tool_digests[tool]
+
+
+    def presynthesise(self, top, sources):
+        """Synthesise module top from the named sources on its own, in its own
+        directory, and have the main synthesis read the resulting netlist
+        instead of the sources. Its cache key only covers those sources, so
+        it hits however the rest of the design changes."""
+        script = os.path.join(self.build_dir, self.build_name + ".ys")
+        with open(script) as f:
+            lines = f.read().splitlines()
+        reads = [line for line in lines
+                 if line.startswith("read_") and os.path.basename(shlex.split(line)[-1]) in sources]
+        synth = [line for line in lines if line.startswith("synth_ice40")]
+        if not reads or not synth:
+            return
+
+        ooc_dir = os.path.join(self.build_dir, top)
+        os.makedirs(ooc_dir, exist_ok=True)
+        # Same synthesis options as the top level, minus its top and output.
+        words = shlex.split(synth[0])
+        for option in ("-top", "-json", "-blif"):
+            if option in words:
+                del words[words.index(option):words.index(option) + 2]
+        with open(os.path.join(ooc_dir, top + ".ys"), "w") as f:
+            f.write("\n".join(reads + [
+                " ".join(words) + " -top " + top,
+                # The cell library is read again by the top level synthesis.
+                "delete =A:blackbox",
+                "write_json " + top + ".json"]) + "\n")
+        self.run_stage(Stage("yosys -q -l " + top + ".rpt " + top + ".ys", ooc_dir, name="synth " + top))
+
+        netlist = "read_json " + os.path.join(top, top + ".json")
+        lines = [netlist if line == reads[0] else line for line in lines if line not in reads[1:]]
+        with open(script, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def run_stage(self, stage):
+        """Run (or restore) one stage. Returns True on a cache hit."""
+        key = stage.key(self.tool_digest(stage.tool))
+        if self.cache.restore(stage.name, key, stage.build_dir):
+            self.hits.append(stage.name)
+            print("Build cache hit:", stage.name, key[:12])
+            return True
+        self.misses.append(stage.name)
+        print("Build cache miss:", stage.name, key[:12])
+        subprocess.check_call(stage.args, cwd=stage.build_dir)
+        self.cache.store(stage.name, key, stage.build_dir, stage.outputs)
+        return False
+
+    def run(self, stages=None):
+        """Run the flow, or just the named stages of it."""
+        if stages is None or "synth" in stages:
+            for top, sources in self.prebuilt.items():
+                self.presynthesise(top, sources)
+        for command in self.commands():
+            stage = Stage(command, self.build_dir)
+            if stages is None or stage.name in stages:
+                self.run_stage(stage)
+        print("Build cache:", len(self.hits), "hit(s),", len(self.misses), "miss(es)")
+        return os.path.join(self.build_dir, self.build_name + ".bin")
+
+    def timing(self):
+        """Timing from the nextpnr log of the last run."""
+        with open(os.path.join(self.build_dir, self.build_name + "_pnr.log")) as f:
+            return parse_nextpnr_timing(f.read())
+
+# nextpnr reports each clock after placement and again after routing; the
+# last report is the one that counts.
+_FMAX = re.compile(r"Max frequency for clock\s+'([^']+)': ([0-9.]+) MHz \((?:PASS|FAIL) at ([0-9.]+) MHz\)")
+
+def parse_nextpnr_timing(log):
+    """Returns {clock: (fmax, target)}, in MHz, from a nextpnr log."""
+    return {clock: (float(fmax), float(target)) for clock, fmax, target in _FMAX.findall(log)}
+
+def worst_slack(timing):
+    """The smallest slack, in ns, over all the clocks; negative fails."""
+    if not timing:
+        return float("-inf")
+    return min(1000 / target - 1000 / fmax for fmax, target in timing.values())
+
+def _synth(build_dir, cache_dir, prebuilt):
+    FomuFlow(build_dir, cache_dir, prebuilt=prebuilt).run(stages=("synth",))
+
+def _place_and_route(build_dir, cache_dir, seed):
+    # Each seed places and routes in its own copy of the synthesised build.
+    seed_dir = os.path.join(build_dir, "seed" + str(seed))
+    os.makedirs(seed_dir, exist_ok=True)
+    for name in os.listdir(build_dir):
+        if os.path.isfile(os.path.join(build_dir, name)):
+            shutil.copyfile(os.path.join(build_dir, name), os.path.join(seed_dir, name))
+    flow = FomuFlow(seed_dir, cache_dir, seed=seed)
+    try:
+        flow.run(stages=("pnr", "timing", "pack"))
+    except subprocess.CalledProcessError as e:
+        # A seed that can't route shouldn't take the rest of the sweep down.
+        print("Warning: seed", seed, "failed in", seed_dir + ":", e)
+        return seed_dir, None
+    return seed_dir, flow.timing()
+
+def sweep(build_dirs, cache_dir, seeds, jobs=None, build_name="top", prebuilt=None):
+    """Synthesise each of build_dirs (one per revision, as left by
+    platform.build(..., run=False)), then place and route each with every
+    nextpnr seed, spread over jobs processes. The bitstream, ASC and log
+    from the seed with the most slack are copied back into each build_dir.
+
+    Seeds that fail timing still count; one whose flow fails outright
+    doesn't. Raises RuntimeError if no seed gave a build_dir a bitstream.
+
+    Returns {build_dir: (seed, timing)} for the seeds that were kept."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    best = {}
+    with ProcessPoolExecutor(jobs) as pool:
+        for result in [pool.submit(_synth, d, cache_dir, prebuilt) for d in build_dirs]:
+            result.result()
+        results = {(d, seed): pool.submit(_place_and_route, d, cache_dir, seed)
+                   for d in build_dirs for seed in seeds}
+        for (build_dir, seed), result in results.items():
+            seed_dir, timing = result.result()
+            if timing is None:
+                print(build_dir, "seed", seed, "produced no bitstream")
+                continue
+            print(build_dir, "seed", seed, "worst slack %.2fns:" % worst_slack(timing),
+                  ", ".join("%s %.2f MHz" % (clock, fmax) for clock, (fmax, target) in sorted(timing.items())))
+            if build_dir not in best or worst_slack(timing) > worst_slack(best[build_dir][1]):
+                best[build_dir] = (seed, timing)
+
+    for build_dir, (seed, timing) in best.items():
+        seed_dir = os.path.join(build_dir, "seed" + str(seed))
+        for suffix in (".bin", ".txt", "_pnr.log"):
+            shutil.copyfile(os.path.join(seed_dir, build_name + suffix),
+                            os.path.join(build_dir, build_name + suffix))
+        print("Kept seed", seed, "for", build_dir, "(worst slack %.2fns)" % worst_slack(timing))
+        if worst_slack(timing) < 0:
+            print("Warning: no seed meets timing for", build_dir)
+    failed = [d for d in build_dirs if d not in best]
+    if failed:
+        raise RuntimeError("No seed produced a bitstream for " + ", ".join(failed))
+    return best
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""asyncio host library for the Fomu 6502 USB device (1209:5bf0).
+
+    async with FomuHost(AsyncUSBTransport()) as fomu:
+        await fomu.load_program(0x0200, image, entry=0x0200)
+        await fomu.serial_write(b"hello")
+        print(await fomu.serial_read(5))
+
+Memory accesses go through USBWishboneHost (fomu_usb_wishbone.py) on EP3
+and the serial port is the CDC data endpoints on EP2. Calls don't wait for
+each other: commands from every caller are packed back to back into
+64-byte packets, and as many as are queued are in flight at once. Memory
+can only be accessed while the CPU is held (see hold()).
+
+LoopbackTransport runs the same protocol into a migen simulation of the
+SoC's USB endpoints instead, so host tooling can be tried out and its
+throughput measured without hardware:
+
+    python3 fomu_host.py --loopback --bench 4096
+"""
+import argparse
+import asyncio
+import collections
+import queue
+import struct
+import threading
+import time
+
+from fomu_usb_wishbone import NOP, WRITE, READ
+from fomu_6502_bus_window import CONTROL, CPU_RESET, VECTOR, VECTOR_ENABLE
+from fomu_wishbone_client import (MAX_PACKET, SERIAL_ENDPOINT, WISHBONE_ENDPOINT, WishboneError, USBTransport,
+                                  command, bursts, reply_length, check_status)
+
+class AsyncUSBTransport(object):
+    """The device, through fomu_wishbone_client.USBTransport with the CDC
+    interfaces claimed too, to get at EP2. pyusb blocks, so each call runs
+    in a worker thread; reads time out after timeout ms and try again, so
+    they can be cancelled."""
+
+    def __init__(self, vid=0x1209, pid=0x5bf0, timeout=100):
+        self.usb = USBTransport(vid, pid, interfaces=range(3), timeout=timeout)
+
+    async def write(self, endpoint, packet):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.usb.write, packet, endpoint, 0)
+
+    async def read(self, endpoint):
+        loop = asyncio.get_running_loop()
+        while True:
+            packet = await loop.run_in_executor(None, self.usb.read_packet, endpoint)
+            if packet is not None:
+                return packet
+
+    def close(self):
+        self.usb.close()
+
+class LoopbackTransport(object):
+    """Plays the USB host to a migen simulation of the SoC, a transaction
+    at a time: the bulk endpoints get the same strobes, with the bytes
+    spaced out at the USB full speed line rate, as the USB core would give
+    them. The simulation runs in its own thread, and only while there is a
+    transaction waiting, so cycles counts simulated time spent on USB
+    traffic (or polling for it).
+
+    soc_args are passed on to Fomu."""
+
+    # Token and handshake packets, with sync, EOP and turnaround, in bytes.
+    TOKEN_BYTES = 6
+    HANDSHAKE_BYTES = 4
+    # Sync, PID and CRC16 around a data packet.
+    DATA_OVERHEAD_BYTES = 5
+
+    def __init__(self, revision="pvt", **soc_args):
+        from fomu_platform import FomuPlatform
+        from fomu_soc import Fomu
+        self.soc = Fomu(FomuPlatform(revision=revision), simulation=True, **soc_args)
+        self.cycles_per_byte = max(1, round(self.soc.sys_clk_freq / 1.5e6))
+        self.endpoints = {
+            (SERIAL_ENDPOINT, "out"): self.soc.usb.bulk_out,
+            (SERIAL_ENDPOINT, "in"): self.soc.usb.bulk_in,
+            (WISHBONE_ENDPOINT, "out"): self.soc.usb.wishbone_out,
+            (WISHBONE_ENDPOINT, "in"): self.soc.usb.wishbone_in,
+            }
+        self.cycles = 0
+        self.requests = queue.Queue()
+        self.closed = False
+        self.thread = None
+
+    def _start(self):
+        if self.thread is None:
+            from migen.sim import run_simulation
+            self.thread = threading.Thread(target=run_simulation, args=(self.soc, self._host()), daemon=True)
+            self.thread.start()
+
+    async def _transaction(self, endpoint, direction, packet=None):
+        self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requests.put((endpoint, direction, packet, loop, future))
+        return await future
+
+    async def write(self, endpoint, packet):
+        await self._transaction(endpoint, "out", bytes(packet))
+
+    async def read(self, endpoint):
+        return await self._transaction(endpoint, "in")
+
+    def close(self):
+        self.closed = True
+        self.requests.put(None)
+
+    def _cycles(self, cycles):
+        for i in range(cycles):
+            self.cycles += 1
+            yield
+
+    def _wait(self, byte_times):
+        yield from self._cycles(byte_times * self.cycles_per_byte)
+
+    def _out(self, ep, packet):
+        # The core passes the CRC16 on after the payload.
+        yield from self._wait(self.TOKEN_BYTES)
+        yield ep.start.eq(1)
+        yield from self._cycles(1)
+        yield ep.start.eq(0)
+        for byte in packet + b"\0\0":
+            yield ep.data_recv_payload.eq(byte)
+            yield ep.data_recv_put.eq(1)
+            yield from self._cycles(1)
+            yield ep.data_recv_put.eq(0)
+            yield from self._cycles(self.cycles_per_byte - 1)
+        acked = (yield ep.ack)
+        if acked:
+            yield ep.commit.eq(1)
+            yield from self._cycles(1)
+            yield ep.commit.eq(0)
+        yield from self._wait(self.DATA_OVERHEAD_BYTES + self.HANDSHAKE_BYTES)
+        return acked
+
+    def _in(self, ep):
+        yield from self._wait(self.TOKEN_BYTES)
+        yield ep.start.eq(1)
+        yield from self._cycles(1)
+        yield ep.start.eq(0)
+        yield from self._cycles(2)
+        if not (yield ep.ack):
+            yield from self._wait(self.HANDSHAKE_BYTES)
+            return None
+        packet = bytearray()
+        while (yield ep.data_send_have):
+            packet.append((yield ep.data_send_payload))
+            yield ep.data_send_get.eq(1)
+            yield from self._cycles(1)
+            yield ep.data_send_get.eq(0)
+            yield from self._cycles(self.cycles_per_byte - 1)
+        yield from self._wait(self.DATA_OVERHEAD_BYTES + self.HANDSHAKE_BYTES)
+        yield ep.commit.eq(1)
+        yield from self._cycles(1)
+        yield ep.commit.eq(0)
+        return bytes(packet)
+
+    def _host(self):
+        pending = collections.deque()
+        while not self.closed:
+            # Block (with simulated time stopped) only when there is nothing
+            # to do.
+            try:
+                while True:
+                    request = self.requests.get(block=not pending)
+                    if request is None:
+                        return
+                    pending.append(request)
+            except queue.Empty:
+                pass
+
+            # Each pending transaction gets a turn, NAKed ones try again.
+            for i in range(len(pending)):
+                endpoint, direction, packet, loop, future = pending.popleft()
+                ep = self.endpoints[(endpoint, direction)]
+                if direction == "out":
+                    done = yield from self._out(ep, packet)
+                    result = None
+                else:
+                    result = yield from self._in(ep)
+                    done = result is not None
+                if done:
+                    loop.call_soon_threadsafe(future.set_result, result)
+                else:
+                    pending.append((endpoint, direction, packet, loop, future))
+
+class FomuHost(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self._tasks = []
+
+        self._commands = bytearray()
+        self._replies = collections.deque()
+        self._commands_ready = asyncio.Event()
+
+        self._serial_out = bytearray()
+        self._serial_sent = 0
+        self._serial_queued = 0
+        self._serial_waiters = collections.deque()
+        self._serial_ready = asyncio.Event()
+        self._serial_in = bytearray()
+        self._serial_arrived = asyncio.Condition()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        for worker in (self._command_writer, self._reply_reader, self._serial_writer, self._serial_reader):
+            self._tasks.append(asyncio.ensure_future(worker()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.transport.close()
+
+    async def _send_pooled(self, endpoint, buffer, ready):
+        # Whatever else is queued in this turn of the event loop joins the
+        # packet; after that, full packets go out as long as there is data.
+        await ready.wait()
+        ready.clear()
+        await asyncio.sleep(0)
+        while buffer:
+            packet = bytes(buffer[:MAX_PACKET])
+            del buffer[:MAX_PACKET]
+            await self.transport.write(endpoint, packet)
+            yield len(packet)
+
+    # Memory, through USBWishboneHost.
+
+    async def _command_writer(self):
+        while True:
+            async for sent in self._send_pooled(WISHBONE_ENDPOINT, self._commands, self._commands_ready):
+                pass
+
+    async def _reply_reader(self):
+        replies = bytearray()
+        while True:
+            replies += await self.transport.read(WISHBONE_ENDPOINT)
+            while self._replies and len(replies) >= self._replies[0][0]:
+                length, future = self._replies.popleft()
+                reply = bytes(replies[:length])
+                del replies[:length]
+                if future.cancelled():
+                    continue
+                try:
+                    check_status(reply[-1])
+                except WishboneError as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(reply[:-1])
+
+    def _command(self, opcode, address, count=0, payload=b"", reply_words=0):
+        future = asyncio.get_running_loop().create_future()
+        self._commands += command(opcode, address, count, payload)
+        self._replies.append((reply_length(reply_words), future))
+        self._commands_ready.set()
+        return future
+
+    async def read_words(self, address, count, fixed=False):
+        """count 32-bit words from a word aligned Wishbone address."""
+        parts = [self._command(opcode, burst_address, burst, reply_words=burst)
+                 for opcode, burst_address, start, burst in bursts(READ, address, count, fixed)]
+        data = b"".join(await asyncio.gather(*parts))
+        return list(struct.unpack("<%dI" % count, data))
+
+    async def write_words(self, address, words, fixed=False):
+        words = list(words)
+        parts = [self._command(opcode, burst_address, burst,
+                               struct.pack("<%dI" % burst, *words[start:start + burst]))
+                 for opcode, burst_address, start, burst in bursts(WRITE, address, len(words), fixed)]
+        await asyncio.gather(*parts)
+
+    async def read_memory(self, address, length):
+        """length bytes of the 6502's address space."""
+        start = address & ~3
+        count = (address + length - start + 3) // 4
+        data = struct.pack("<%dI" % count, *await self.read_words(start, count))
+        return data[address - start:address - start + length]
+
+    async def write_memory(self, address, data):
+        """Write bytes into the 6502's address space. Words are written
+        whole, so bytes sharing a word with the start or end of data are
+        read and written back."""
+        data = bytes(data)
+        start = address & ~3
+        end = (address + len(data) + 3) & ~3
+        if start != address or end != address + len(data):
+            # Read-modify-write of the partial words at each end.
+            head = await self.read_memory(start, address - start)
+            tail = await self.read_memory(address + len(data), end - address - len(data))
+            data = head + data + tail
+        await self.write_words(start, struct.unpack("<%dI" % (len(data) // 4), data))
+
+    async def ping(self):
+        await self._command(NOP, 0)
+
+    # The CPU.
+
+    async def hold(self):
+        """Hold the CPU in reset, giving the host the bus."""
+        await self.write_words(CONTROL * 4, [CPU_RESET])
+
+    async def release(self, entry=None):
+        """Let the CPU go, from entry if given, or else its reset vector."""
+        await self.write_words(VECTOR * 4, [VECTOR_ENABLE | entry if entry is not None else 0])
+        await self.write_words(CONTROL * 4, [0])
+
+    async def reset(self, entry=None):
+        await self.hold()
+        await self.release(entry)
+
+    async def load_program(self, address, image, entry=None):
+        """Hold the CPU, write image at address and restart the CPU at
+        entry (by default, the start of the image)."""
+        await self.hold()
+        await self.write_memory(address, image)
+        await self.release(address if entry is None else entry)
+
+    # The serial port.
+
+    async def _serial_writer(self):
+        while True:
+            async for sent in self._send_pooled(SERIAL_ENDPOINT, self._serial_out, self._serial_ready):
+                self._serial_sent += sent
+                while self._serial_waiters and self._serial_waiters[0][0] <= self._serial_sent:
+                    end, future = self._serial_waiters.popleft()
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _serial_reader(self):
+        while True:
+            packet = await self.transport.read(SERIAL_ENDPOINT)
+            async with self._serial_arrived:
+                self._serial_in += packet
+                self._serial_arrived.notify_all()
+
+    async def serial_write(self, data):
+        """Send data to the CPU's serial port, returning once it has gone."""
+        future = asyncio.get_running_loop().create_future()
+        self._serial_out += data
+        self._serial_queued += len(data)
+        self._serial_waiters.append((self._serial_queued, future))
+        self._serial_ready.set()
+        await future
+
+    async def serial_read(self, length=1):
+        """Wait for length bytes from the CPU's serial port."""
+        async with self._serial_arrived:
+            await self._serial_arrived.wait_for(lambda: len(self._serial_in) >= length)
+            data = bytes(self._serial_in[:length])
+            del self._serial_in[:length]
+            return data
+
+async def benchmark(host, size, address=0x0200):
+    """Write then read back size bytes of RAM, as one batch each way, and
+    report the throughput."""
+    pattern = bytes(i * 7 & 0xFF for i in range(size))
+    await host.hold()
+    results = []
+    for name, operation in (("write", host.write_memory(address, pattern)),
+                            ("read", host.read_memory(address, size))):
+        cycles = getattr(host.transport, "cycles", None)
+        start = time.perf_counter()
+        data = await operation
+        elapsed = time.perf_counter() - start
+        line = "{:<6} {} bytes in {:.3f}s ({:.2f} KB/s)".format(name, size, elapsed, size / elapsed / 1024)
+        if cycles is not None:
+            simulated = (host.transport.cycles - cycles) / host.transport.soc.sys_clk_freq
+            line += ", {:.2f}ms simulated ({:.1f} KB/s)".format(simulated * 1000, size / simulated / 1024)
+        print(line)
+        results.append(data)
+    if results[1] != pattern:
+        raise WishboneError("Read back something other than what was written")
+    await host.release()
+
+def main():
+    parser = argparse.ArgumentParser(description="Talk to the Fomu 6502 over USB")
+    parser.add_argument("--loopback", action="store_true",
+                        help="use a simulation of the SoC instead of the device")
+    parser.add_argument("--revision", default="pvt", help="platform revision for --loopback")
+    parser.add_argument("--load", help="program to load at --address and run")
+    parser.add_argument("--address", type=lambda a: int(a, 0), default=0x0200)
+    parser.add_argument("--bench", type=int, metavar="BYTES",
+                        help="measure memory write and read throughput")
+    args = parser.parse_args()
+
+    async def run():
+        transport = LoopbackTransport(args.revision) if args.loopback else AsyncUSBTransport()
+        async with FomuHost(transport) as host:
+            await host.ping()
+            if args.bench:
+                await benchmark(host, args.bench, args.address)
+            if args.load:
+                with open(args.load, "rb") as f:
+                    await host.load_program(args.address, f.read())
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
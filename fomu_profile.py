@@ -0,0 +1,80 @@
+import cProfile
+import pstats
+import time
+
+from migen.fhdl.structure import _Fragment
+from migen.fhdl.verilog import convert
+from migen.fhdl.visit import NodeVisitor
+
+class _StatementCounter(NodeVisitor):
+    def __init__(self):
+        self.statements = 0
+
+    def visit_Assign(self, node):
+        self.statements += 1
+        super().visit_Assign(node)
+
+    def visit_If(self, node):
+        self.statements += 1
+        super().visit_If(node)
+
+    def visit_Case(self, node):
+        self.statements += 1
+        super().visit_Case(node)
+
+def count_statements(fragment):
+    """Assignments, Ifs and Cases in a fragment's comb and sync logic."""
+    counter = _StatementCounter()
+    counter.visit(fragment)
+    return counter.statements
+
+class ElaborationProfiler(object):
+    """Times the construction of an SoC and the generation of its Verilog,
+    broken down by submodule.
+
+    factory builds the SoC. Construction time for each submodule is the
+    time spent in its class's __init__, so submodules of the same class
+    share one figure. Finalisation time is how long get_fragment() takes,
+    and the statement and special counts are from the resulting fragment.
+    """
+
+    def __init__(self, platform, factory):
+        self.platform = platform
+        self.rows = []
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        soc = profile.runcall(factory)
+        self.construction = time.perf_counter() - start
+        init_times = {}
+        for (filename, line, function), (calls, _, _, cumulative, _) in pstats.Stats(profile).stats.items():
+            init_times[(filename, line, function)] = cumulative
+
+        fragment = _Fragment()
+        for name, module in soc._submodules:
+            code = type(module).__init__.__code__
+            init_time = init_times.get((code.co_filename, code.co_firstlineno, code.co_name), 0)
+            start = time.perf_counter()
+            f = module.get_fragment()
+            finalise_time = time.perf_counter() - start
+            fragment += f
+            self.rows.append((name or type(module).__name__, init_time, finalise_time,
+                              count_statements(f), len(f.specials)))
+        fragment += soc._fragment
+
+        # Roughly what platform.build() does to write top.v.
+        start = time.perf_counter()
+        convert(fragment, platform.constraint_manager.get_io_signals(),
+                special_overrides=platform.toolchain.special_overrides)
+        self.conversion = time.perf_counter() - start
+        self.statements = count_statements(fragment)
+
+    def print_report(self):
+        print("Elaboration profile:")
+        print("  {:<16} {:>10} {:>10} {:>10} {:>8}".format(
+            "submodule", "init (s)", "final (s)", "statements", "specials"))
+        for name, init_time, finalise_time, statements, specials in self.rows:
+            print("  {:<16} {:>10.3f} {:>10.3f} {:>10} {:>8}".format(
+                name, init_time, finalise_time, statements, specials))
+        print("  Construction {:.3f}s (under the profiler), Verilog generation {:.3f}s, {} statements".format(
+            self.construction, self.conversion, self.statements))
@@ -1,14 +1,24 @@
 from collections import namedtuple
-from fomu_clock import CRG
+from fomu_clock import CRG, SimCRG
 from fomu_6502_cpu import A6502
+from fomu_6502_cpu_sim import A6502Sim
 from fomu_6502_rgb import SBLED
-from fomu_spram import FomuSPRAM
+from fomu_spram import FomuSPRAM, FomuPagedSPRAM
+from fomu_6502_paging import FomuPagingRegister
 from fomu_6502_rom import FomuROM
+from fomu_flash import FomuFlashROM
 from fomu_6502_wishbone_bridge import FomuBridge
-from fomu_usb_cdc import FomuUSBCDC
+from fomu_6502_usb_serial import FomuUSBSerial
+from fomu_6502_bus_window import Bus6502Window
+from fomu_usb_wishbone import USBWishboneHost
+from fomu_6502_dma import FomuDMA
+from fomu_6502_math import FomuMath
+from fomu_6502_fabric import BusFabric
 from migen import *
 
-AddressRange = namedtuple("AddressRange", ("start", "size"))
+# wait_states is how many extra cycles the device needs to answer; the bus
+# fabric holds RDY low for that long on every access to it.
+AddressRange = namedtuple("AddressRange", ("start", "size", "wait_states"), defaults=(0,))
 
 # The 6502 processor is too different to what litex expects to see. In particular,
 # the address space for the various CSRs is much smaller than would be normal, and
@@ -24,32 +34,37 @@ class Fomu(Module):
         "ram": AddressRange( 0x0, 0x8000),
         "paged_rom": AddressRange( 0x8000, 0x4000),
         "low_os_rom": AddressRange( 0xC000, 0x3c00),
-        "rgb": AddressRange(0xFE00, 0x10),
-        "wishbone": AddressRange(0xFE20, 0x08), 
+        # The LED IP samples its register write on LEDDCLK; holding the write
+        # for a second cycle gives LEDDADDR/LEDDDAT a whole cycle of setup.
+        "rgb": AddressRange(0xFE00, 0x10, 1),
+        "wishbone": AddressRange(0xFE20, 0x10),
         "paging_register": AddressRange(0xFE30, 0x10),
-        "high_os_rom": AddressRange(0xFF00, 0xFF),
+        "usb_serial": AddressRange(0xFE40, 0x10),
+        "dma": AddressRange(0xFE50, 0x10),
+        "math": AddressRange(0xFE60, 0x10),
+        "high_os_rom": AddressRange(0xFF00, 0x100),
         }
 
-    def __init__(self, platform):
-        # Set up the basic address space layout and create basic
-        # select signals for each entry in the memory map.
-        self.address_bus = Signal(16)
-        for name, address_range in self.memory_map.items():
-            fast_sel = Signal(name=name+"_sel")
-            slow_sel = Signal(name=name+"_sel_slow")
-            setattr(self, name+"_sel", fast_sel)
-            setattr(self, name+"_sel_slow", slow_sel)
-            self.comb += [
-                fast_sel.eq(Mux(wrap(self.address_bus >= address_range.start) & wrap(self.address_bus < address_range.start+address_range.size), 1, 0))
-            ]
-            # Latched versions, needed to drive the databus logic
-            self.sync += [
-                slow_sel.eq(Mux(wrap(self.address_bus >= address_range.start) & wrap(self.address_bus < address_range.start+address_range.size), 1, 0))
-            ]
+    def __init__(self, platform, simulation=False, registered_bus=False, sys_clk_freq=12e6, flash_image=None,
+                 rom_image=None, rom_region="high_os_rom", rom_size=None, cpu_variant="standard"):
+        # With simulation=True, everything is built from parts migen's
+        # simulator can execute, and the USB core is left out (but not its
+        # bulk endpoints); flash_image is then what the simulated SPI flash
+        # holds at the OS ROM's offset. registered_bus trades a wait state on
+        # every access for a registered read mux; SPRAM reads of the word it
+        # last read don't pay it.
+        # rom_image goes in a block RAM ROM of rom_size bytes (by default, the
+        # image's size) in place of whatever normally lives at rom_region.
+        # cpu_variant picks the core: "standard" (NMOS) or "65c02".
 
-        # Fomu clock/reset generator, using the PLL to generate a 48MHz and 12MHz clock.
-        # The 12MHz clock becomes cd_sys; the 48MHz clock is available as cd_usb_48.
-        self.submodules.crg = CRG(platform, use_pll=True)
+        # Fomu clock/reset generator. The PLL generates cd_sys at sys_clk_freq for
+        # the CPU; USB gets cd_usb_48 and cd_usb_12 from the 48MHz oscillator.
+        if simulation:
+            self.submodules.crg = SimCRG()
+            self.sys_clk_freq = sys_clk_freq
+        else:
+            self.submodules.crg = CRG(platform, use_pll=True, sys_clk_freq=sys_clk_freq)
+            self.sys_clk_freq = self.crg.sys_clk_freq
 
         #self.clock_domains.cd_sys = ClockDomain()
         #clk48_raw = platform.request("clk48")
@@ -67,68 +82,135 @@ class Fomu(Module):
         #    ]
         
         # CPU
-        self.submodules.cpu = A6502(platform)
+        if simulation:
+            self.submodules.cpu = A6502Sim(platform, cpu_variant)
+        else:
+            self.submodules.cpu = A6502(platform, cpu_variant)
         
+        # Block RAM ROM; the boot ROM (for debug only) unless we're given firmware.
+        if rom_region not in self.memory_map:
+            raise ValueError("No memory map entry \'"+rom_region+"\' to put the ROM in")
+        if rom_size is not None and rom_size > self.memory_map[rom_region].size:
+            raise ValueError("A "+str(rom_size)+" byte ROM doesn't fit in "+rom_region)
+        setattr(self.submodules, rom_region, FomuROM(platform, rom_image, rom_size))
+        if rom_region != "high_os_rom":
+            self.submodules.high_os_rom = FomuROM(platform)
+
         # Basic RAM.
-        self.submodules.ram = FomuSPRAM(platform)
+        if rom_region != "ram":
+            self.submodules.ram = FomuSPRAM(platform, simulation)
 
-        # Boot ROM (for debug only)
-        self.submodules.high_os_rom = FomuROM(platform)
+        # The other three SPRAM blocks, banked into the paged_rom window like
+        # a BBC Micro's sideways RAM.
+        if rom_region != "paged_rom":
+            self.submodules.paged_rom = FomuPagedSPRAM(platform, simulation)
+        if rom_region != "paging_register":
+            self.submodules.paging_register = FomuPagingRegister(platform)
+        if rom_region not in ("paged_rom", "paging_register"):
+            self.comb += self.paged_rom.bank.eq(self.paging_register.bank)
+
+        # OS ROM, executed in place from the SPI flash. The hacker board only
+        # wires up two of the flash data lines. When the flash isn't used it
+        # is left deselected.
+        low_os_rom = self.memory_map["low_os_rom"]
+        if simulation:
+            if rom_region != "low_os_rom":
+                self.submodules.low_os_rom = FomuFlashROM(platform, size=low_os_rom.size,
+                                                          simulation=True, image=flash_image)
+        else:
+            flash_pads = platform.request("spiflash4x")
+            if rom_region == "low_os_rom":
+                self.comb += flash_pads.cs_n.eq(1)
+            elif len(flash_pads.dq) == 4:
+                self.submodules.low_os_rom = FomuFlashROM(platform, flash_pads, size=low_os_rom.size)
+            else:
+                print("Warning: No quad SPI flash on this board, so no OS ROM.")
+                self.comb += flash_pads.cs_n.eq(1)
 
         # LEDs for I/O
-        self.submodules.rgb = SBLED(platform)
+        if rom_region != "rgb":
+            self.submodules.rgb = SBLED(platform, simulation)
 
         # Wishbone bridge
-        self.submodules.wishbone = FomuBridge(platform)
-        
-        # Build up a mux for the data bus (in), IRQ, NMI, RDY, and connect up the chip selects.
-        mux = Constant(0)
-        rdy_mux = Constant(1)
-        irq_mux = Constant(0)
-        nmi_mux = Constant(0)
+        if rom_region != "wishbone":
+            self.submodules.wishbone = FomuBridge(platform)
+
+        # Multiply/divide unit, on a DSP block.
+        if rom_region != "math":
+            self.submodules.math = FomuMath(platform, simulation)
+
+        # Serial port over USB. In simulation the USB side runs on the CPU
+        # clock.
+        if rom_region != "usb_serial":
+            self.submodules.usb_serial = FomuUSBSerial(platform, usb_domain="sys" if simulation else "usb_12")
         
-        for name, address_range in self.memory_map.items():
-            try:
-                # Find the module and its select signals
-                module = getattr(self, name)
-            except AttributeError:
-                print("Warning: Memory map defines \'"+name+"\' but no submodule exists.")
-                continue
-            select_fast = getattr(self, name+"_sel")
-            select_slow = getattr(self, name+"_sel_slow")
-            
-            # Extend the existing muxes for this module. Slow select used for mux
-            # because this CPU core reads one cycle behind the address bus.
-            mux = Mux(select_slow, module.data_out, mux)
-            rdy_mux = Mux(select_slow, module.rdy, rdy_mux)
-            irq_mux = irq_mux | module.irq
-            nmi_mux = nmi_mux | module.nmi
-            
-            self.comb += [
-                # Connect up the CS signals.
-                module.cs.eq(select_fast),
-                module.cs_slow.eq(select_slow),
-                # Wire up the address bus in to each device too.
-                module.address.eq(self.address_bus - address_range.start),
-                # And the data bus out to it.
-                module.data_in.eq(self.cpu.data_out),
-                module.we.eq(self.cpu.we)
-                ]
-                
-            print("Connected device",name,"at",address_range)
-                
-        print("Constructed data mux:", mux)
-        print("Constructed RDY mux:", rdy_mux)
-        self.comb += [self.cpu.data_in.eq(mux),
-                          self.cpu.rdy.eq(rdy_mux),
-                          self.cpu.irq.eq(irq_mux),
-                          self.cpu.nmi.eq(nmi_mux),
-                          self.address_bus.eq(self.cpu.address)]
+        # Wishbone access to the whole address space for the USB host, which
+        # can hold the CPU in reset and take over its bus.
+        self.submodules.bus_window = Bus6502Window(self.cpu)
+        self.submodules.usb_wishbone = USBWishboneHost(usb_domain="sys" if simulation else "usb_12")
+        self.comb += [
+            self.bus_window.wishbone_adr_i.eq(self.usb_wishbone.wishbone_adr_o),
+            self.bus_window.wishbone_dat_i.eq(self.usb_wishbone.wishbone_dat_o),
+            self.usb_wishbone.wishbone_dat_i.eq(self.bus_window.wishbone_dat_o),
+            self.bus_window.wishbone_sel_i.eq(self.usb_wishbone.wishbone_sel_o),
+            self.bus_window.wishbone_cyc_i.eq(self.usb_wishbone.wishbone_cyc_o),
+            self.bus_window.wishbone_stb_i.eq(self.usb_wishbone.wishbone_stb_o),
+            self.bus_window.wishbone_we_i.eq(self.usb_wishbone.wishbone_we_o),
+            self.usb_wishbone.wishbone_ack_i.eq(self.bus_window.wishbone_ack_o),
+            self.usb_wishbone.wishbone_err_i.eq(self.bus_window.wishbone_err_o)
+            ]
+
+        # Block copies, which take the bus from the CPU (or the USB host).
+        if rom_region != "dma":
+            wide_regions = [self.memory_map[name] for name in self.memory_map
+                            if hasattr(getattr(self, name, None), "wide")]
+            self.submodules.dma = FomuDMA(platform, self.bus_window, wide_regions)
+            master = self.dma.port
+        else:
+            master = self.bus_window
 
+        # Decode the memory map and build the data bus (in), IRQ, NMI and RDY
+        # muxes, connecting up the chip selects as we go.
+        devices = {}
+        for name in self.memory_map:
+            if hasattr(self, name):
+                devices[name] = getattr(self, name)
+        self.submodules.bus = BusFabric(master, self.memory_map, devices, registered_bus)
+        self.address_bus = master.address
+        for name in self.memory_map:
+            setattr(self, name+"_sel", self.bus.fast_sel[name])
+            setattr(self, name+"_sel_slow", self.bus.slow_sel[name])
+        self.bus.print_report()
 
-        # Set up a dummyusb device.
-        from valentyusb.usbcore import io as usbio
-        usb_pads = platform.request("usb")
-        usb_iobuf = usbio.IoBuf(usb_pads.d_p, usb_pads.d_n, usb_pads.pullup)
-        self.submodules.usb = FomuUSBCDC(usb_iobuf)
+        if simulation:
+            # No USB core; a testbench (such as fomu_host.py's loopback)
+            # drives the bulk endpoints a transaction at a time.
+            from fomu_usb_endpoints import USBBulkEndpoints
+            self.submodules.usb = USBBulkEndpoints()
+        else:
+            # Set up a dummyusb device.
+            from fomu_usb_cdc import FomuUSBCDC
+            from valentyusb.usbcore import io as usbio
+            usb_pads = platform.request("usb")
+            usb_iobuf = usbio.IoBuf(usb_pads.d_p, usb_pads.d_n, usb_pads.pullup)
+            # The USB core runs entirely in the USB clock domains, whatever
+            # the CPU clock is.
+            self.submodules.usb = ClockDomainsRenamer({"sys": "usb_12"})(FomuUSBCDC(usb_iobuf))
+        if rom_region != "usb_serial":
+            self.comb += [
+                self.usb_serial.rx_data.eq(self.usb.bulk_out.source_data),
+                self.usb_serial.rx_we.eq(self.usb.bulk_out.source_we),
+                self.usb.bulk_out.source_writable.eq(self.usb_serial.rx_writable),
+                self.usb.bulk_in.sink_data.eq(self.usb_serial.tx_data),
+                self.usb.bulk_in.sink_readable.eq(self.usb_serial.tx_readable),
+                self.usb_serial.tx_re.eq(self.usb.bulk_in.sink_re)
+                ]
+        self.comb += [
+            self.usb_wishbone.rx_data.eq(self.usb.wishbone_out.source_data),
+            self.usb_wishbone.rx_we.eq(self.usb.wishbone_out.source_we),
+            self.usb.wishbone_out.source_writable.eq(self.usb_wishbone.rx_writable),
+            self.usb.wishbone_in.sink_data.eq(self.usb_wishbone.tx_data),
+            self.usb.wishbone_in.sink_readable.eq(self.usb_wishbone.tx_readable),
+            self.usb_wishbone.tx_re.eq(self.usb.wishbone_in.sink_re)
+            ]
         
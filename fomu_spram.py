@@ -1,12 +1,69 @@
 from migen import *
 from fomu_6502_bus import Bus6502
+
+class SPRAMBlock(Module):
+    """One of the UP5K's four 16K x 16 SB_SPRAM256KA blocks.
+
+    With simulation=True the SB_SPRAM256KA is replaced by a Memory that
+    behaves the same way, so migen's simulator can run it."""
+
+    def __init__(self, simulation=False):
+        self.address = Signal(14)
+        self.datain = Signal(16)
+        self.maskwren = Signal(4)
+        self.wren = Signal()
+        self.chipselect = Signal(reset=1)
+        self.dataout = Signal(16)
+
+        if simulation:
+            # Like the SPRAM, DATAOUT holds its value during writes and
+            # while deselected.
+            self.specials.mem = Memory(16, 16384)
+            port = self.mem.get_port(write_capable=True, async_read=True, we_granularity=8)
+            self.specials += port
+            self.comb += [
+                port.adr.eq(self.address),
+                port.dat_w.eq(self.datain),
+                port.we.eq(Mux(self.wren & self.chipselect, Cat(self.maskwren[0], self.maskwren[2]), 0)),
+                ]
+            self.sync += If(~self.wren & self.chipselect, self.dataout.eq(port.dat_r))
+            return
+
+        self.specials += Instance("SB_SPRAM256KA",
+                                      i_ADDRESS=self.address,
+                                      i_DATAIN=self.datain,
+                                      i_MASKWREN=self.maskwren,
+                                      i_WREN=self.wren,
+                                      i_CHIPSELECT=self.chipselect,
+                                      i_CLOCK=ClockSignal(),
+                                      i_STANDBY=0b0,
+                                      i_SLEEP=0b0,
+                                      i_POWEROFF=0b1,
+                                      o_DATAOUT=self.dataout
+                                      )
+
 class FomuSPRAM(Bus6502, Module):
     """Implements a 6502 bus interface to the ice40 UP's SPRAM.
     SPRAM is 16 bits wide_, so we need to multiplex everything in/out
-    down to 8 to make good use of it."""
+    down to 8 to make good use of it. A bus master that can (the DMA
+    controller) gets both bytes of a word at once with wide, the upper
+    one on data_in_high and data_out_high.
+
+    The last word read is kept, so a read of either of its bytes (the
+    operand after an opcode, say) is answered without the SPRAM, which is
+    only enabled when it has to be. held is set for those reads, while the
+    address is presented; a cycle later held_data and held_data_high have
+    the byte and the upper byte straight from flip-flops, which lets a
+    registered BusFabric skip its wait state."""
     
-    def __init__(self, platform):
+    def __init__(self, platform, simulation=False):
         super().__init__(platform)
+        self.wide = Signal()
+        self.data_in_high = Signal(8)
+        self.data_out_high = Signal(8)
+        self.held = Signal()
+        self.held_data = Signal(8)
+        self.held_data_high = Signal(8)
         
         # 16-bit domain signals.
         self.wide_address = Signal(14)
@@ -14,27 +71,115 @@ class FomuSPRAM(Bus6502, Module):
         self.wide_dataout = Signal(16)        
         self.wide_mask = Signal(4)
         self.wide_high_half = Signal()
+        self.wide_we = Signal()
 
+        # The write mask has to come from the address being written now;
+        # the registered half select is only right for read data, which
+        # comes back a cycle later. Only write when we're selected, or
+        # every write to an I/O device would land in RAM too.
         self.comb += [
             self.wide_address.eq(self.address[1:]),
             self.data_out.eq(Mux(self.wide_high_half, self.wide_dataout[8:], self.wide_dataout[:8])),
-            self.wide_datain.eq(Cat(self.data_in, self.data_in)),
-            self.wide_mask.eq(Mux(self.wide_high_half, 0b1100, 0b0011))
+            self.data_out_high.eq(self.wide_dataout[8:]),
+            self.wide_datain.eq(Cat(self.data_in, Mux(self.wide, self.data_in_high, self.data_in))),
+            self.wide_mask.eq(Mux(self.wide, 0b1111, Mux(self.address[0], 0b1100, 0b0011))),
+            self.wide_we.eq(self.we & self.cs)
             ]
 
         self.sync += [
             self.wide_high_half.eq(self.address[0]),
             ]
-        
-        self.specials += Instance("SB_SPRAM256KA",
-                                      i_ADDRESS=self.wide_address,
-                                      i_DATAIN=self.wide_datain,
-                                      i_MASKWREN=self.wide_mask,
-                                      i_WREN=self.we,
-                                      i_CHIPSELECT=0b1,
-                                      i_CLOCK=ClockSignal(),
-                                      i_STANDBY=0b0,
-                                      i_SLEEP=0b0,
-                                      i_POWEROFF=0b1,
-                                      o_DATAOUT=self.wide_dataout
-                                      )
+
+        self.submodules.block = block = SPRAMBlock(simulation)
+
+        # The kept word. Its address is taken when the SPRAM reads it and
+        # its data when that comes out, the next cycle; a write to it
+        # makes it stale. DATAOUT holds the same word while the SPRAM is
+        # deselected or writing, so data_out can still come from there;
+        # the copy is for held_data, as DATAOUT is slow to change.
+        word = Signal(16)
+        word_address = Signal(14)
+        word_valid = Signal()
+        reading = Signal()
+        was_reading = Signal()
+        self.comb += [
+            self.held.eq(self.cs & ~self.we & word_valid & (word_address == self.wide_address)),
+            reading.eq(self.cs & ~self.we & ~self.held),
+            self.held_data.eq(Mux(self.wide_high_half, word[8:], word[:8])),
+            self.held_data_high.eq(word[8:]),
+            ]
+        self.sync += [
+            was_reading.eq(reading),
+            If(was_reading, word.eq(block.dataout)),
+            If(reading,
+                word_address.eq(self.wide_address),
+                word_valid.eq(1)
+            ).Elif(self.wide_we & (word_address == self.wide_address),
+                word_valid.eq(0)
+            )
+            ]
+
+        self.comb += [
+            block.address.eq(self.wide_address),
+            block.datain.eq(self.wide_datain),
+            block.maskwren.eq(self.wide_mask),
+            block.wren.eq(self.wide_we),
+            block.chipselect.eq(reading | self.wide_we),
+            self.wide_dataout.eq(block.dataout)
+            ]
+
+class FomuPagedSPRAM(Bus6502, Module):
+    """A 16K window onto the three SPRAM blocks FomuSPRAM doesn't use,
+    which hold 6 banks of 16K. bank picks the one that's visible (it comes
+    from FomuPagingRegister); with any other value the window reads as 0
+    and ignores writes, as though nothing were there. wide accesses work
+    as they do for FomuSPRAM."""
+
+    banks = 6
+
+    def __init__(self, platform, simulation=False):
+        super().__init__(platform)
+        self.bank = Signal(8)
+        self.wide = Signal()
+        self.data_in_high = Signal(8)
+        self.data_out_high = Signal(8)
+
+        valid = Signal()
+        block_select = Signal(2)
+        read_valid = Signal()
+        read_block = Signal(2)
+        read_high_half = Signal()
+        self.comb += [
+            valid.eq(self.bank < self.banks),
+            block_select.eq(self.bank[1:3]),
+            ]
+        self.sync += [
+            read_valid.eq(valid),
+            read_block.eq(block_select),
+            read_high_half.eq(self.address[0]),
+            ]
+
+        # Two banks to a block; the bank's low bit is the top address bit.
+        # Only the block holding the bank is enabled, so the others idle.
+        outputs = []
+        for i in range(self.banks // 2):
+            block = SPRAMBlock(simulation)
+            self.submodules += block
+            selected = valid & (block_select == i)
+            self.comb += [
+                block.address.eq(Cat(self.address[1:14], self.bank[0])),
+                block.datain.eq(Cat(self.data_in, Mux(self.wide, self.data_in_high, self.data_in))),
+                block.maskwren.eq(Mux(self.wide, 0b1111, Mux(self.address[0], 0b1100, 0b0011))),
+                block.wren.eq(self.we & self.cs & selected),
+                block.chipselect.eq(selected)
+                ]
+            outputs.append(block.dataout)
+
+        wide_dataout = Signal(16)
+        self.comb += [
+            wide_dataout.eq(Array(outputs)[read_block]),
+            If(read_valid,
+                self.data_out.eq(Mux(read_high_half, wide_dataout[8:], wide_dataout[:8])),
+                self.data_out_high.eq(wide_dataout[8:])
+            )
+            ]
@@ -9,18 +9,15 @@ from migen.genlib import fsm, fifo
 from valentyusb.usbcore.endpoint import EndpointType, EndpointResponse
 from valentyusb.usbcore.pid import PID, PIDTypes
 from valentyusb.usbcore.sm.transfer import UsbTransfer
-from valentyusb.usbcore.cpu.usbwishbonebridge import USBWishboneBridge
 
-def build_case_mux(selector, cases):
-    """Build an N-way multiplexer (just like Case() except we can
-    handle expressions not just statements.)"""
-    if "default" in cases:
-        output = cases["default"]
-    else:
-        output = 0
+from fomu_usb_endpoints import Endpoint, BulkOutEndpoint, BulkInEndpoint
 
-    for case, val in cases.items():
-        output = Mux(selector==case, val, output)
+def build_select_mux(cases, default=0):
+    """Build an N-way multiplexer from (select, value) pairs, whose
+    selects are one-hot. With nothing selected it gives default."""
+    output = default
+    for select, value in cases:
+        output = Mux(select, value, output)
 
     return output
 
@@ -33,16 +30,7 @@ def _limit_eq(var, value, limiting_value):
     
 
 
-class Endpoint(Module):
-    """Generic USB endpoint as a FIFO.
-    Assumes both in and out streams; obviously both may not be required. 
-    """
-    def __init__(self, usb_bus, input_fifo_size : int = 128, output_fifo_size : int = 128):
-        # FIFOs for data in/out.
-        input_fifo = self.submodules.input_fifo = fifo.SyncFIFO(8, 128, fwft = False)
-        output_fifo = self.submodules.input_fifo = fifo.SyncFIFO(8, 128, fwft = False)
-    
-class ControlEndpoint(Module):
+class ControlEndpoint(Endpoint):
     """Control endpoint, handles USB setup packets.
     """
 
@@ -62,21 +50,7 @@ class ControlEndpoint(Module):
 
     def __init__(self, vid = 0x1209, pid = 0x5bf0, product = "Fomu 6502 Bridge", manufacturer = "Dark Devices"):
 
-        # IOs to/from USB core.
-
-        # Inputs
-        self.start = Signal()
-        self.token = Signal(2)
-        self.data_recv_payload = Signal(8)
-        self.data_recv_put = Signal()
-        self.data_send_get = Signal()
-
-        # Outputs
-        self.data_send_payload = Signal(8)
-        self.data_send_have = Signal()
-        self.dtb = Signal()
-        self.ack = Signal()
-        self.stall = Signal()
+        super().__init__()
         self.address = Signal(7)
         
         # WCID Vendor code.
@@ -104,7 +78,7 @@ class ControlEndpoint(Module):
                 0x09, # bLength
                 0x02, # bDescriptorType
                 0x12, 0x00, # wTotalLength
-                0x02, # bNumInterfaces
+                0x03, # bNumInterfaces
                 0x01, # bConfigurationValue
                 0x00, # iConfiguration
                 0x80, # bmAttributes
@@ -141,8 +115,7 @@ class ControlEndpoint(Module):
                 6,    # bmCapabilities
 
                 # Union Functional Descriptor - should be needed but
-                # seems to work if omitted. This allows us to fit
-                # the descriptor in under 64 bytes.
+                # seems to work if omitted.
                 #0x05, # bFunctionLength
                 #0x24, # bDescriptorType - CS_INTERFACE
                 #0x06, # bDescriptorSubType - USB_CDC_TYPE_UNION
@@ -183,6 +156,34 @@ class ControlEndpoint(Module):
                 0x02, # bmAttributes - USB_ENDPOINT_ATTR_BULK
                 0x40, 0x00, # wMaxPacketSize,
                 0x01, # bInterval
+
+                # Interface Descriptor, Wishbone host access (see
+                # fomu_usb_wishbone.py).
+                0x09, # bLength
+                0x04, # bDescriptorType - USB_DT_INTERFACE
+                0x02, # bInterfaceNumber
+                0x00, # bAlternateSetting
+                0x02, # bNumEndpoints
+                0xFF, # bInterfaceClass - vendor specific
+                0x00, # bInterfaceSubClass
+                0x00, # bInterfaceProtocol
+                0x00, # iInterface
+
+                # Endpoint Descriptor
+                0x07, # bLength
+                0x05, # bDescriptorType - USB_DT_ENDPOINT
+                0x83, # bEndpointAddress
+                0x02, # bmAttributes - USB_ENDPOINT_ATTR_BULK
+                0x40, 0x00, # wMaxPacketSize
+                0x01, # bInterval
+
+                # Endpoint Descriptor
+                0x07, # bLength
+                0x05, # bDescriptorType - USB_DT_ENDPOINT
+                0x03, # bEndpointAddress
+                0x02, # bmAttributes - USB_ENDPOINT_ATTR_BULK
+                0x40, 0x00, # wMaxPacketSize,
+                0x01, # bInterval
                 ],
         0x300: [ # usb_string0_descriptor
                     0x04, 0x03, 0x09, 0x04,
@@ -220,7 +221,7 @@ class ControlEndpoint(Module):
             0x04, 0x00, # Compatibility ID descriptor index
             0x01, # Number of sections
             0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, # 7 reserved bytes.
-            0x00, # Interface number
+            0x02, # Interface number - the Wishbone one, for WinUSB
             0x01, # Reserved
             ord('W'), ord('I'), ord('N'), ord('U'), ord('S'), ord('B'), 0, 0, # Compatible ID
             0,0,0,0,0,0,0,0, # Sub-compatible ID
@@ -245,7 +246,6 @@ class ControlEndpoint(Module):
             descriptor_start_address[descriptor_id] = next_address
             memory_contents += descriptor_data
             next_address += len(descriptor_data)
-            print("Mapped descriptor", descriptor_id,"to",hex(next_address))
 
         # We also need to store the WCID descriptor and default status report here.
         usb_wcid_descriptor_address = next_address
@@ -255,10 +255,11 @@ class ControlEndpoint(Module):
         usb_device_status_report_address = next_address
         memory_contents += usb_device_status_report
         next_address += len(usb_device_status_report)
+        print("Mapped", len(usb_descriptors) + 2, "USB descriptors into", next_address, "bytes")
 
         # Set up the actual buffer.
         out_buffer = self.specials.out_buffer = Memory(8, len(memory_contents), init=memory_contents)
-        descriptor_bytes_remaining = Signal(6) # Maximum number of bytes in USB is 64
+        descriptor_bytes_remaining = Signal(16)
         self.specials.out_buffer_rd = out_buffer_rd = out_buffer.get_port(write_capable=False, clock_domain="usb_12")
 
         # Response start address, length, and whether we're ack-ing it or not.
@@ -269,6 +270,17 @@ class ControlEndpoint(Module):
         # Delayed transaction start signal.
         last_start = Signal()
 
+        # Responses longer than a packet go out max_packet bytes at a time,
+        # DATA1 first. packet_addr and packet_remaining are where the
+        # current packet starts, so it can be sent again if the host doesn't
+        # acknowledge it.
+        max_packet = 64
+        packet_addr = Signal(9)
+        packet_remaining = Signal(16)
+        packet_bytes = Signal(max=max_packet + 1)
+        new_response = Signal()
+        dtb = Signal()
+
         # SETUP packets contain a DATA segment that is always 8 bytes
         # (for our purposes)
         bmRequestType = Signal(8)
@@ -299,8 +311,6 @@ class ControlEndpoint(Module):
             ]
 
         # Do we stall, or respond?
-        self.stall = Signal()
-        self.ack = Signal()
         self.comb += [
             self.stall.eq(~(have_response | response_ack)),
             self.ack.eq(have_response | response_ack)
@@ -317,7 +327,8 @@ class ControlEndpoint(Module):
         # Map buffer output and have_response to outputs.
         self.comb += [
             self.data_send_payload.eq(out_buffer_rd.dat_r),
-            self.data_send_have.eq(have_response)
+            self.data_send_have.eq(have_response & (packet_bytes != max_packet)),
+            self.dtb.eq(dtb)
             ]
         
         self.sync += [
@@ -327,12 +338,30 @@ class ControlEndpoint(Module):
                           setup_index.eq(0),
                           descriptor_bytes_remaining.eq(0)
                     ).Elif(transaction_queued,
-                               self.ack.eq(1),
+                               response_ack.eq(1),
                                transaction_queued.eq(0),
                                self.address.eq(new_address))
                                ),
+            If(last_start & (self.token == PID.IN),
+                packet_bytes.eq(0),
+                If(new_response,
+                    packet_addr.eq(response_addr),
+                    packet_remaining.eq(descriptor_bytes_remaining),
+                    new_response.eq(0)
+                ).Else(
+                    response_addr.eq(packet_addr),
+                    descriptor_bytes_remaining.eq(packet_remaining)
+                )
+            ),
+            If(self.commit & (self.token == PID.IN),
+                packet_addr.eq(response_addr),
+                packet_remaining.eq(descriptor_bytes_remaining),
+                dtb.eq(~dtb)
+            ),
             If(self.token == PID.SETUP,
                 If(self.data_recv_put,
+                    new_response.eq(1),
+                    dtb.eq(1),
                     If(setup_index < 8,
                         setup_index.eq(setup_index + 1),
                     ),
@@ -348,18 +377,22 @@ class ControlEndpoint(Module):
                     }),
                 ),
             ),
-            If(self.token == PID.SETUP,
+            # Answer once the whole setup packet is in, so nothing is left
+            # over from the last request.
+            If((self.token == PID.SETUP) & (setup_index == 8) & ~last_start,
                    Case (bmRequestType, {
                        0x80: If(bRequest == 0x06,
                                     Case(wValue, descriptor_cases)).Elif(
                            bRequest == 0x00,
                            response_addr.eq(usb_device_status_report_address),
-                           _limit_eq(response_len, wLength, len(usb_device_status_report))
+                           _limit_eq(response_len, wLength, len(usb_device_status_report)),
+                           _limit_eq(descriptor_bytes_remaining, wLength, len(usb_device_status_report))
                            ),
                               # MS Extended Compat ID OS Feature
                 0xc0: [
                     response_addr.eq(usb_wcid_descriptor_address),
-                    _limit_eq(response_len, wLength, len(usb_wcid_descriptor))
+                    _limit_eq(response_len, wLength, len(usb_wcid_descriptor)),
+                    _limit_eq(descriptor_bytes_remaining, wLength, len(usb_wcid_descriptor))
                     ],
                 # Set Address / Configuration
                 0x00: [
@@ -375,6 +408,7 @@ class ControlEndpoint(Module):
             If(self.data_send_get,
                 response_ack.eq(1),
                 response_addr.eq(response_addr + 1),
+                packet_bytes.eq(packet_bytes + 1),
                 If(descriptor_bytes_remaining,
                     descriptor_bytes_remaining.eq(descriptor_bytes_remaining - 1),
                 ),
@@ -387,10 +421,17 @@ class ControlEndpoint(Module):
         
 class FomuUSBCDC(Module):
     """
-        Basic CDC implementation for the Fomu 6502 core.
+        Basic CDC implementation for the Fomu 6502 core: the control
+        endpoint on EP0, and the bulk data endpoints on EP2. EP1 (the
+        notification endpoint) always NAKs. EP3 is a second pair of bulk
+        endpoints, on a vendor specific interface, for USBWishboneHost.
+
+        Data from the host comes out of bulk_out.source_*, and data for it
+        goes in to bulk_in.sink_*; likewise wishbone_out and wishbone_in
+        for EP3.
     """
 
-    def __init__(self, iobuf, endpoints = [ControlEndpoint()]):
+    def __init__(self, iobuf):
         # USB Core
         self.submodules.usb_core = usb_core = UsbTransfer(iobuf)
 
@@ -399,64 +440,62 @@ class FomuUSBCDC(Module):
             self.comb += usb_core.iobuf.usb_pullup.eq(1)
         self.iobuf = usb_core.iobuf
 
-        # Current endpoint.
-        endpoint = Signal(4)
-        self.comb += [
-            endpoint.eq(usb_core.endp)
+        self.submodules.control = ControlEndpoint()
+        self.submodules.bulk_out = BulkOutEndpoint()
+        self.submodules.bulk_in = BulkInEndpoint()
+        self.submodules.wishbone_out = BulkOutEndpoint()
+        self.submodules.wishbone_in = BulkInEndpoint()
+
+        # Endpoint number, the token it handles (None for all of them) and
+        # the endpoint.
+        endpoints = [
+            (0, None, self.control),
+            (2, PID.OUT, self.bulk_out),
+            (2, PID.IN, self.bulk_in),
+            (3, PID.OUT, self.wishbone_out),
+            (3, PID.IN, self.wishbone_in),
             ]
-        
+
+        selects = []
+        for number, token, endpoint in endpoints:
+            select = Signal()
+            if token is None:
+                self.comb += select.eq(usb_core.endp == number)
+            else:
+                self.comb += select.eq((usb_core.endp == number) & (usb_core.tok == token))
+            selects.append((select, endpoint))
+
+            # The token and received data go to every endpoint, strobes
+            # only to the one selected.
+            self.comb += [
+                endpoint.token.eq(usb_core.tok),
+                endpoint.data_recv_payload.eq(usb_core.data_recv_payload),
+                endpoint.start.eq(usb_core.start & select),
+                endpoint.commit.eq(usb_core.commit & select),
+                endpoint.data_recv_put.eq(usb_core.data_recv_put & select),
+                endpoint.data_send_get.eq(usb_core.data_send_get & select),
+                ]
+
         # Mux stall/ack/dtb signals across endpoints.
         self.comb += [
             # Stall?
-            usb_core.sta.eq(build_case_mux(endpoint, {
-                ep_id: endpoints[ep_id].stall for ep_id in range(len(endpoints))
-                })),
+            usb_core.sta.eq(build_select_mux((s, e.stall) for s, e in selects)),
             # Send ACK in response?
-            usb_core.arm.eq(build_case_mux(endpoint, {
-                ep_id: endpoints[ep_id].ack for ep_id in range(len(endpoints))
-                })),
+            usb_core.arm.eq(build_select_mux((s, e.ack) for s, e in selects)),
             # Output appropriate data toggle bit.
-            usb_core.dtb.eq(build_case_mux(endpoint, {
-                ep_id: endpoints[ep_id].dtb for ep_id in range(len(endpoints))
-                })),
+            usb_core.dtb.eq(build_select_mux((s, e.dtb) for s, e in selects)),
             # Map the endpoint's readable status to the core's data_send_have.
-            usb_core.data_send_have.eq(build_case_mux(endpoint, {
-                ep_id: endpoints[ep_id].data_send_have for ep_id in range(len(endpoints))
-                })),
+            usb_core.data_send_have.eq(build_select_mux((s, e.data_send_have) for s, e in selects)),
             # Map the endpoint's output to the core's data_send_payload
-            usb_core.data_send_payload.eq(build_case_mux(endpoint, {
-                ep_id: endpoints[ep_id].data_send_payload for ep_id in range(len(endpoints))
-                })),
+            usb_core.data_send_payload.eq(build_select_mux((s, e.data_send_payload) for s, e in selects)),
         ]
 
-        # Send the input stream from the USB core to all endpoints' input bits.
-        self.comb += [
-            endpoints[ep_id].data_recv_payload.eq(usb_core.data_recv_payload) for ep_id in range(len(endpoints))
-            ]
-        # But the recv_data_put to only the active endpoint.
-        self.comb += [
-            endpoints[ep_id].data_recv_put.eq(usb_core.data_recv_payload & wrap(ep_id==endpoint)) for ep_id in range(len(endpoints))
-            ]
-        # Same for data_send_get
-        self.comb += [
-            endpoints[ep_id].data_send_get.eq(usb_core.data_send_get & wrap(ep_id==endpoint)) for ep_id in range(len(endpoints))
-            ]
-        
-        
-        # Send the token type to all endpoints
-        self.comb += [
-            endpoints[ep_id].data_recv_payload.eq(usb_core.data_recv_payload) for ep_id in range(len(endpoints))
-            ]
-
         # Use the control endpoint's address value for the USB core.
         self.comb += [
-            usb_core.addr.eq(endpoints[0].address),
+            usb_core.addr.eq(self.control.address),
             ]
-        
+
         # Reset on error.
         self.sync += [
-            If(usb_core.error,
-                usb_core.reset.eq(1),
-            ),
+            usb_core.reset.eq(usb_core.error),
         ]
-        
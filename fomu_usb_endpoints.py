@@ -0,0 +1,190 @@
+from migen import *
+
+# The USB endpoints that don't need anything from valentyusb, so that a
+# simulation can use them without a USB core.
+
+class Endpoint(Module):
+    """Signals between an endpoint and the USB core. FomuUSBCDC only
+    pulses start, commit, data_recv_put and data_send_get for the endpoint
+    a transaction is addressed to; the rest are shared.
+    """
+    def __init__(self):
+        # Inputs
+        self.start = Signal() # A transaction for this endpoint has begun...
+        self.commit = Signal() # ...and has been acknowledged.
+        self.token = Signal(4)
+        self.data_recv_payload = Signal(8)
+        self.data_recv_put = Signal()
+        self.data_send_get = Signal()
+
+        # Outputs
+        self.data_send_payload = Signal(8)
+        self.data_send_have = Signal()
+        self.dtb = Signal()
+        self.ack = Signal() # Accept OUT data, or answer IN with data; NAK otherwise.
+        self.stall = Signal()
+
+class BulkOutEndpoint(Endpoint):
+    """Host to device bulk endpoint, double buffered in block RAM.
+
+    Each packet is received into one half of the buffer while the other
+    half drains out through source_data/source_we (whenever
+    source_writable), so the host can send the next packet before the last
+    one has been consumed. With both halves full the host is NAKed.
+    """
+    def __init__(self, max_packet=64):
+        super().__init__()
+        self.source_data = Signal(8)
+        self.source_we = Signal()
+        self.source_writable = Signal()
+
+        # The core passes the CRC16 on after the payload, so leave room.
+        offset_bits = bits_for(max_packet + 1)
+        half = 1 << offset_bits
+        buffer = Memory(8, 2 * half)
+        wr = buffer.get_port(write_capable=True)
+        rd = buffer.get_port()
+        self.specials += buffer, wr, rd
+
+        full = Array(Signal() for i in range(2))
+        lengths = Array(Signal(offset_bits) for i in range(2))
+
+        # Receive into the fill half.
+        fill = Signal()
+        wptr = Signal(offset_bits + 1)
+        self.comb += [
+            self.ack.eq(~full[fill]),
+            wr.adr.eq(Cat(wptr[:offset_bits], fill)),
+            wr.dat_w.eq(self.data_recv_payload),
+            wr.we.eq(self.data_recv_put & ~full[fill] & (wptr < half))
+            ]
+        self.sync += [
+            If(self.start,
+                wptr.eq(0)
+            ).Elif(self.data_recv_put & (wptr < half),
+                wptr.eq(wptr + 1)
+            ),
+            If(self.commit & ~full[fill],
+                full[fill].eq(1),
+                lengths[fill].eq(wptr - 2),
+                fill.eq(~fill)
+            )
+            ]
+
+        # Drain the other. The read port is given the next address, so
+        # rd.dat_r is always the byte at rptr.
+        drain = Signal()
+        rptr = Signal(offset_bits)
+        next_drain = Signal()
+        next_rptr = Signal(offset_bits)
+        self.comb += [
+            next_drain.eq(drain),
+            next_rptr.eq(rptr),
+            self.source_data.eq(rd.dat_r),
+            If(full[drain],
+                If(rptr == lengths[drain],
+                    next_drain.eq(~drain),
+                    next_rptr.eq(0)
+                ).Elif(self.source_writable,
+                    self.source_we.eq(1),
+                    next_rptr.eq(rptr + 1)
+                )
+            ),
+            rd.adr.eq(Cat(next_rptr, next_drain))
+            ]
+        self.sync += [
+            drain.eq(next_drain),
+            rptr.eq(next_rptr),
+            If(full[drain] & (rptr == lengths[drain]),
+                full[drain].eq(0)
+            )
+            ]
+
+class BulkInEndpoint(Endpoint):
+    """Device to host bulk endpoint, double buffered in block RAM.
+
+    Bytes from sink_data (read with sink_re while sink_readable) fill one
+    half of the buffer. The half is handed over as a packet when it is
+    full, or as a short packet as soon as the stream runs dry while the
+    other half is idle, so a trickle of bytes isn't held back. The host is
+    NAKed while there is no packet to send; a packet that isn't
+    acknowledged is sent again.
+    """
+    def __init__(self, max_packet=64):
+        super().__init__()
+        self.sink_data = Signal(8)
+        self.sink_re = Signal()
+        self.sink_readable = Signal()
+
+        offset_bits = log2_int(max_packet)
+        buffer = Memory(8, 2 * max_packet)
+        wr = buffer.get_port(write_capable=True)
+        rd = buffer.get_port()
+        self.specials += buffer, wr, rd
+
+        full = Array(Signal() for i in range(2))
+        lengths = Array(Signal(offset_bits + 1) for i in range(2))
+
+        # Fill one half from the stream.
+        fill = Signal()
+        wptr = Signal(offset_bits + 1)
+        flush = Signal()
+        self.comb += [
+            wr.adr.eq(Cat(wptr[:offset_bits], fill)),
+            wr.dat_w.eq(self.sink_data),
+            self.sink_re.eq(~full[fill] & (wptr != max_packet) & self.sink_readable),
+            wr.we.eq(self.sink_re),
+            flush.eq(~full[fill] & ((wptr == max_packet) |
+                                    ((wptr != 0) & ~self.sink_readable & ~full[~fill])))
+            ]
+        self.sync += [
+            If(self.sink_re,
+                wptr.eq(wptr + 1)
+            ),
+            If(flush,
+                full[fill].eq(1),
+                lengths[fill].eq(wptr),
+                fill.eq(~fill),
+                wptr.eq(0)
+            )
+            ]
+
+        # Send the other. Every transaction starts from the beginning of
+        # the packet, which takes care of retries.
+        send = Signal()
+        rptr = Signal(offset_bits + 1)
+        next_rptr = Signal(offset_bits + 1)
+        dtb = Signal()
+        self.comb += [
+            self.ack.eq(full[send]),
+            self.dtb.eq(dtb),
+            self.data_send_have.eq(full[send] & (rptr != lengths[send])),
+            self.data_send_payload.eq(rd.dat_r),
+            If(self.start,
+                next_rptr.eq(0)
+            ).Elif(self.data_send_get,
+                next_rptr.eq(rptr + 1)
+            ).Else(
+                next_rptr.eq(rptr)
+            ),
+            rd.adr.eq(Cat(next_rptr[:offset_bits], send))
+            ]
+        self.sync += [
+            rptr.eq(next_rptr),
+            If(self.commit & full[send],
+                full[send].eq(0),
+                send.eq(~send),
+                dtb.eq(~dtb)
+            )
+            ]
+
+class USBBulkEndpoints(Module):
+    """FomuUSBCDC's bulk endpoints with no USB core in front of them, for
+    simulation. The testbench plays the USB core, strobing each endpoint's
+    start, data_recv_put, data_send_get and commit itself."""
+
+    def __init__(self):
+        self.submodules.bulk_out = BulkOutEndpoint()
+        self.submodules.bulk_in = BulkInEndpoint()
+        self.submodules.wishbone_out = BulkOutEndpoint()
+        self.submodules.wishbone_in = BulkInEndpoint()
@@ -0,0 +1,188 @@
+from migen import *
+from migen.genlib.fsm import FSM, NextState, NextValue
+from fomu_cdc import StreamCrossing
+
+# Command opcodes. FIXED can be added to READ or WRITE to keep the address
+# the same for every word, for FIFO-like registers.
+NOP = 0x00
+WRITE = 0x01
+READ = 0x02
+FIXED = 0x80
+
+# Status bytes.
+OK = 0x00
+BUS_ERROR = 0x01
+BAD_COMMAND = 0x02
+
+class USBWishboneHost(Module):
+    """Wishbone master for the USB host, driven by a stream of commands
+    from a bulk OUT endpoint, with the replies going back on a bulk IN
+    endpoint.
+
+    Each command is an opcode byte, then for READ and WRITE a 4-byte byte
+    address (which should be word aligned) and a 2-byte word count, both
+    little-endian. WRITE is followed by the data, 4 bytes per word, and
+    READ is answered with it. Every command ends with a status byte in
+    reply: OK, BUS_ERROR if any word got err (a word that errs reads as
+    0), or BAD_COMMAND for an unknown opcode, after which nothing more is
+    read from the command. Commands are read back to back, so one packet
+    can carry any number of them, and a command can span packets.
+
+    The USB side is clocked by usb_domain, and connects like
+    FomuUSBSerial's."""
+
+    def __init__(self, usb_domain="usb_12", depth=16):
+        self.submodules.rx = rx = StreamCrossing(usb_domain, "sys", depth=depth)
+        self.submodules.tx = tx = StreamCrossing("sys", usb_domain, depth=depth)
+
+        self.rx_data = rx.din
+        self.rx_we = rx.we
+        self.rx_writable = rx.writable
+        self.tx_data = tx.dout
+        self.tx_re = tx.re
+        self.tx_readable = tx.readable
+
+        # Wishbone signals.
+        self.wishbone_adr_o = Signal(30)
+        self.wishbone_dat_o = Signal(32)
+        self.wishbone_dat_i = Signal(32)
+        self.wishbone_sel_o = Signal(4)
+        self.wishbone_cyc_o = Signal()
+        self.wishbone_stb_o = Signal()
+        self.wishbone_we_o = Signal()
+        self.wishbone_ack_i = Signal()
+        self.wishbone_err_i = Signal()
+
+        opcode = Signal(8)
+        address = Signal(32)
+        count = Signal(16)
+        word = Signal(32)
+        index = Signal(2)
+        status = Signal(8)
+
+        self.comb += [
+            self.wishbone_adr_o.eq(address[2:]),
+            self.wishbone_dat_o.eq(word),
+            self.wishbone_sel_o.eq(0xF),
+            ]
+
+        fsm = FSM(reset_state="COMMAND")
+        self.submodules.fsm = fsm
+
+        fsm.act("COMMAND",
+            rx.re.eq(1),
+            If(rx.readable,
+                NextValue(opcode, rx.dout),
+                NextValue(index, 0),
+                If((rx.dout & ~FIXED) == WRITE,
+                    NextState("ADDRESS")
+                ).Elif((rx.dout & ~FIXED) == READ,
+                    NextState("ADDRESS")
+                ).Elif(rx.dout == NOP,
+                    NextState("STATUS")
+                ).Else(
+                    NextValue(status, BAD_COMMAND),
+                    NextState("STATUS")
+                )
+            )
+        )
+        # Address and count come in least significant byte first, so shift
+        # them in from the top.
+        fsm.act("ADDRESS",
+            rx.re.eq(1),
+            If(rx.readable,
+                NextValue(address, Cat(address[8:], rx.dout)),
+                NextValue(index, index + 1),
+                If(index == 3,
+                    NextValue(index, 0),
+                    NextState("COUNT")
+                )
+            )
+        )
+        fsm.act("COUNT",
+            rx.re.eq(1),
+            If(rx.readable,
+                NextValue(count, Cat(count[8:], rx.dout)),
+                NextValue(index, 0),
+                If(index == 0,
+                    NextValue(index, 1)
+                ).Elif(Cat(count[8:], rx.dout) == 0,
+                    NextState("STATUS")
+                ).Elif(opcode[0],
+                    NextState("WRITE_DATA")
+                ).Else(
+                    NextState("READ_BUS")
+                )
+            )
+        )
+
+        fsm.act("WRITE_DATA",
+            rx.re.eq(1),
+            If(rx.readable,
+                NextValue(word, Cat(word[8:], rx.dout)),
+                NextValue(index, index + 1),
+                If(index == 3,
+                    NextState("WRITE_BUS")
+                )
+            )
+        )
+        fsm.act("WRITE_BUS",
+            self.wishbone_cyc_o.eq(1),
+            self.wishbone_stb_o.eq(1),
+            self.wishbone_we_o.eq(1),
+            If(self.wishbone_ack_i | self.wishbone_err_i,
+                If(self.wishbone_err_i,
+                    NextValue(status, BUS_ERROR)
+                ),
+                NextValue(count, count - 1),
+                If(~opcode[7],
+                    NextValue(address, address + 4)
+                ),
+                If(count == 1,
+                    NextState("STATUS")
+                ).Else(
+                    NextState("WRITE_DATA")
+                )
+            )
+        )
+
+        fsm.act("READ_BUS",
+            self.wishbone_cyc_o.eq(1),
+            self.wishbone_stb_o.eq(1),
+            If(self.wishbone_ack_i,
+                NextValue(word, self.wishbone_dat_i),
+                NextState("READ_DATA")
+            ).Elif(self.wishbone_err_i,
+                NextValue(word, 0),
+                NextValue(status, BUS_ERROR),
+                NextState("READ_DATA")
+            )
+        )
+        fsm.act("READ_DATA",
+            tx.din.eq(word[:8]),
+            tx.we.eq(1),
+            If(tx.writable,
+                NextValue(word, word[8:]),
+                NextValue(index, index + 1),
+                If(index == 3,
+                    NextValue(count, count - 1),
+                    If(~opcode[7],
+                        NextValue(address, address + 4)
+                    ),
+                    If(count == 1,
+                        NextState("STATUS")
+                    ).Else(
+                        NextState("READ_BUS")
+                    )
+                )
+            )
+        )
+
+        fsm.act("STATUS",
+            tx.din.eq(status),
+            tx.we.eq(1),
+            If(tx.writable,
+                NextValue(status, OK),
+                NextState("COMMAND")
+            )
+        )
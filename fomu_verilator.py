@@ -0,0 +1,109 @@
+import ctypes
+import os
+import subprocess
+from collections import namedtuple
+
+SimResult = namedtuple("SimResult", ("reason", "cycles", "pc"))
+
+# Matches the STOP_* values in verilator_harness.cpp.
+STOP_REASONS = ["cycles", "pc", "write", "finish"]
+
+class VerilatorSim(object):
+    """Fast simulation of the generated SoC, using Verilator.
+
+    build_dir is the directory platform.build() wrote top.v to. The
+    Verilog is compiled, with the iCE40 primitive models in sim_models.v,
+    into a shared library which is then loaded and driven through ctypes.
+    flash_image, if given, is what the SPI flash holds at the OS ROM's
+    offset. sources are the CPU core's Verilog (fomu_6502_cpu.CPU_SOURCES).
+    """
+
+    def __init__(self, build_dir, sources=("cpu.v", "ALU.v"), verilator="verilator", flash_image=None):
+        self.handle = None
+        self.base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.build_dir = os.path.abspath(build_dir)
+        self.obj_dir = os.path.join(self.build_dir, "obj_dir")
+        library = os.path.join(self.obj_dir, "libfomusim.so")
+
+        files = [os.path.join(self.base_dir, "verilator_top.v"),
+                 os.path.join(self.build_dir, "top.v"),
+                 os.path.join(self.base_dir, "sim_models.v")]
+        files += [os.path.join(self.base_dir, s) for s in sources]
+        harness = os.path.join(self.base_dir, "verilator_harness.cpp")
+
+        # Rebuilding takes a while, so only do it when something changed,
+        # including which files the core comes from.
+        stamp = os.path.join(self.obj_dir, "sources")
+        built_from = None
+        if os.path.exists(stamp):
+            with open(stamp) as f:
+                built_from = f.read()
+        if not os.path.exists(library) or built_from != "\n".join(files) or \
+           max(os.path.getmtime(f) for f in files + [harness]) > os.path.getmtime(library):
+            command = [verilator, "--cc", "--exe", "--build", "-O3",
+                       "-Wno-fatal", "-Wno-lint", "-Wno-style",
+                       "--top-module", "verilator_top",
+                       "--Mdir", self.obj_dir,
+                       "-CFLAGS", "-fPIC -O2",
+                       "-LDFLAGS", "-shared",
+                       "-o", "libfomusim.so"]
+            subprocess.check_call(command + files + [harness])
+            with open(stamp, "w") as f:
+                f.write("\n".join(files))
+
+        self.lib = ctypes.CDLL(library)
+        self.lib.fomusim_new.restype = ctypes.c_void_p
+        self.lib.fomusim_free.argtypes = [ctypes.c_void_p]
+        self.lib.fomusim_run.restype = ctypes.c_int
+        self.lib.fomusim_run.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int32, ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_uint32)]
+        self.lib.fomusim_peek.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        self.lib.fomusim_leds.argtypes = [ctypes.c_void_p]
+
+        # The flash model loads flash.hex from the build directory, if it's there.
+        flash_hex = os.path.join(self.build_dir, "flash.hex")
+        if flash_image is not None:
+            with open(flash_hex, "w") as f:
+                f.write("\n".join("%02x" % b for b in flash_image) + "\n")
+        elif os.path.exists(flash_hex):
+            os.remove(flash_hex)
+
+        # $readmemh paths in top.v are relative to the build directory.
+        cwd = os.getcwd()
+        os.chdir(self.build_dir)
+        try:
+            self.handle = self.lib.fomusim_new()
+        finally:
+            os.chdir(cwd)
+
+    def run(self, cycles, stop_pc=None, stop_write=None):
+        """Run for at most 'cycles' CPU clock cycles, stopping early when an
+        instruction at stop_pc is fetched or the CPU writes to stop_write.
+        Returns a SimResult; cycles and pc are totals since construction."""
+        total = ctypes.c_uint64()
+        pc = ctypes.c_uint32()
+        reason = self.lib.fomusim_run(
+            self.handle, cycles,
+            -1 if stop_pc is None else stop_pc,
+            -1 if stop_write is None else stop_write,
+            ctypes.byref(total), ctypes.byref(pc))
+        return SimResult(STOP_REASONS[reason], total.value, pc.value)
+
+    def peek(self, address):
+        """Last value the CPU wrote to address (0 if it never has)."""
+        return self.lib.fomusim_peek(self.handle, address)
+
+    @property
+    def leds(self):
+        """(rgb0, rgb1, rgb2) pad levels; the pads sink current, so 0 is lit."""
+        value = self.lib.fomusim_leds(self.handle)
+        return (value & 1, (value >> 1) & 1, (value >> 2) & 1)
+
+    def close(self):
+        if self.handle is not None:
+            self.lib.fomusim_free(self.handle)
+            self.handle = None
+
+    def __del__(self):
+        self.close()
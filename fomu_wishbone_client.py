@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Host side of fomu_usb_wishbone.py: batched Wishbone reads and writes
+over the Fomu's vendor bulk endpoints (EP3).
+
+    client = WishboneClient(USBTransport())
+    client.hold_cpu()
+    client.load(0x0000, open("program.bin", "rb").read())
+    vectors = client.read(0xFFFC, 1)
+    client.release_cpu()
+    client.flush()
+    print(hex(vectors.words[0]))
+
+Nothing goes to the device until flush(), which sends everything queued
+in one stream and collects all the replies, so a batch costs one round
+trip however many commands are in it. Addresses are byte addresses and
+must be word aligned; through Bus6502Window they are 6502 addresses, with
+the control register at CONTROL_ADDRESS.
+
+This is also where the wire protocol lives (command encoding, burst
+splitting, reply status and the pyusb transport) for fomu_host.py.
+"""
+import struct
+import threading
+
+from fomu_usb_wishbone import NOP, WRITE, READ, FIXED, OK, BUS_ERROR
+from fomu_6502_bus_window import CONTROL, CPU_RESET
+
+CONTROL_ADDRESS = CONTROL * 4
+
+MAX_PACKET = 64
+SERIAL_ENDPOINT = 2
+WISHBONE_ENDPOINT = 3
+
+# The count field is 16 bits, so bigger bursts are split.
+MAX_BURST = 0xFFFF
+
+class WishboneError(Exception):
+    pass
+
+def command(opcode, address=0, count=0, payload=b""):
+    """The bytes of one command for USBWishboneHost."""
+    if opcode == NOP:
+        return bytes([NOP])
+    if address % 4:
+        raise ValueError("Wishbone address "+hex(address)+" is not word aligned")
+    return struct.pack("<BIH", opcode, address, count) + payload
+
+def bursts(opcode, address, count, fixed=False):
+    """Splits an access to count words into commands the count field can
+    hold. Yields (opcode, address, index of first word, words) for each."""
+    if fixed:
+        opcode |= FIXED
+    for start in range(0, count, MAX_BURST):
+        yield opcode, address if fixed else address + start * 4, start, min(MAX_BURST, count - start)
+
+def reply_length(words):
+    """Bytes of reply to a command that reads words: the data, then a
+    status."""
+    return words * 4 + 1
+
+def check_status(status):
+    """Raises WishboneError if a reply's status isn't OK."""
+    if status == BUS_ERROR:
+        raise WishboneError("Bus error (is the CPU held?)")
+    if status != OK:
+        raise WishboneError("Command rejected, status "+hex(status))
+
+class USBTransport(object):
+    """The Fomu's vendor interface, through pyusb. Reads and writes go to
+    EP3 unless given another endpoint; to get at the serial port's EP2 as
+    well, claim interfaces 0-2, taking the CDC ones from the kernel's
+    driver."""
+
+    def __init__(self, vid=0x1209, pid=0x5bf0, interfaces=(2,), timeout=1000):
+        try:
+            import usb.core
+            import usb.util
+        except ImportError:
+            raise ImportError("USBTransport needs pyusb (pip install pyusb)")
+        self.usb = usb
+        self.device = usb.core.find(idVendor=vid, idProduct=pid)
+        if self.device is None:
+            raise ValueError("No USB device "+"%04x:%04x" % (vid, pid)+" found")
+        for interface in interfaces:
+            if self.device.is_kernel_driver_active(interface):
+                self.device.detach_kernel_driver(interface)
+            usb.util.claim_interface(self.device, interface)
+        self.timeout = timeout
+
+    def write(self, data, endpoint=WISHBONE_ENDPOINT, timeout=None):
+        """timeout is in ms: None for the transport's, 0 to wait for ever."""
+        self.device.write(endpoint, data, self.timeout if timeout is None else timeout)
+
+    def read(self, length, endpoint=WISHBONE_ENDPOINT):
+        """Exactly length bytes, however many packets that takes."""
+        data = bytearray()
+        while len(data) < length:
+            data += self.device.read(0x80 | endpoint, -(-(length - len(data)) // MAX_PACKET) * MAX_PACKET,
+                                     self.timeout)
+        return bytes(data)
+
+    def read_packet(self, endpoint=WISHBONE_ENDPOINT):
+        """One packet, or None if nothing came within the timeout."""
+        try:
+            return bytes(self.device.read(0x80 | endpoint, MAX_PACKET, self.timeout))
+        except self.usb.core.USBTimeoutError:
+            return None
+
+    def close(self):
+        self.usb.util.dispose_resources(self.device)
+
+class Read(object):
+    """A queued read. words is filled in by flush()."""
+
+    def __init__(self, address, count):
+        self.address = address
+        self.count = count
+        self.words = []
+
+    def data(self):
+        """The words read, as little-endian bytes."""
+        return struct.pack("<%dI" % len(self.words), *self.words)
+
+class WishboneClient(object):
+    """Queues commands for USBWishboneHost. transport needs write(bytes)
+    and read(length), which returns exactly length bytes."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.commands = bytearray()
+        self.replies = []
+
+    def _queue(self, opcode, address, count, payload=b"", read=None):
+        self.commands += command(opcode, address, count, payload)
+        # Each command's reply is the words read, if any, then a status.
+        self.replies.append((count if read is not None else 0, read))
+
+    def write(self, address, words, fixed=False):
+        """Queue a write of words (32-bit integers) from address upwards,
+        or all to address if fixed."""
+        words = list(words)
+        for opcode, burst_address, start, count in bursts(WRITE, address, len(words), fixed):
+            burst = words[start:start + count]
+            self._queue(opcode, burst_address, count, struct.pack("<%dI" % count, *burst))
+
+    def read(self, address, count, fixed=False):
+        """Queue a read of count words. Returns a Read, whose words are
+        there after flush()."""
+        result = Read(address, count)
+        for opcode, burst_address, start, burst in bursts(READ, address, count, fixed):
+            self._queue(opcode, burst_address, burst, read=result)
+        return result
+
+    def load(self, address, data):
+        """Queue a write of a byte string, which must be a whole number of
+        words."""
+        if len(data) % 4:
+            raise ValueError("Can only load whole words, not "+str(len(data))+" bytes")
+        self.write(address, struct.unpack("<%dI" % (len(data) // 4), data))
+
+    def hold_cpu(self):
+        """Queue holding the CPU in reset, which gives the host the bus."""
+        self.write(CONTROL_ADDRESS, [CPU_RESET])
+
+    def release_cpu(self):
+        """Queue letting the CPU go; it starts again from its reset vector."""
+        self.write(CONTROL_ADDRESS, [0])
+
+    def nop(self):
+        """Queue a command that does nothing but reply."""
+        self._queue(NOP, 0, 0)
+
+    def flush(self):
+        """Send everything queued and wait for the replies. Raises
+        WishboneError if any command failed, after filling in every Read."""
+        commands, replies = bytes(self.commands), self.replies
+        self.commands, self.replies = bytearray(), []
+        if not replies:
+            return
+        length = sum(reply_length(count) for count, read in replies)
+
+        # Read while writing: the device stops taking commands when nobody
+        # collects its replies.
+        received = []
+        reader = threading.Thread(target=lambda: received.append(self.transport.read(length)))
+        reader.start()
+        try:
+            self.transport.write(commands)
+        finally:
+            reader.join()
+        if not received:
+            raise WishboneError("No reply from the device")
+        reply = received[0]
+
+        errors = []
+        offset = 0
+        for i, (count, read) in enumerate(replies):
+            if read is not None:
+                read.words += struct.unpack_from("<%dI" % count, reply, offset)
+                offset += count * 4
+            status = reply[offset]
+            offset += 1
+            try:
+                check_status(status)
+            except WishboneError as e:
+                errors.append("Command "+str(i)+": "+str(e))
+        if errors:
+            raise WishboneError(", ".join(errors))
@@ -0,0 +1,283 @@
+/*
+ * Simulation models of the iCE40UP5K primitives used by the Fomu SoC.
+ *
+ * These are written for Verilator: no delays, no X propagation, and only
+ * the behaviour the design actually relies on. They are not a replacement
+ * for the vendor models when checking timing or unusual configurations.
+ */
+
+/*
+ * 16K x 16 single-port RAM. MASKWREN is a nibble write mask, and DATAOUT
+ * holds its last value during writes and while deselected.
+ */
+module SB_SPRAM256KA( ADDRESS, DATAIN, MASKWREN, WREN, CHIPSELECT, CLOCK,
+                      STANDBY, SLEEP, POWEROFF, DATAOUT );
+	input [13:0] ADDRESS;
+	input [15:0] DATAIN;
+	input [3:0] MASKWREN;
+	input WREN;
+	input CHIPSELECT;
+	input CLOCK;
+	input STANDBY;
+	input SLEEP;
+	input POWEROFF;	// Active low: 1 means powered.
+	output reg [15:0] DATAOUT;
+
+reg [15:0] mem[0:16383];
+
+wire active = CHIPSELECT & ~STANDBY & ~SLEEP & POWEROFF;
+
+always @(posedge CLOCK)
+    if( active ) begin
+	if( WREN ) begin
+	    if( MASKWREN[0] ) mem[ADDRESS][3:0]   <= DATAIN[3:0];
+	    if( MASKWREN[1] ) mem[ADDRESS][7:4]   <= DATAIN[7:4];
+	    if( MASKWREN[2] ) mem[ADDRESS][11:8]  <= DATAIN[11:8];
+	    if( MASKWREN[3] ) mem[ADDRESS][15:12] <= DATAIN[15:12];
+	end else
+	    DATAOUT <= mem[ADDRESS];
+    end
+
+endmodule
+
+/*
+ * LED PWM controller. Only the register file is modelled; the PWM outputs
+ * are simply the most significant bit of each duty register, which is
+ * enough to see the LED "on" in a waveform.
+ */
+module SB_LEDDA_IP( LEDDCS, LEDDCLK,
+                    LEDDDAT7, LEDDDAT6, LEDDDAT5, LEDDDAT4,
+                    LEDDDAT3, LEDDDAT2, LEDDDAT1, LEDDDAT0,
+                    LEDDADDR3, LEDDADDR2, LEDDADDR1, LEDDADDR0,
+                    LEDDDEN, LEDDEXE, LEDDRST,
+                    PWMOUT0, PWMOUT1, PWMOUT2, LEDDON );
+	input LEDDCS;
+	input LEDDCLK;
+	input LEDDDAT7, LEDDDAT6, LEDDDAT5, LEDDDAT4;
+	input LEDDDAT3, LEDDDAT2, LEDDDAT1, LEDDDAT0;
+	input LEDDADDR3, LEDDADDR2, LEDDADDR1, LEDDADDR0;
+	input LEDDDEN;
+	input LEDDEXE;
+	input LEDDRST;
+	output PWMOUT0;
+	output PWMOUT1;
+	output PWMOUT2;
+	output LEDDON;
+
+reg [7:0] regs[0:15];
+
+wire [3:0] addr = { LEDDADDR3, LEDDADDR2, LEDDADDR1, LEDDADDR0 };
+wire [7:0] data = { LEDDDAT7, LEDDDAT6, LEDDDAT5, LEDDDAT4,
+                    LEDDDAT3, LEDDDAT2, LEDDDAT1, LEDDDAT0 };
+
+always @(posedge LEDDCLK)
+    if( LEDDCS & LEDDDEN )
+	regs[addr] <= data;
+
+// LEDDPWRR/G/B are registers 1, 2 and 3; LEDDCR0 bit 7 enables the block.
+wire enable = regs[8][7] & LEDDEXE;
+
+assign PWMOUT0 = enable & regs[1][7];
+assign PWMOUT1 = enable & regs[2][7];
+assign PWMOUT2 = enable & regs[3][7];
+assign LEDDON = enable;
+
+endmodule
+
+/*
+ * PLL. The output frequency is REFERENCECLK * (DIVF+1) / ((DIVR+1) * 2^DIVQ),
+ * halved for the GENCLK_HALF output. The model toggles the output from a
+ * phase accumulator clocked on both reference edges, so ratios that aren't
+ * integers come out with the right average frequency and some jitter.
+ */
+module SB_PLL40_CORE( REFERENCECLK, PLLOUTCORE, PLLOUTGLOBAL, EXTFEEDBACK,
+                      DYNAMICDELAY, LOCK, BYPASS, RESETB, LATCHINPUTVALUE,
+                      SDO, SDI, SCLK );
+	input REFERENCECLK;
+	output reg PLLOUTCORE = 0;
+	output PLLOUTGLOBAL;
+	input EXTFEEDBACK;
+	input [7:0] DYNAMICDELAY;
+	output LOCK;
+	input BYPASS;
+	input RESETB;
+	input LATCHINPUTVALUE;
+	output SDO;
+	input SDI;
+	input SCLK;
+
+parameter FEEDBACK_PATH = "SIMPLE";
+parameter DELAY_ADJUSTMENT_MODE_FEEDBACK = "FIXED";
+parameter DELAY_ADJUSTMENT_MODE_RELATIVE = "FIXED";
+parameter SHIFTREG_DIV_MODE = 0;
+parameter FDA_FEEDBACK = 0;
+parameter FDA_RELATIVE = 0;
+parameter PLLOUT_SELECT = "GENCLK";
+parameter DIVR = 0;
+parameter DIVF = 0;
+parameter DIVQ = 0;
+parameter FILTER_RANGE = 0;
+parameter ENABLE_ICEGATE = 0;
+parameter TEST_MODE = 0;
+parameter EXTERNAL_DIVIDE_FACTOR = 1;
+
+localparam NUM = DIVF + 1;
+localparam DEN = (DIVR + 1) * (1 << DIVQ) * (PLLOUT_SELECT == "GENCLK_HALF" ? 2 : 1);
+
+integer phase = 0;
+
+always @(posedge REFERENCECLK or negedge REFERENCECLK)
+    if( ~RESETB )
+	phase <= 0;
+    else if( BYPASS )
+	PLLOUTCORE <= REFERENCECLK;
+    else if( phase + NUM >= DEN ) begin
+	phase <= phase + NUM - DEN;
+	PLLOUTCORE <= ~PLLOUTCORE;
+    end else
+	phase <= phase + NUM;
+
+assign PLLOUTGLOBAL = PLLOUTCORE;
+assign LOCK = RESETB;
+assign SDO = 0;
+
+endmodule
+
+module SB_RGBA_DRV( CURREN, RGBLEDEN, RGB0PWM, RGB1PWM, RGB2PWM, RGB0, RGB1, RGB2 );
+	input CURREN;
+	input RGBLEDEN;
+	input RGB0PWM;
+	input RGB1PWM;
+	input RGB2PWM;
+	output RGB0;
+	output RGB1;
+	output RGB2;
+
+parameter CURRENT_MODE = "0b0";
+parameter RGB0_CURRENT = "0b000000";
+parameter RGB1_CURRENT = "0b000000";
+parameter RGB2_CURRENT = "0b000000";
+
+// The pads are open-drain current sinks, so an LED is lit when low.
+assign RGB0 = ~(CURREN & RGBLEDEN & RGB0PWM);
+assign RGB1 = ~(CURREN & RGBLEDEN & RGB1PWM);
+assign RGB2 = ~(CURREN & RGBLEDEN & RGB2PWM);
+
+endmodule
+
+module SB_GB( USER_SIGNAL_TO_GLOBAL_BUFFER, GLOBAL_BUFFER_OUTPUT );
+	input USER_SIGNAL_TO_GLOBAL_BUFFER;
+	output GLOBAL_BUFFER_OUTPUT;
+
+assign GLOBAL_BUFFER_OUTPUT = USER_SIGNAL_TO_GLOBAL_BUFFER;
+
+endmodule
+
+/*
+ * D flip-flop with asynchronous set, as used by migen's
+ * AsyncResetSynchronizer on iCE40.
+ */
+module SB_DFFS( Q, C, D, S );
+	output reg Q = 1;
+	input C;
+	input D;
+	input S;
+
+always @(posedge C or posedge S)
+    if( S )
+	Q <= 1;
+    else
+	Q <= D;
+
+endmodule
+
+/*
+ * I/O pad. Only the unregistered, tristate-able configuration that
+ * migen's Tristate lowering uses is modelled.
+ */
+module SB_IO( PACKAGE_PIN, LATCH_INPUT_VALUE, CLOCK_ENABLE, INPUT_CLK,
+              OUTPUT_CLK, OUTPUT_ENABLE, D_OUT_0, D_OUT_1, D_IN_0, D_IN_1 );
+	inout PACKAGE_PIN;
+	input LATCH_INPUT_VALUE;
+	input CLOCK_ENABLE;
+	input INPUT_CLK;
+	input OUTPUT_CLK;
+	input OUTPUT_ENABLE;
+	input D_OUT_0;
+	input D_OUT_1;
+	output D_IN_0;
+	output D_IN_1;
+
+parameter PIN_TYPE = 6'b000000;
+parameter PULLUP = 1'b0;
+parameter NEG_TRIGGER = 1'b0;
+parameter IO_STANDARD = "SB_LVCMOS";
+
+assign PACKAGE_PIN = OUTPUT_ENABLE ? D_OUT_0 : 1'bz;
+assign D_IN_0 = PACKAGE_PIN;
+assign D_IN_1 = PACKAGE_PIN;
+
+endmodule
+
+/*
+ * Quad I/O SPI flash, for the XIP controller in fomu_flash.py. Only the
+ * Fast Read Quad I/O (0xEB) command is understood. flash.hex, if present,
+ * holds the contents from BASE up; everything else reads as erased.
+ */
+module spiflash_model( csn, clk, dq );
+	input csn;
+	input clk;
+	inout [3:0] dq;
+
+parameter BASE = 32'h80000;
+parameter SIZE = 65536;
+
+reg [7:0] mem [0:SIZE-1];
+reg [5:0] clocks = 0;
+reg [7:0] command = 0;
+reg [23:0] address = 0;
+reg [23:0] offset = 0;
+reg nibble = 0;
+reg [3:0] out = 0;
+
+integer i, fd;
+initial begin
+	for( i = 0; i < SIZE; i = i + 1 )
+		mem[i] = 8'hFF;
+	fd = $fopen("flash.hex", "r");
+	if( fd != 0 ) begin
+		$fclose(fd);
+		$readmemh("flash.hex", mem);
+	end
+end
+
+// Command, then 6 address and 2 mode nibbles, then 4 dummy clocks.
+always @(posedge clk or posedge csn)
+    if( csn )
+	clocks <= 0;
+    else begin
+	if( clocks != 20 )
+	    clocks <= clocks + 1;
+	if( clocks < 8 )
+	    command <= { command[6:0], dq[0] };
+	else if( clocks < 14 )
+	    address <= { address[19:0], dq };
+    end
+
+wire [31:0] index = address + offset - BASE;
+wire [7:0] byte_out = (address + offset >= BASE && index < SIZE) ? mem[index] : 8'hFF;
+
+always @(negedge clk)
+    if( clocks != 20 ) begin
+	nibble <= 0;
+	offset <= 0;
+    end else begin
+	out <= nibble ? byte_out[3:0] : byte_out[7:4];
+	nibble <= ~nibble;
+	if( nibble )
+	    offset <= offset + 1;
+    end
+
+assign dq = (~csn && clocks == 20 && command == 8'hEB) ? out : 4'bz;
+
+endmodule
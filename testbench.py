@@ -1,15 +1,712 @@
-from migen.sim import run_simulation
+import argparse
+import random
+
+from migen.sim import run_simulation, passive
 from fomu_soc import Fomu
 from fomu_platform import FomuPlatform
+from fomu_6502_cpu_sim import DECODE
+from fomu_6502_math import MUL
+from fomu_6502_usb_serial import STATUS as SERIAL_STATUS, RX_READY
+from fomu_6502_wishbone_bridge import ADDRESS as BRIDGE_ADDRESS, CONTROL as BRIDGE_CONTROL, STREAM, STATUS as BRIDGE_STATUS, \
+    INCREMENT, READ_AHEAD
+from fomu_6502_dma import SOURCE, DEST, LENGTH, MODE, CONTROL, FILL_VALUE, SOURCE_INCREMENT, DEST_INCREMENT, COPY, FILL, COMPARE, MOVE, START
+from fomu_6502_emu import FomuMachine
+from fomu_6502_emu.asm import assemble
+
+def testbench(soc, cycles, stop_pc=None, stop_write=None):
+    """Run the SoC for up to 'cycles' clocks, reporting LED register writes.
+    Stops early when the CPU decodes an instruction at stop_pc or writes to
+    stop_write. The LED registers (which sit behind a wait state) are then
+    checked against the writes seen."""
+    leds = {}
+    yield from _run(soc, cycles, stop_pc, stop_write, leds)
+    for register, value in leds.items():
+        actual = (yield soc.rgb.registers[register])
+        if actual != value:
+            raise RuntimeError("LED register "+hex(register)+" holds "+hex(actual)+", expected "+hex(value))
+
+def _run(soc, cycles, stop_pc, stop_write, leds):
+    cpu = soc.cpu
+    for cycle in range(cycles):
+        yield
+        if not (yield cpu.rdy):
+            continue
+        if (yield cpu.we):
+            address = (yield cpu.address)
+            value = (yield cpu.data_out)
+            if (yield soc.rgb_sel):
+                print("Cycle", cycle, "- LED register", hex(address & 0xF), "=", hex(value))
+                leds[address & 0xF] = value
+            if address == stop_write:
+                print("Cycle", cycle, "- write of", hex(value), "to", hex(address))
+                return
+        if stop_pc is not None and (yield cpu.state) == DECODE:
+            if (yield cpu.insn_pc) == stop_pc:
+                print("Cycle", cycle, "- reached PC", hex(stop_pc))
+                return
+    print("Ran for", cycles, "cycles, PC =", hex((yield cpu.pc)))
+
+# The runs below load a program and check what it leaves in RAM against
+# the emulator (fomu_6502_emu), which runs the same program as the model.
+
+# Unmapped, between the LED registers and the Wishbone bridge; programs
+# write here to mark where they are.
+MARK = 0xFE10
+DMA = Fomu.memory_map["dma"].start
+MATH = Fomu.memory_map["math"].start
+SERIAL = Fomu.memory_map["usb_serial"].start
+BRIDGE = Fomu.memory_map["wishbone"].start
+RGB = Fomu.memory_map["rgb"].start
+PAGING = Fomu.memory_map["paging_register"].start
+PAGED = Fomu.memory_map["paged_rom"].start
+# Where programs are loaded, and where dma_program() keeps its table of
+# operations and leaves the DMA registers after each.
+PROGRAM = 0x0200
+TABLE = 0x0600
+RESULTS = 0x7F00
+
+def _vectors_rom(entry):
+    """A 256-byte ROM for 0xFF00 with every vector at entry."""
+    return bytes(0xFA) + bytes([entry & 0xFF, entry >> 8]) * 3
+
+def _model(rom, image, stop_write, serial=b"", wishbone=None, cpu_variant="standard"):
+    machine = FomuMachine(rom_image=rom, cpu_variant=cpu_variant)
+    machine.load(0, image)
+    machine.devices["usb_serial"].send(serial)
+    machine.devices["wishbone"].target.words.update(wishbone or {})
+    machine.watch_write(stop_write)
+    machine.reset()
+    machine.run(1000000)
+    return machine
+
+def _check_ram(soc, machine, start, end):
+    """Compare the SoC's RAM from start to end with the model's."""
+    for i in range(start >> 1, end >> 1):
+        actual = (yield soc.ram.block.mem[i])
+        expected = machine.mem[2*i] | (machine.mem[2*i + 1] << 8)
+        if actual != expected:
+            raise RuntimeError("RAM at "+hex(2*i)+" holds "+hex(actual)+", expected "+hex(expected))
+
+def _check_leds(soc, machine):
+    """Compare the SoC's LED registers with the model's."""
+    for register in range(16):
+        actual = (yield soc.rgb.registers[register])
+        expected = machine.devices["rgb"].registers[register]
+        if actual != expected:
+            raise RuntimeError("LED register "+hex(register)+" holds "+hex(actual)+", expected "+hex(expected))
+
+def _program_run(image, stop_write, registered_bus, serial=b"", wishbone=None, cpu_variant="standard"):
+    """A simulated SoC, and the emulator run up to stop_write, each with
+    RAM starting out as image, starting at PROGRAM and with the cpu_variant
+    core. The emulator's serial port is sent serial first, and its Wishbone
+    target holds the words in wishbone; give the SoC's to _usb_out() and
+    _wishbone_memory()."""
+    rom = _vectors_rom(PROGRAM)
+    soc = Fomu(FomuPlatform(revision="pvt"), simulation=True, registered_bus=registered_bus, rom_image=rom,
+               cpu_variant=cpu_variant)
+    soc.ram.block.mem.init = [image[2*i] | (image[2*i + 1] << 8) for i in range(len(image) // 2)]
+    return soc, _model(rom, image, stop_write, serial, wishbone, cpu_variant)
 
-platform = FomuPlatform(revision="pvt")
-fomu = Fomu(platform)
-    
-def testbench():
-    yield fomu.cd_sys.clk
-    yield fomu.cd_sys.rst
-    yield fomu.address_bus
+@passive
+def _wishbone_memory(bridge, words, latency=2):
+    """A Wishbone target for bridge holding words, a dict by address,
+    answering each cycle after latency clocks."""
+    while True:
+        yield
+        if (yield bridge.wishbone_cyc_o) and (yield bridge.wishbone_stb_o):
+            for i in range(latency):
+                yield
+            address = (yield bridge.wishbone_adr_o)
+            if (yield bridge.wishbone_we_o):
+                words[address] = (yield bridge.wishbone_dat_o)
+            else:
+                yield bridge.wishbone_dat_i.eq(words.get(address, 0))
+            yield bridge.wishbone_ack_i.eq(1)
+            yield
+            yield bridge.wishbone_ack_i.eq(0)
+
+def _usb_out(endpoint, packet):
+    """Put packet into a bulk OUT endpoint as the USB core would, a byte
+    every other cycle."""
+    # The token comes first: six bytes at full speed, 8 cycles each.
+    for i in range(6 * 8):
+        yield
+    yield endpoint.start.eq(1)
+    yield
+    yield endpoint.start.eq(0)
+    # The core passes the CRC16 on after the payload.
+    for byte in packet + b"\0\0":
+        yield endpoint.data_recv_payload.eq(byte)
+        yield endpoint.data_recv_put.eq(1)
+        yield
+        yield endpoint.data_recv_put.eq(0)
+        yield
+    yield endpoint.commit.eq(1)
     yield
+    yield endpoint.commit.eq(0)
+
+def _usb_in(endpoint):
+    """Take what a bulk IN endpoint has to send, a packet at a time, until
+    it NAKs."""
+    data = bytearray()
+    while True:
+        yield endpoint.start.eq(1)
+        yield
+        yield endpoint.start.eq(0)
+        yield
+        yield
+        if not (yield endpoint.ack):
+            return bytes(data)
+        while (yield endpoint.data_send_have):
+            data.append((yield endpoint.data_send_payload))
+            yield endpoint.data_send_get.eq(1)
+            yield
+            # The next byte comes out of block RAM a cycle later.
+            yield endpoint.data_send_get.eq(0)
+            yield
+        yield endpoint.commit.eq(1)
+        yield
+        yield endpoint.commit.eq(0)
+
+def _run_to_mark(soc, cycles, stats):
+    """Run until the CPU writes MARK, noting the cycle of each write to
+    MARK+n in stats["marks"], and the cycles each DMA operation holds the
+    bus for, with how many of its accesses were 16 bits, in stats["dma"]."""
+    cpu = soc.cpu
+    port = soc.dma.port
+    active = wide = 0
+    for cycle in range(cycles):
+        yield
+        if (yield port.active):
+            active += 1
+            if (yield port.dma_wide) and (yield soc.bus.rdy):
+                wide += 1
+        elif active:
+            stats["dma"].append((active, wide))
+            active = wide = 0
+        if (yield cpu.rdy) and (yield cpu.we):
+            address = (yield cpu.address)
+            if MARK <= address < MARK + 0x10:
+                stats["marks"][address - MARK] = cycle
+                if address == MARK:
+                    return
+    raise RuntimeError("Program didn't finish in "+str(cycles)+" cycles")
+
+def dma_program(ops, cpu_copy=None):
+    """A program for PROGRAM, and its table for TABLE, that runs each of
+    ops, (operation, SOURCE, DEST, LENGTH, MODE increment bits,
+    FILL_VALUE), on the DMA controller in turn, saving its eight registers
+    at RESULTS after each. With cpu_copy, (source, dest, length) of up to
+    256 bytes, it then copies that with a CPU loop, writing MARK+1 before
+    and MARK+2 after. It ends by writing MARK."""
+    registers = [SOURCE, SOURCE + 1, DEST, DEST + 1, LENGTH, LENGTH + 1, MODE, FILL_VALUE]
+    table = []
+    for op, source, dest, length, mode, fill in ops:
+        table += [source & 0xFF, source >> 8, dest & 0xFF, dest >> 8, length & 0xFF, length >> 8,
+                  op | mode, fill]
+    if len(table) > 0xFF:
+        raise ValueError("Too many DMA operations ("+str(len(ops))+")")
+    program = [
+        ("LDA", "#", RESULTS & 0xFF), ("STA", "zp", 0),
+        ("LDA", "#", RESULTS >> 8), ("STA", "zp", 1),
+        ("LDX", "#", 0),
+        "op",
+        ]
+    for i, register in enumerate(registers):
+        program += [("LDA", "abs,x", TABLE + i), ("STA", "abs", DMA + register)]
+    program += [
+        ("LDA", "#", START), ("STA", "abs", DMA + CONTROL),
+        ("LDY", "#", 0),
+        "save",
+        ("LDA", "abs,y", DMA), ("STA", "(zp),y", 0),
+        ("INY", ""), ("CPY", "#", 8), ("BNE", "rel", "save"),
+        ("LDA", "zp", 0), ("CLC", ""), ("ADC", "#", 8), ("STA", "zp", 0),
+        ("TXA", ""), ("CLC", ""), ("ADC", "#", 8), ("TAX", ""),
+        ("CPX", "#", len(table)), ("BNE", "rel", "op"),
+        ]
+    if cpu_copy is not None:
+        source, dest, length = cpu_copy
+        program += [
+            ("STA", "abs", MARK + 1),
+            ("LDX", "#", 0),
+            "copy",
+            ("LDA", "abs,x", source), ("STA", "abs,x", dest),
+            ("INX", ""), ("CPX", "#", length & 0xFF), ("BNE", "rel", "copy"),
+            ("STA", "abs", MARK + 2),
+            ]
+    program += [
+        ("STA", "abs", MARK),
+        "end",
+        ("JMP", "abs", "end"),
+        ]
+    return assemble(PROGRAM, program), bytes(table)
+
+def _random_ram():
+    return bytearray(random.Random(1).randrange(256) for i in range(0x8000))
+
+def _dma_run(ops, image, registered_bus, cpu_copy=None):
+    """Run dma_program(ops) on a simulated SoC whose RAM starts out as
+    image, and check RAM, the registers saved after each operation and the
+    LED registers against the emulator. Returns the stats from
+    _run_to_mark."""
+    program, table = dma_program(ops, cpu_copy)
+    image[PROGRAM:PROGRAM + len(program)] = program
+    image[TABLE:TABLE + len(table)] = table
+    soc, machine = _program_run(image, MARK, registered_bus)
+    stats = {"marks": {}, "dma": []}
+    def run():
+        yield from _run_to_mark(soc, 200000, stats)
+        # Zero page and the rest; the stack is left out, as the gateware's
+        # reset sequence writes to it and the emulator's doesn't.
+        yield from _check_ram(soc, machine, 0x0000, 0x0100)
+        yield from _check_ram(soc, machine, 0x0200, 0x8000)
+        yield from _check_leds(soc, machine)
+    run_simulation(soc, run())
+    if len(stats["dma"]) != len(ops):
+        raise RuntimeError(str(len(ops))+" DMA operations, but the bus was taken "+str(len(stats["dma"]))+" times")
+    return stats
+
+def dma_check(registered_bus=False):
+    """Run every DMA operation on SPRAM, with the addresses even, odd and
+    mismatched (so both 16-bit and byte accesses), including backward
+    MOVEs, and COMPAREs that stop in the low and the high byte of a word,
+    then COPY and FILL to the LED registers (byte wide, behind a wait
+    state), checking the results against the emulator's model."""
+    image = _random_ram()
+    both = SOURCE_INCREMENT | DEST_INCREMENT
+    ops = [
+        (FILL, 0, 0x1000, 64, DEST_INCREMENT, 0xA5),
+        (FILL, 0, 0x1101, 63, DEST_INCREMENT, 0x3C),
+        (COPY, 0x2000, 0x3000, 64, both, 0),
+        (COPY, 0x2001, 0x3101, 63, both, 0),
+        (COPY, 0x2000, 0x3201, 64, both, 0),
+        (MOVE, 0x4000, 0x4002, 64, 0, 0),
+        (MOVE, 0x4101, 0x4103, 63, 0, 0),
+        (MOVE, 0x4200, 0x4201, 64, 0, 0),
+        (MOVE, 0x4301, 0x4300, 63, 0, 0),
+        (MOVE, 0x4400, 0x4403, 50, 0, 0),
+        (COMPARE, 0x2000, 0x3000, 64, both, 0),
+        # Make the copy at 0x3000 differ in the high byte of the word at
+        # 0x3020, then in the low byte of the one at 0x3010.
+        (FILL, 0, 0x3021, 1, DEST_INCREMENT, image[0x2021] ^ 0xFF),
+        (COMPARE, 0x2000, 0x3000, 64, both, 0),
+        (COMPARE, 0x2001, 0x3001, 63, both, 0),
+        (FILL, 0, 0x3010, 1, DEST_INCREMENT, image[0x2010] ^ 0xFF),
+        (COMPARE, 0x2000, 0x3000, 64, both, 0),
+        (COPY, 0x2000, 0xFE01, 3, both, 0),
+        (FILL, 0, 0xFE05, 4, 0, 0x5A),
+        ]
+    stats = _dma_run(ops, image, registered_bus)
+    wide = sum(w for active, w in stats["dma"])
+    if not wide:
+        raise RuntimeError("No 16-bit DMA accesses were made")
+    print("DMA check passed:", len(ops), "operations,", wide, "16-bit accesses")
+
+def dma_bench(length=64, registered_bus=False):
+    """Time DMA copies within SPRAM, of an aligned block (16 bits at a time)
+    and a misaligned one (a byte at a time), and a fill, against a CPU copy
+    loop, and check the copies against the emulator."""
+    if not 1 <= length <= 256:
+        raise ValueError("Can only bench copies of 1 to 256 bytes, not "+str(length))
+    both = SOURCE_INCREMENT | DEST_INCREMENT
+    ops = [
+        (COPY, 0x2000, 0x3000, length, both, 0),
+        (COPY, 0x2000, 0x3401, length, both, 0),
+        (FILL, 0, 0x3800, length, DEST_INCREMENT, 0xA5),
+        ]
+    stats = _dma_run(ops, _random_ram(), registered_bus, (0x2000, 0x3C00, length))
+    results = [("DMA copy, aligned", stats["dma"][0][0]),
+               ("DMA copy, misaligned", stats["dma"][1][0]),
+               ("DMA fill", stats["dma"][2][0]),
+               ("CPU copy loop", stats["marks"][2] - stats["marks"][1])]
+    print("Moving", length, "bytes" + (" on the registered bus:" if registered_bus else ":"))
+    for name, cycles in results:
+        print("  {:<22} {:>6} cycles, {:5.2f} a byte".format(name, cycles, cycles / length))
+
+SERIAL_RX = bytes([0x10, 0x21, 0x32, 0x43, 0x54, 0x65])
+# What the Wishbone target starts out holding.
+WISHBONE_WORDS = {i: 0x03020100 + 0x04040404 * i for i in range(0x40)}
+
+def registers_program():
+    """A program for PROGRAM that writes the device registers with indexed
+    stores (abs,X, abs,Y and (zp),Y), which read their target the cycle
+    before writing it, and read-modify-write instructions, which read it
+    twice, then copies the registers to RESULTS and writes MARK. The
+    serial port is expected to be sent SERIAL_RX, and the Wishbone target
+    to hold WISHBONE_WORDS."""
+    results = RESULTS
+    def save(address, mode="abs"):
+        nonlocal results
+        program.extend([("LDA", mode, address), ("STA", "abs", results)])
+        results += 1
+
+    program = [
+        ("LDA", "#", RGB & 0xFF), ("STA", "zp", 0x28),
+        ("LDA", "#", RGB >> 8), ("STA", "zp", 0x29),
+        ("LDA", "#", MATH & 0xFF), ("STA", "zp", 0x20),
+        ("LDA", "#", MATH >> 8), ("STA", "zp", 0x21),
+        ("LDA", "#", SERIAL & 0xFF), ("STA", "zp", 0x22),
+        ("LDA", "#", SERIAL >> 8), ("STA", "zp", 0x23),
+        # Serial: wait for SERIAL_RX to arrive, then send "ABC" with
+        # indexed stores, which take nothing, and two bytes taken and
+        # changed by INC and ASL, and take one more with an indexed load.
+        "wait",
+        ("LDA", "abs", SERIAL + SERIAL_STATUS), ("AND", "#", RX_READY), ("BEQ", "rel", "wait"),
+        ("LDY", "#", 0),
+        "delay",
+        ("DEY", ""), ("BNE", "rel", "delay"),
+        ("LDX", "#", 0),
+        ("LDA", "#", ord("A")), ("STA", "abs,x", SERIAL),
+        ("LDA", "#", ord("B")), ("STA", "(zp),y", 0x22),
+        ("LDA", "#", ord("C")), ("STA", "abs,y", SERIAL),
+        ("INC", "abs", SERIAL),
+        ("ASL", "abs,x", SERIAL),
+        ]
+    save(SERIAL, "abs,x")
+    # The rest of SERIAL_RX, and reads of nothing after it.
+    save(SERIAL + SERIAL_STATUS)
+    for i in range(len(SERIAL_RX) - 1):
+        save(SERIAL)
+    save(SERIAL + SERIAL_STATUS)
+    program += [
+        # Math: A = 0x1234 and B = 0x5678, stepped by INC, DEC and ASL,
+        # then multiplied.
+        ("LDX", "#", 0),
+        ("LDA", "#", 0x34), ("STA", "abs,x", MATH),
+        ("LDA", "#", 0x12), ("STA", "abs,x", MATH + 1),
+        ("LDY", "#", 2), ("LDA", "#", 0x78), ("STA", "abs,y", MATH),
+        ("INY", ""), ("LDA", "#", 0x56), ("STA", "(zp),y", 0x20),
+        ("INC", "abs", MATH),
+        ("ASL", "abs", MATH + 2),
+        ("INX", ""), ("DEC", "abs,x", MATH),
+        ("LDA", "#", MUL), ("STA", "abs,x", MATH + 7),
+        ]
+    for address in range(MATH, MATH + 10):
+        save(address)
+
+    # DMA: set up a FILL of 16 bytes of 0xB4 at 0x3001 with indexed stores,
+    # INC and ASL, and start it with an indexed store.
+    program += [
+        ("LDA", "#", DMA & 0xFF), ("STA", "zp", 0x26),
+        ("LDA", "#", DMA >> 8), ("STA", "zp", 0x27),
+        ("LDX", "#", 0),
+        ("LDA", "#", 0x00), ("STA", "abs,x", DMA + DEST),
+        ("LDA", "#", 0x30), ("STA", "abs,x", DMA + DEST + 1),
+        ("LDY", "#", LENGTH), ("LDA", "#", 0x0F), ("STA", "(zp),y", 0x26),
+        ("INY", ""), ("LDA", "#", 0), ("STA", "abs,y", DMA),
+        ("INC", "abs", DMA + LENGTH),
+        ("LDA", "#", 0x5A), ("STA", "abs,x", DMA + FILL_VALUE),
+        ("ASL", "abs,x", DMA + FILL_VALUE),
+        ("LDA", "#", FILL | DEST_INCREMENT), ("STA", "abs,x", DMA + MODE),
+        ("INC", "abs", DMA + DEST),
+        ("LDA", "#", START), ("STA", "abs,x", DMA + CONTROL),
+        ]
+    for address in range(DMA, DMA + 9):
+        save(address)
+
+    # Paging register: select banks with an indexed store, INC and DEC
+    # abs,X, writing a byte into the window in each.
+    program += [
+        ("LDA", "#", 1), ("STA", "abs,x", PAGING),
+        ("LDA", "#", 0xA1), ("STA", "abs", PAGED),
+        ("INC", "abs", PAGING),
+        ("LDA", "#", 0xA2), ("STA", "abs", PAGED),
+        ("DEC", "abs,x", PAGING),
+        ]
+    save(PAGED)
+    save(PAGING)
+    program += [("INC", "abs", PAGING)]
+    save(PAGED)
+
+    # LED registers, which read as 0: an indexed store, INC and ASL abs,X.
+    program += [
+        ("LDA", "#", 0x3C), ("STA", "abs,x", RGB + 1),
+        ("INC", "abs", RGB + 2),
+        ("ASL", "abs,x", RGB + 3),
+        ("LDY", "#", 9), ("LDA", "#", 0x81), ("STA", "(zp),y", 0x28),
+        ]
+
+    def set_address(address):
+        for i in range(4):
+            program.extend([("LDA", "#", (address >> (8 * i)) & 0xFF),
+                            ("STA", "abs", BRIDGE + BRIDGE_ADDRESS + i)])
+
+    # Wishbone bridge: write DATA a byte at a time with indexed stores, the
+    # last of which writes the word to 0x10, then with INCREMENT read the
+    # words at 0x20 up, with an indexed load and INC, which read DATA byte
+    # 0 (and so the next word) once, and write them back with byte 0
+    # stepped, or replaced with an indexed store, which reads nothing.
+    set_address(0x10)
+    program += [
+        ("LDA", "#", BRIDGE & 0xFF), ("STA", "zp", 0x24),
+        ("LDA", "#", BRIDGE >> 8), ("STA", "zp", 0x25),
+        ("LDX", "#", 0),
+        ("LDA", "#", 0x11), ("STA", "abs,x", BRIDGE),
+        ("LDA", "#", 0x22), ("STA", "abs,x", BRIDGE + 1),
+        ("LDY", "#", 2), ("LDA", "#", 0x33), ("STA", "abs,y", BRIDGE),
+        ("INY", ""), ("LDA", "#", 0x44), ("STA", "(zp),y", 0x24),
+        ("LDA", "#", INCREMENT), ("STA", "abs,x", BRIDGE + BRIDGE_CONTROL),
+        ]
+    set_address(0x20)
+    save(BRIDGE, "abs,x")
+    for i in range(1, 8):
+        save(BRIDGE + i)
+    program += [
+        ("INC", "abs", BRIDGE),
+        ("LDA", "abs", BRIDGE + 3), ("STA", "abs,x", BRIDGE + 3),
+        ("LDA", "#", 0x99), ("STA", "abs,x", BRIDGE),
+        ("LDA", "abs", BRIDGE + 3), ("STA", "abs,x", BRIDGE + 3),
+        ("INC", "abs,x", BRIDGE),
+        ("LDA", "abs", BRIDGE + 3), ("STA", "abs", BRIDGE + 3),
+        ]
+    for i in range(1, 8):
+        save(BRIDGE + i)
+    # Then STREAM from 0x30, reading a word with a load, an indexed load,
+    # INC and ASL abs,X, which take one byte each, between indexed stores,
+    # which take none; the five bytes written go to 0x31 (as reading the
+    # word moved ADDRESS on) and gather.
+    program += [
+        ("LDA", "#", 0), ("STA", "abs", BRIDGE + BRIDGE_CONTROL),
+        ]
+    set_address(0x30)
+    save(BRIDGE + STREAM)
+    program += [("LDA", "#", 0x55), ("STA", "abs,x", BRIDGE + STREAM)]
+    save(BRIDGE + STREAM, "abs,x")
+    program += [
+        ("LDA", "#", 0x66), ("STA", "abs,x", BRIDGE + STREAM),
+        ("INC", "abs", BRIDGE + STREAM),
+        ("ASL", "abs,x", BRIDGE + STREAM),
+        ("LDA", "#", 0x77), ("STA", "abs,x", BRIDGE + STREAM),
+        ]
+    for i in range(4, 8):
+        save(BRIDGE + i)
+    save(BRIDGE + STREAM)
+    # And with READ_AHEAD, from 0x38, with indexed loads.
+    set_address(0x38)
+    program += [("LDA", "#", READ_AHEAD), ("STA", "abs", BRIDGE + BRIDGE_CONTROL)]
+    for i in range(6):
+        save(BRIDGE + STREAM, "abs,x")
+    program += [("LDA", "#", 0), ("STA", "abs", BRIDGE + BRIDGE_CONTROL)]
+    for i in range(4, 8):
+        save(BRIDGE + i)
+    save(BRIDGE + BRIDGE_STATUS)
+
+    program += [
+        ("STA", "abs", MARK),
+        "end",
+        ("JMP", "abs", "end"),
+        ]
+    return assemble(PROGRAM, program)
+
+def registers_run(registered_bus=False):
+    """Run registers_program(), checking what it copies out of the
+    registers, sends on the serial port and leaves on the Wishbone bus,
+    against the emulator."""
+    program = registers_program()
+    image = bytearray(0x8000)
+    image[PROGRAM:PROGRAM + len(program)] = program
+    soc, machine = _program_run(image, MARK, registered_bus, SERIAL_RX, WISHBONE_WORDS)
+    words = dict(WISHBONE_WORDS)
+
+    def run():
+        yield from _usb_out(soc.usb.bulk_out, SERIAL_RX)
+        yield from _run_to_mark(soc, 20000, {"marks": {}, "dma": []})
+        # Zero page and the rest; the stack is left out, as the gateware's
+        # reset sequence writes to it and the emulator's doesn't.
+        yield from _check_ram(soc, machine, 0x0000, 0x0100)
+        yield from _check_ram(soc, machine, 0x0200, 0x8000)
+        yield from _check_leds(soc, machine)
+        sent = yield from _usb_in(soc.usb.bulk_in)
+        expected = bytes(machine.devices["usb_serial"].tx)
+        if sent != expected:
+            raise RuntimeError("The serial port sent "+sent.hex()+", expected "+expected.hex())
+        expected = machine.devices["wishbone"].target.words
+        for address in sorted(set(words) | set(expected)):
+            if words.get(address, 0) != expected.get(address, 0):
+                raise RuntimeError("Wishbone word "+hex(address)+" holds "+hex(words.get(address, 0))+
+                                   ", expected "+hex(expected.get(address, 0)))
+        print("Register run passed" + (" on the registered bus" if registered_bus else ""))
+    run_simulation(soc, [run(), _wishbone_memory(soc.wishbone, words)])
+
+def cmos_program():
+    """A program for PROGRAM that runs the 65C02's additions (STZ, BRA,
+    PHX/PLX/PHY/PLY, TSB/TRB, (zp), INC/DEC A, SMB/RMB, BBR/BBS and BIT #),
+    keeping A and the flags after each at RESULTS up and leaving the other
+    results in zero page and from RESULTS + 0x80, then writes MARK."""
+    program = []
+    kept = RESULTS
+    other = RESULTS + 0x80
+    def keep():
+        nonlocal kept
+        program.extend([("PHP", ""), ("STA", "abs", kept), ("PLA", ""), ("STA", "abs", kept + 1)])
+        kept += 2
+
+    program += [
+        ("LDA", "#", 0xFF), ("STA", "zp", 0x40), ("STA", "zp", 0x51),
+        ("STA", "abs", other), ("STA", "abs", other + 0x11),
+        ("LDX", "#", 0x11),
+        ("STZ", "zp", 0x40), ("STZ", "zp,x", 0x40), ("STZ", "abs", other), ("STZ", "abs,x", other),
+        ("BRA", "rel", "forward"),
+        "back",
+        ("LDA", "#", 0x5A), ("STA", "abs", other + 0x12),
+        ("BRA", "rel", "stack"),
+        "forward",
+        ("LDA", "#", 0xEE), ("BRA", "rel", "back"),
+        ("STA", "abs", other + 0x12),
+        "stack",
+        ("LDX", "#", 0x5A), ("LDY", "#", 0xA5),
+        ("PHX", ""), ("PHY", ""), ("LDX", "#", 0), ("LDY", "#", 0),
+        ("PLX", ""),
+        ]
+    keep()
+    program += [("PLY", "")]
+    keep()
+    program += [
+        ("STX", "abs", other + 0x13), ("STY", "abs", other + 0x14),
+        ("LDA", "#", 0x3C), ("STA", "zp", 0x42), ("LDA", "#", 0x01), ("STA", "abs", other + 0x15),
+        ("LDA", "#", 0x0F), ("TSB", "zp", 0x42),
+        ]
+    keep()
+    program += [("LDA", "#", 0xC0), ("TSB", "abs", other + 0x15)]
+    keep()
+    program += [("LDA", "#", 0x30), ("TRB", "zp", 0x42)]
+    keep()
+    program += [("LDA", "#", 0x02), ("TRB", "abs", other + 0x15)]
+    keep()
+    program += [
+        ("LDA", "#", (other + 0x16) & 0xFF), ("STA", "zp", 0x44),
+        ("LDA", "#", (other + 0x16) >> 8), ("STA", "zp", 0x45),
+        ("LDA", "#", 0x77), ("STA", "(zp)", 0x44),
+        ("LDA", "#", 0), ("LDA", "(zp)", 0x44), ("CLC", ""), ("ADC", "(zp)", 0x44),
+        ("EOR", "(zp)", 0x44), ("CMP", "(zp)", 0x44),
+        ]
+    keep()
+    program += [("LDA", "#", 0xFF), ("INC", "")]
+    keep()
+    program += [("DEC", "")]
+    keep()
+    program += [
+        ("LDA", "#", 0), ("STA", "zp", 0x46),
+        ("SMB0", "zp", 0x46), ("SMB7", "zp", 0x46), ("SMB3", "zp", 0x46), ("RMB0", "zp", 0x46),
+        ("RMB4", "zp", 0x51), ("SMB4", "zp", 0x40),
+        ("LDA", "#", 0x81), ("STA", "zp", 0x47),
+        # Taken branches skip their INC, so other + 0x18 and other + 0x1B end up 1.
+        ("BBS0", "zp,rel", 0x47, "bbs0"), ("INC", "abs", other + 0x17), "bbs0",
+        ("BBR0", "zp,rel", 0x47, "bbr0"), ("INC", "abs", other + 0x18), "bbr0",
+        ("BBR1", "zp,rel", 0x47, "bbr1"), ("INC", "abs", other + 0x19), "bbr1",
+        ("BBS7", "zp,rel", 0x47, "bbs7"), ("INC", "abs", other + 0x1A), "bbs7",
+        ("BBS6", "zp,rel", 0x47, "bbs6"), ("INC", "abs", other + 0x1B), "bbs6",
+        # BIT # only sets Z: N and V stay as BIT abs leaves them.
+        ("LDA", "#", 0xC0), ("STA", "abs", other + 0x1C),
+        ("LDA", "#", 0x0F), ("BIT", "abs", other + 0x1C), ("BIT", "#", 0x01),
+        ]
+    keep()
+    program += [("LDA", "#", 0x0F), ("BIT", "#", 0x30)]
+    keep()
+    program += [
+        ("STA", "abs", MARK),
+        "end",
+        ("JMP", "abs", "end"),
+        ]
+    return assemble(PROGRAM, program, cmos=True)
+
+def cmos_run(registered_bus=False):
+    """Run cmos_program() on the 65C02 core, checking what it leaves in RAM
+    against the emulator's 65C02."""
+    program = cmos_program()
+    image = bytearray(0x8000)
+    image[PROGRAM:PROGRAM + len(program)] = program
+    soc, machine = _program_run(image, MARK, registered_bus, cpu_variant="65c02")
+
+    def run():
+        yield from _run_to_mark(soc, 20000, {"marks": {}, "dma": []})
+        yield from _check_ram(soc, machine, 0x0000, 0x0100)
+        yield from _check_ram(soc, machine, 0x0200, 0x8000)
+        print("65C02 run passed" + (" on the registered bus" if registered_bus else ""))
+    run_simulation(soc, run())
+
+def checksum_program():
+    """A program for PROGRAM that fills 0x0300-0x033F, going through
+    a JSR, the stack and decimal mode for each byte, and stores the count
+    at 0x0400; then sums the table with (zp),Y loads and stores the low
+    byte of the sum at 0x0401. Returns it and the subroutine for 0x0280."""
+    program = assemble(PROGRAM, [
+        ("LDX", "#", 0),
+        ("LDA", "#", 0x35),
+        "fill",
+        ("CLC", ""), ("ADC", "#", 0x17), ("STA", "abs,x", 0x0300), ("INX", ""),
+        ("PHA", ""), ("PLA", ""),
+        ("SED", ""), ("ADC", "#", 0x19), ("CLD", ""),
+        ("LSR", ""), ("JSR", "abs", 0x0280),
+        ("CPX", "#", 0x40), ("BNE", "rel", "fill"),
+        ("STA", "abs", 0x0400),
+        ("LDA", "#", 0x00), ("STA", "zp", 0x12), ("LDA", "#", 0x03), ("STA", "zp", 0x13),
+        ("LDY", "#", 0), ("LDA", "#", 0),
+        "sum",
+        ("CLC", ""), ("ADC", "(zp),y", 0x12), ("BCC", "rel", "no_carry"), ("INC", "zp", 0x11),
+        "no_carry",
+        ("INY", ""), ("CPY", "#", 0x40), ("BNE", "rel", "sum"),
+        ("STA", "zp", 0x10),
+        ("STA", "abs", 0x0401),
+        ("JMP", "abs", PROGRAM),
+        ])
+    subroutine = assemble(0x0280, [("INC", "zp", 0x10), ("LDA", "zp", 0x10), ("RTS", "")])
+    return program, subroutine
+
+def checksum_run(registered_bus=False):
+    """Run checksum_program() from SPRAM, checking what it stores against
+    the emulator. Its fetches and (zp),Y pointer loads read the same word
+    again and again, so most of them are answered from the word FomuSPRAM
+    keeps from its last read; this reports how many."""
+    program, subroutine = checksum_program()
+    image = bytearray(0x8000)
+    image[PROGRAM:PROGRAM + len(program)] = program
+    image[0x0280:0x0280 + len(subroutine)] = subroutine
+    soc, machine = _program_run(image, 0x0401, registered_bus)
+
+    def run():
+        cpu = soc.cpu
+        held = 0
+        for cycle in range(20000):
+            yield
+            if (yield soc.ram.held):
+                held += 1
+            if (yield cpu.rdy) and (yield cpu.we) and (yield cpu.address) == 0x0401:
+                break
+        else:
+            raise RuntimeError("Checksum didn't finish in 20000 cycles")
+        yield
+        yield from _check_ram(soc, machine, 0x0300, 0x0402)
+        if not held:
+            raise RuntimeError("No reads were answered from the kept word")
+        print("Checksum run passed in", cycle, "cycles" + (" on the registered bus," if registered_bus else ","),
+              held, "cycles reading the kept word; count", hex(machine.mem[0x0400]),
+              "sum", hex(machine.mem[0x0401]))
+    run_simulation(soc, run())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SoC in migen's simulator")
+    parser.add_argument("run", nargs="?", default="boot", choices=["boot", "dma-check", "dma-bench", "checksum", "registers", "65c02"],
+                        help="boot: the boot ROM, for --cycles; dma-check: every DMA operation, against the "
+                             "emulator; dma-bench: DMA against CPU copies; checksum: a program run from SPRAM; "
+                             "registers: indexed and read-modify-write stores to the devices, against the emulator; "
+                             "65c02: the 65C02 core's additions, against the emulator")
+    parser.add_argument("--registered-bus", action="store_true", help="Build the SoC with a registered bus")
+    parser.add_argument("--cycles", type=int, default=1000, help="Cycles to run the boot ROM for")
+    parser.add_argument("--length", type=int, default=64, help="Bytes to move for dma-bench")
+    args = parser.parse_args()
 
-run_simulation(fomu, testbench())
-    
+    if args.run == "boot":
+        platform = FomuPlatform(revision="pvt")
+        fomu = Fomu(platform, simulation=True, registered_bus=args.registered_bus)
+        run_simulation(fomu, testbench(fomu, args.cycles))
+    elif args.run == "dma-check":
+        dma_check(args.registered_bus)
+    elif args.run == "dma-bench":
+        dma_bench(args.length, args.registered_bus)
+    elif args.run == "checksum":
+        checksum_run(args.registered_bus)
+    elif args.run == "registers":
+        registers_run(args.registered_bus)
+    else:
+        cmos_run(args.registered_bus)
@@ -0,0 +1,116 @@
+/*
+ * C harness around the Verilator model of verilator_top.v. It is built
+ * into a shared library and driven from fomu_verilator.py through ctypes,
+ * so the whole clock loop runs in C++ and Python only sees the result.
+ */
+#include <cstdint>
+#include <cstring>
+#include "verilated.h"
+#include "Vverilator_top.h"
+
+struct FomuSim {
+    VerilatedContext *context;
+    Vverilator_top *top;
+    uint64_t cycles;
+    uint16_t last_pc;
+    uint8_t memory[65536];      // Shadow of every byte the CPU has written
+};
+
+// Why fomusim_run() returned.
+enum {
+    STOP_CYCLES = 0,
+    STOP_PC = 1,
+    STOP_WRITE = 2,
+    STOP_FINISH = 3,
+};
+
+static void half_period(FomuSim *sim)
+{
+    sim->top->clk48 = !sim->top->clk48;
+    sim->top->eval();
+    sim->context->timeInc(1);
+}
+
+extern "C" {
+
+void *fomusim_new(void)
+{
+    FomuSim *sim = new FomuSim;
+    sim->context = new VerilatedContext;
+    sim->top = new Vverilator_top(sim->context);
+    sim->cycles = 0;
+    sim->last_pc = 0;
+    memset(sim->memory, 0, sizeof(sim->memory));
+    sim->top->clk48 = 0;
+    sim->top->eval();
+    return sim;
+}
+
+void fomusim_free(void *handle)
+{
+    FomuSim *sim = (FomuSim *)handle;
+    sim->top->final();
+    delete sim->top;
+    delete sim->context;
+    delete sim;
+}
+
+/*
+ * Run for up to max_cycles CPU clock cycles. stop_pc and stop_write are
+ * addresses, or -1 to disable them. Bus state is sampled on the falling
+ * edge of the CPU clock, when everything the core registered on the
+ * rising edge has settled.
+ */
+int fomusim_run(void *handle, uint64_t max_cycles, int32_t stop_pc,
+                int32_t stop_write, uint64_t *cycles_out, uint32_t *pc_out)
+{
+    FomuSim *sim = (FomuSim *)handle;
+    Vverilator_top *top = sim->top;
+    uint64_t end = sim->cycles + max_cycles;
+    int reason = STOP_CYCLES;
+
+    while (sim->cycles < end) {
+        uint8_t was_high = top->cpu_clk;
+        half_period(sim);
+        if (sim->context->gotFinish()) {
+            reason = STOP_FINISH;
+            break;
+        }
+        if (!was_high && top->cpu_clk) {
+            sim->cycles++;
+        } else if (was_high && !top->cpu_clk && top->cpu_rdy) {
+            if (top->cpu_we) {
+                sim->memory[top->cpu_ab] = top->cpu_do;
+                if ((int32_t)top->cpu_ab == stop_write) {
+                    reason = STOP_WRITE;
+                    break;
+                }
+            }
+            if (top->cpu_sync) {
+                sim->last_pc = top->cpu_pc;
+                if ((int32_t)top->cpu_pc == stop_pc) {
+                    reason = STOP_PC;
+                    break;
+                }
+            }
+        }
+    }
+
+    *cycles_out = sim->cycles;
+    *pc_out = sim->last_pc;
+    return reason;
+}
+
+int fomusim_peek(void *handle, uint32_t address)
+{
+    FomuSim *sim = (FomuSim *)handle;
+    return sim->memory[address & 0xFFFF];
+}
+
+int fomusim_leds(void *handle)
+{
+    FomuSim *sim = (FomuSim *)handle;
+    return (sim->top->led_rgb2 << 2) | (sim->top->led_rgb1 << 1) | sim->top->led_rgb0;
+}
+
+}
@@ -0,0 +1,52 @@
+/*
+ * Verilator wrapper for the generated SoC. The only real input is the
+ * 48MHz oscillator; everything else is observed from inside the cpu
+ * instance so the C++ harness can count CPU cycles, spot instruction
+ * boundaries and shadow writes without the SoC having to export anything.
+ */
+module verilator_top(
+	input clk48,
+	output led_rgb0,
+	output led_rgb1,
+	output led_rgb2,
+	output cpu_clk,
+	output cpu_sync,
+	output [15:0] cpu_pc,
+	output [15:0] cpu_ab,
+	output [7:0] cpu_do,
+	output cpu_we,
+	output cpu_rdy
+	);
+
+wire flash_csn;
+wire flash_clk;
+wire [3:0] flash_dq;
+
+top dut(
+	.clk48(clk48),
+	.led_rgb0(led_rgb0),
+	.led_rgb1(led_rgb1),
+	.led_rgb2(led_rgb2),
+	.spiflash4x_cs_n(flash_csn),
+	.spiflash4x_clk(flash_clk),
+	.spiflash4x_dq(flash_dq)
+	);
+
+spiflash_model flash(
+	.csn(flash_csn),
+	.clk(flash_clk),
+	.dq(flash_dq)
+	);
+
+// cpu.v decodes an opcode while in DECODE (state 12). Whether the opcode
+// came straight off the bus or was prefetched into IRHOLD by PUSH0/PULL0,
+// PC has already moved one past it by then.
+assign cpu_clk = dut.cpu.clk;
+assign cpu_sync = (dut.cpu.state == 6'd12) & dut.cpu.RDY;
+assign cpu_pc = dut.cpu.PC - 16'd1;
+assign cpu_ab = dut.cpu.AB;
+assign cpu_do = dut.cpu.DO;
+assign cpu_we = dut.cpu.WE;
+assign cpu_rdy = dut.cpu.RDY;
+
+endmodule